@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/11 3:20 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : __init__.py
+# @Software: xingzhe.ai
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/25 6:00 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : face_detect_bench.py
+# @Software: xingzhe.ai
+'''
+输出图人脸检测单图耗时：原 detect_faces（每次创建 dlib 检测器、读文件、原图检测、串行）
+对比 FaceDetector（检测器复用、缩小检测、线程池批量、哈希缓存），并对比两者的人脸数。
+
+    python -m benchmark.face_detect_bench --dir handlers/clothes_repair/template_image
+'''
+import argparse
+import glob
+import os
+import time
+import numpy as np
+from PIL import Image
+from tools.face import FaceDetector
+
+
+def legacy_detect_faces(image_path) -> int:
+    import dlib
+    # 与原实现相同：每次创建检测器，原图灰度图 upsample=1 检测
+    gray = np.asarray(Image.open(image_path).convert('L'))
+    detector = dlib.get_frontal_face_detector()
+    return len(detector(gray, 1))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default=os.path.join('handlers', 'clothes_repair', 'template_image'))
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.dir, '*.png')) + glob.glob(os.path.join(args.dir, '*.jpg')))
+    images = [Image.open(p).convert('RGB') for p in paths]
+    print(f"images={len(paths)}, size={images[0].size}, workers={args.workers}, cpus={os.cpu_count()}")
+
+    st = time.time()
+    legacy = [legacy_detect_faces(p) for p in paths]
+    legacy_cost = (time.time() - st) / len(paths)
+    print(f"{'legacy':>16}: {legacy_cost * 1e3:7.1f} ms/image, faces={legacy}")
+
+    detector = FaceDetector(workers=args.workers)
+    for name in ('batched (cold)', 'batched (cached)'):
+        st = time.time()
+        faces = detector.batch_count(images)
+        cost = (time.time() - st) / len(paths)
+        print(f"{name:>16}: {cost * 1e3:7.1f} ms/image, faces={faces}, speedup x{legacy_cost / cost:.1f}")
+    detector.close()
+
+
+if __name__ == '__main__':
+    main()
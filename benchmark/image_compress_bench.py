@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/25 11:20 AM
+# @Author  : wangdongming
+# @Site    :
+# @File    : image_compress_bench.py
+# @Software: xingzhe.ai
+'''
+LOW 图压缩单核吞吐：原实现（质量每次降 30 全图重编码）对比 encode_to_size（预览图二分估算质量，1~2 次全图编码），
+语料为固定随机种子生成的图片（渐变、模糊噪声、几何图形，接近生成图的频谱）。
+
+    python -m benchmark.image_compress_bench --images 16 --size 1024 --kb 300
+'''
+import argparse
+import random
+import time
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageFilter
+from tools.image import encode_to_size, support_format
+
+
+def make_corpus(count: int, size: int, seed: int = 2023):
+    rnd = random.Random(seed)
+    images = []
+    for _ in range(count):
+        base = Image.linear_gradient('L').resize((size, size)).rotate(rnd.randint(0, 359))
+        noise = Image.effect_noise((size, size), rnd.randint(20, 80)).filter(ImageFilter.GaussianBlur(rnd.uniform(0.5, 3)))
+        im = Image.merge('RGB', (base, noise, base.transpose(Image.FLIP_LEFT_RIGHT))).convert('RGB')
+        draw = ImageDraw.Draw(im)
+        for _ in range(rnd.randint(10, 40)):
+            x, y, r = rnd.randint(0, size), rnd.randint(0, size), rnd.randint(size // 40, size // 6)
+            color = tuple(rnd.randint(0, 255) for _ in range(3))
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=color, outline=(0, 0, 0))
+        detail = Image.effect_noise((size, size), rnd.randint(5, 30)).convert('RGB')
+        images.append(Image.blend(im, detail, rnd.uniform(0.1, 0.6)))
+    return images
+
+
+def legacy_compress(im: Image.Image, kb: float, step: int = 30, quality: int = 70):
+    # 原 compress_image 的编码循环（原文件已大于 kb）
+    im, data, encodes = im.convert('RGB'), None, 0
+    o_size = kb + 1
+    while o_size > kb:
+        out = BytesIO()
+        im.save(out, format='JPEG', quality=quality)
+        encodes += 1
+        if quality - step < 0:
+            break
+        data = out.getvalue()
+        o_size = len(data) / 1024
+        quality -= step
+    return data, encodes
+
+
+def count_encodes(fn):
+    # 统计原图尺寸的编码次数
+    counter = {'n': 0}
+    save = Image.Image.save
+
+    def counted(im, fp, *args, **kwargs):
+        if im.size == counter['size']:
+            counter['n'] += 1
+        return save(im, fp, *args, **kwargs)
+
+    def run(im, *args):
+        counter['size'] = im.size
+        Image.Image.save = counted
+        try:
+            return fn(im, *args), counter['n']
+        finally:
+            Image.Image.save = save
+    return run, counter
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=16)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--kb', type=float, default=300)
+    parser.add_argument('--formats', default='JPEG,WEBP,AVIF')
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.images, args.size)
+    print(f"images={args.images}, size={args.size}x{args.size}, target={args.kb}KB, single thread")
+    cases = [('legacy JPEG', lambda im: legacy_compress(im, args.kb))]
+    for format in args.formats.upper().split(','):
+        if not support_format(format):
+            print(f"{format} not supported, skip")
+            continue
+        run, counter = count_encodes(lambda im, f=format: encode_to_size(im, args.kb, f))
+
+        def case(im, run=run, counter=counter):
+            counter['n'] = 0
+            return run(im)
+        cases.append((f'adaptive {format}', case))
+
+    for name, fn in cases:
+        st, encodes, sizes, hits = time.time(), 0, 0, 0
+        for im in corpus:
+            data, n = fn(im)
+            encodes += n
+            sizes += len(data)
+            hits += len(data) <= args.kb * 1024
+        cost = time.time() - st
+        print(f"{name:>14}: {args.images / cost:6.2f} images/s/core, {encodes / args.images:.2f} full encodes/image, "
+              f"avg {sizes / args.images / 1024:.0f}KB, {hits}/{args.images} within target")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/15 10:40 AM
+# @Author  : wangdongming
+# @Site    :
+# @File    : queue_load.py
+# @Software: xingzhe.ai
+'''
+任务队列压测：N 个模拟 worker（线程）对本地 REDIS（默认 fakeredis，可通过 --redis-url 指定真实实例）
+并发领取任务，生产者按 Zipf 分布向多个模型队列投递任务（或回放记录的任务），统计：
+领取吞吐、领取耗时分位数、每个任务的 REDIS 请求数、重复领取与丢失任务、各队列等待时间的公平性。
+
+领取路径与 TaskReceiver 一致（注册表快照 -> 调度策略排序 -> LUA 原子领取 -> 租约完成），
+投递与 RedisSender 一致（QueueRegistry.push，分数 level*-100000+当前时间），
+执行期间按 AsyncTaskDumper 的方式写入进度缓存。
+
+    python -m benchmark.queue_load --workers 50 --models 100 --rate 200 --duration 10
+    python -m benchmark.queue_load --replay tasks.jsonl --json result.json
+
+回放文件每行一个任务：{"at": 投递时间（秒，相对开始）, "model_hash": "...", "level": 0}
+'''
+import argparse
+import json
+import random
+import threading
+import time
+import typing
+from collections import defaultdict
+import fakeredis
+import redis
+from tools.model_hist import CkptLoadRecorder
+from worker.claim import TaskClaimer
+from worker.queue_registry import QueueRegistry
+from worker.scheduler import TaskQueuePrefix, queue_model_hash
+from benchmark.schedule_sim import POLICIES, _percentile
+
+# 模拟一次出图写入的进度次数（AsyncTaskDumper 进度缓存）
+ProgressUpdates = 5
+
+
+class CommandStats:
+
+    def __init__(self):
+        self.round_trips = 0
+        self.commands = 0
+
+    def add(self, commands: int = 1):
+        self.round_trips += 1
+        self.commands += commands
+
+
+class CountingMixin:
+    '''
+    统计客户端请求数：普通命令和脚本调用各算一次往返，PIPELINE 算一次往返、多条命令。
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = CommandStats()
+
+    def execute_command(self, *args, **options):
+        self.stats.add()
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super().pipeline(transaction, shard_hint)
+        execute = pipe.execute
+
+        def counted_execute(raise_on_error=True):
+            self.stats.add(len(pipe.command_stack))
+            return execute(raise_on_error)
+
+        pipe.execute = counted_execute
+        return pipe
+
+
+class CountingFakeRedis(CountingMixin, fakeredis.FakeRedis):
+    pass
+
+
+class CountingRedis(CountingMixin, redis.Redis):
+    pass
+
+
+def client_factory(redis_url: str = None) -> typing.Callable[[], CountingMixin]:
+    if redis_url:
+        pool = redis.ConnectionPool.from_url(redis_url)
+        return lambda: CountingRedis(connection_pool=pool)
+    server = fakeredis.FakeServer()
+    return lambda: CountingFakeRedis(server=server)
+
+
+class TaskRecord(typing.NamedTuple):
+    at: float
+    model_hash: str
+    level: int
+
+
+def synthetic_tasks(models: int, rate: float, duration: float, zipf: float = 1.1,
+                    vip_ratio: float = 0.1, seed: int = 0) -> typing.List[TaskRecord]:
+    rnd = random.Random(seed)
+    model_hashes = ['%010d' % i for i in range(models)]
+    weights = [1 / (i + 1) ** zipf for i in range(models)]
+    tasks, t = [], 0
+    while True:
+        t += rnd.expovariate(rate)
+        if t >= duration:
+            break
+        level = 1 if rnd.random() < vip_ratio else 0
+        tasks.append(TaskRecord(t, rnd.choices(model_hashes, weights)[0], level))
+    return tasks
+
+
+def load_tasks(path: str) -> typing.List[TaskRecord]:
+    tasks = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                r = json.loads(line)
+                tasks.append(TaskRecord(float(r['at']), r['model_hash'][:10], int(r.get('level', 0))))
+    tasks.sort(key=lambda x: x.at)
+    return tasks
+
+
+class LoadTest:
+
+    def __init__(self, tasks: typing.Sequence[TaskRecord], workers: int, policy: str = 'cost',
+                 service_ms: float = 20, switch_ms: float = 10, idle_ms: float = 20,
+                 redis_url: str = None, drain_timeout: float = 60):
+        self.tasks = tasks
+        self.workers = workers
+        self.policy = POLICIES[policy]
+        self.service = service_ms / 1000
+        self.switch = switch_ms / 1000
+        self.idle = idle_ms / 1000
+        self.drain_timeout = drain_timeout
+        self.new_client = client_factory(redis_url)
+        self.clients = []
+        self.locker = threading.Lock()
+        self.pushed = {}
+        self.claims = defaultdict(list)
+        self.claim_latencies = []
+        self.empty_searches = 0
+        self.producing = True
+        self.stopped = False
+
+    def _client(self):
+        rds = self.new_client()
+        with self.locker:
+            self.clients.append(rds)
+        return rds
+
+    def produce(self):
+        rds = self._client()
+        registry = QueueRegistry()
+        start = time.time()
+        for i, t in enumerate(self.tasks):
+            delay = start + t.at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            task_id = f'bench-{i}'
+            queue_name = TaskQueuePrefix + t.model_hash
+            now = int(time.time() * 1000)
+            meta = json.dumps({'task_id': task_id, 'model_hash': t.model_hash, 'task_type': 1,
+                               'user_id': f'user-{i % 97}', 'create_at': int(time.time())})
+            with self.locker:
+                self.pushed[task_id] = (queue_name, time.time())
+            registry.push(rds, queue_name, task_id, t.level * -100000 + now, meta, 3600)
+        self.producing = False
+
+    def receive(self, idx: int):
+        rds = self._client()
+        worker_id = f'bench-worker-{idx}'
+        claimer = TaskClaimer(worker_id)
+        recorder = CkptLoadRecorder(3)
+        disk = set()
+        policy = self.policy(recorder, disk)
+        while not self.stopped:
+            st = time.perf_counter()
+            claimed, queue_name = None, None
+            stats = [s for s in claimer.registry.snapshot(rds) if s.name.startswith(TaskQueuePrefix)]
+            for queue_name in (policy.order(stats) if stats else []):
+                claimed = claimer.claim(rds, queue_name)
+                if claimed:
+                    break
+            cost = time.perf_counter() - st
+            if not claimed:
+                with self.locker:
+                    self.empty_searches += 1
+                if not self.producing and not stats:
+                    return
+                time.sleep(self.idle)
+                continue
+            with self.locker:
+                self.claims[claimed.task_id].append((worker_id, time.time()))
+                self.claim_latencies.append(cost)
+
+            model_hash = queue_model_hash(queue_name)
+            history = recorder.history()
+            service = self.service if history and history[-1] == model_hash else self.service + self.switch
+            recorder.switch_model(model_hash)
+            disk.add(model_hash)
+            for i in range(ProgressUpdates):
+                time.sleep(service / ProgressUpdates)
+                rds.set(claimed.task_id, json.dumps({'task_progress': (i + 1) * 100 // ProgressUpdates}), 1200)
+            claimer.leases.complete(rds, claimed.task_id)
+
+    def run(self) -> typing.Dict:
+        threads = [threading.Thread(target=self.receive, args=(i,), daemon=True) for i in range(self.workers)]
+        producer = threading.Thread(target=self.produce, daemon=True)
+        start = time.time()
+        producer.start()
+        for t in threads:
+            t.start()
+        producer.join()
+        deadline = time.time() + self.drain_timeout
+        for t in threads:
+            t.join(max(deadline - time.time(), 0))
+        self.stopped = True
+        elapsed = time.time() - start
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> typing.Dict:
+        claimed = dict((task_id, v) for task_id, v in self.claims.items() if task_id in self.pushed)
+        duplicates = sum(1 for v in claimed.values() if len(v) > 1)
+        # 未被领取且不在队列中的任务视为丢失，仍在队列中的为排空超时未执行
+        rds = self.new_client()
+        unclaimed = [task_id for task_id in self.pushed if task_id not in claimed]
+        lost = [task_id for task_id in unclaimed if rds.zscore(self.pushed[task_id][0], task_id) is None]
+        waits, queue_waits = [], defaultdict(list)
+        for task_id, v in claimed.items():
+            queue_name, push_at = self.pushed[task_id]
+            wait = v[0][1] - push_at
+            waits.append(wait)
+            queue_waits[queue_name].append(wait)
+        # Jain 公平性指数：各队列平均等待时间越接近越趋近 1
+        means = [sum(v) / len(v) for v in queue_waits.values()]
+        fairness = sum(means) ** 2 / (len(means) * sum(x * x for x in means)) if means and any(means) else 1
+        round_trips = sum(c.stats.round_trips for c in self.clients)
+        commands = sum(c.stats.commands for c in self.clients)
+        n = max(len(claimed), 1)
+        return {
+            'workers': self.workers,
+            'tasks': len(self.pushed),
+            'claimed': len(claimed),
+            'elapsed': elapsed,
+            'claims_per_sec': len(claimed) / max(elapsed, 1e-6),
+            'claim_p50_ms': _percentile(self.claim_latencies, 0.5) * 1000,
+            'claim_p95_ms': _percentile(self.claim_latencies, 0.95) * 1000,
+            'claim_p99_ms': _percentile(self.claim_latencies, 0.99) * 1000,
+            'wait_p50': _percentile(waits, 0.5),
+            'wait_p99': _percentile(waits, 0.99),
+            'empty_searches': self.empty_searches,
+            'round_trips_per_task': round_trips / n,
+            'commands_per_task': commands / n,
+            'duplicates': duplicates,
+            'pending': len(unclaimed) - len(lost),
+            'lost': len(lost),
+            'queues': len(queue_waits),
+            'fairness': fairness,
+            'worst_queue_wait': max(means) if means else 0,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='*', default=[50])
+    parser.add_argument('--models', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=200, help='tasks per second')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--zipf', type=float, default=1.1)
+    parser.add_argument('--replay', help='task records (jsonl)')
+    parser.add_argument('--policy', choices=list(POLICIES), default='cost')
+    parser.add_argument('--service-ms', type=float, default=20)
+    parser.add_argument('--switch-ms', type=float, default=10)
+    parser.add_argument('--idle-ms', type=float, default=20)
+    parser.add_argument('--redis-url', help='use a real redis server instead of fakeredis')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write results to file')
+    args = parser.parse_args()
+
+    if args.replay:
+        tasks = load_tasks(args.replay)
+    else:
+        tasks = synthetic_tasks(args.models, args.rate, args.duration, args.zipf, seed=args.seed)
+    results = []
+    for workers in args.workers:
+        r = LoadTest(tasks, workers, args.policy, args.service_ms, args.switch_ms, args.idle_ms,
+                     args.redis_url).run()
+        results.append(r)
+        print(f"workers={workers} tasks={r['tasks']} claimed={r['claimed']} "
+              f"claims/s={r['claims_per_sec']:.1f} claim p50/p95/p99={r['claim_p50_ms']:.1f}/"
+              f"{r['claim_p95_ms']:.1f}/{r['claim_p99_ms']:.1f}ms wait p50/p99={r['wait_p50']:.2f}/"
+              f"{r['wait_p99']:.2f}s redis/task={r['round_trips_per_task']:.1f} "
+              f"(cmds {r['commands_per_task']:.1f}) empty={r['empty_searches']} "
+              f"dup={r['duplicates']} lost={r['lost']} pending={r['pending']} fairness={r['fairness']:.2f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
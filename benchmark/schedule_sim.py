@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/11 3:24 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : schedule_sim.py
+# @Software: xingzhe.ai
+'''
+队列调度策略离线仿真：多 worker、多模型队列（Zipf 分布热度）、泊松到达，
+按模型位置（显存/内存/磁盘/远端）计算切换耗时，对比各策略的吞吐与排队延迟。
+
+    python -m benchmark.schedule_sim --workers 8 --models 60 --rate 0.4
+'''
+import argparse
+import heapq
+import random
+import typing
+from collections import OrderedDict, deque, Counter
+from tools.model_hist import CkptLoadRecorder
+from worker.queue_registry import QueueStat
+from worker.scheduler import SchedulePolicy, AffinityFirstPolicy, CostBasedPolicy, TaskQueuePrefix, \
+    SwitchCostLoaded, SwitchCostRAM, SwitchCostDisk, SwitchCostRemote, queue_model_hash
+
+PolicyFactory = typing.Callable[[CkptLoadRecorder, typing.Container[str]], SchedulePolicy]
+
+POLICIES = {
+    'affinity': lambda recorder, disk: AffinityFirstPolicy(recorder.history),
+    'cost': lambda recorder, disk: CostBasedPolicy(recorder.history, disk),
+}
+
+
+class SimWorker:
+
+    def __init__(self, idx: int, policy_factory: PolicyFactory, ram_slots: int, disk_slots: int):
+        self.idx = idx
+        self.recorder = CkptLoadRecorder(ram_slots)
+        self.disk = OrderedDict()
+        self.disk_slots = disk_slots
+        self.policy = policy_factory(self.recorder, self.disk)
+
+    def load(self, model_hash: str) -> typing.Tuple[str, float]:
+        history = self.recorder.history()
+        if history and history[-1] == model_hash:
+            kind, cost = 'loaded', SwitchCostLoaded
+        elif model_hash in history:
+            kind, cost = 'ram', SwitchCostRAM
+        elif model_hash in self.disk:
+            kind, cost = 'disk', SwitchCostDisk
+        else:
+            kind, cost = 'remote', SwitchCostRemote
+        self.recorder.switch_model(model_hash)
+        self.disk[model_hash] = True
+        self.disk.move_to_end(model_hash)
+        while len(self.disk) > self.disk_slots:
+            self.disk.popitem(last=False)
+        return kind, cost
+
+
+def _percentile(values: typing.List[float], p: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def simulate(policy_factory: PolicyFactory, workers: int = 8, models: int = 60, rate: float = 0.4,
+             duration: float = 3600, gen_seconds: float = 6, zipf: float = 1.1,
+             ram_slots: int = 3, disk_slots: int = 10, seed: int = 0) -> typing.Dict:
+    '''
+    rate 为每秒到达任务数，duration 为仿真时长（秒），超出时长后不再到达新任务但会执行完剩余任务。
+    '''
+    rnd = random.Random(seed)
+    model_hashes = ['%010d' % i for i in range(models)]
+    weights = [1 / (i + 1) ** zipf for i in range(models)]
+    queues = dict((TaskQueuePrefix + h, deque()) for h in model_hashes)
+    sim_workers = [SimWorker(i, policy_factory, ram_slots, disk_slots) for i in range(workers)]
+
+    # 事件：(时间, 序号, 类型, 数据)
+    events, seq = [], 0
+    t = 0
+    while t < duration:
+        t += rnd.expovariate(rate)
+        queue_name = TaskQueuePrefix + rnd.choices(model_hashes, weights)[0]
+        events.append((t, seq, 'arrive', queue_name))
+        seq += 1
+    heapq.heapify(events)
+    idle = list(range(workers))
+    latencies, switches = [], Counter()
+    busy_time, end_time = 0, 0
+
+    def dispatch(now: float):
+        nonlocal seq, busy_time
+        while idle:
+            stats = [QueueStat(name, len(q), q[0] * 1000) for name, q in queues.items() if q]
+            if not stats:
+                return
+            w = sim_workers[idle.pop(0)]
+            queue_name = w.policy.order(stats, int(now * 1000))[0]
+            arrive_at = queues[queue_name].popleft()
+            kind, cost = w.load(queue_model_hash(queue_name))
+            switches[kind] += 1
+            service = cost + gen_seconds * rnd.uniform(0.8, 1.2)
+            busy_time += service
+            latencies.append(now + service - arrive_at)
+            heapq.heappush(events, (now + service, seq, 'done', w.idx))
+            seq += 1
+
+    while events:
+        now, _, kind, data = heapq.heappop(events)
+        end_time = now
+        if kind == 'arrive':
+            queues[data].append(now)
+        else:
+            idle.append(data)
+        dispatch(now)
+
+    return {
+        'tasks': len(latencies),
+        'throughput_per_min': len(latencies) / max(end_time, 1) * 60,
+        'utilization': busy_time / max(end_time * workers, 1),
+        'p50': _percentile(latencies, 0.5),
+        'p95': _percentile(latencies, 0.95),
+        'p99': _percentile(latencies, 0.99),
+        'max': max(latencies) if latencies else 0,
+        'switches': dict(switches),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--models', type=int, default=60)
+    parser.add_argument('--rate', type=float, default=0.4, help='tasks per second')
+    parser.add_argument('--duration', type=float, default=3600)
+    parser.add_argument('--gen-seconds', type=float, default=6)
+    parser.add_argument('--zipf', type=float, default=1.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--policy', choices=list(POLICIES), nargs='*', default=list(POLICIES))
+    args = parser.parse_args()
+
+    for name in args.policy:
+        r = simulate(POLICIES[name], workers=args.workers, models=args.models, rate=args.rate,
+                     duration=args.duration, gen_seconds=args.gen_seconds, zipf=args.zipf, seed=args.seed)
+        print(f"{name:>10}: tasks={r['tasks']} throughput={r['throughput_per_min']:.1f}/min "
+              f"util={r['utilization']:.2f} p50={r['p50']:.1f}s p95={r['p95']:.1f}s "
+              f"p99={r['p99']:.1f}s max={r['max']:.1f}s switches={r['switches']}")
+
+
+if __name__ == '__main__':
+    main()
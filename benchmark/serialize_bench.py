@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/18 4:05 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : serialize_bench.py
+# @Software: xingzhe.ai
+'''
+TaskProgress 单次进度更新的序列化耗时：反射 to_dict（dir 遍历）+ json 对比显式字段 to_dict + orjson，
+训练任务带 N 个 epoch 的训练日志。
+
+    python -m benchmark.serialize_bench --epochs 100
+'''
+import argparse
+import json
+import timeit
+from tools import serialize
+from worker.task import Task, TaskProgress, TrainEpoch, SerializationObj
+
+
+def reflect_to_dict(obj):
+    # 原实现：遍历 dir()，对每个属性 getattr + callable 判断并递归
+    return SerializationObj.to_dict(obj)
+
+
+def make_progress(epochs: int) -> TaskProgress:
+    task = Task(task_id='bench-train-task', task_type=4, user_id='bench', minor_type=1,
+                prompt='a photo of sks person' * 4, base_model_path='sd-models/base.safetensors',
+                train={'params': {'lr': 1e-4, 'epoch': epochs, 'batch_size': 2}})
+    p = TaskProgress(task)
+    for i in range(epochs):
+        p.train.add_epoch_log(TrainEpoch(i, 0.1 / (i + 1)))
+    p.task_progress = 50
+    p.task_desc = 'training'
+    return p
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--epochs', type=int, default=100)
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    p = make_progress(args.epochs)
+    cases = [
+        ('reflect to_dict', lambda: reflect_to_dict(p)),
+        ('explicit to_dict', lambda: p.to_dict()),
+        ('reflect + json', lambda: json.dumps(reflect_to_dict(p))),
+        ('explicit + serialize', lambda: serialize.dumps(p.to_dict())),
+    ]
+    backend = 'orjson' if serialize.orjson is not None else 'json'
+    print(f"epochs={args.epochs}, serializer backend={backend}")
+    for name, fn in cases:
+        cost = min(timeit.repeat(fn, number=args.number, repeat=3)) / args.number
+        print(f"{name:>22}: {cost * 1e6:8.1f} us/update")
+
+
+if __name__ == '__main__':
+    main()
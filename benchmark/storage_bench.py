@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/22 6:10 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : storage_bench.py
+# @Software: xingzhe.ai
+'''
+存储客户端单对象开销：每个对象新建客户端（原 `with FileStorageCls() as s`）对比进程内共享客户端（get_storage），
+本地起一个 keep-alive 的 S3 兼容替身（PUT/GET 对象），N 个线程并发上传后下载小文件。
+
+    python -m benchmark.storage_bench --objects 500 --threads 8
+'''
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from requests.adapters import HTTPAdapter
+from filestorage import get_storage
+from filestorage.storage import FileStorage
+from tools.environment import get_storage_pool_size
+
+
+class _ObjectHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    objects = {}
+
+    def do_PUT(self):
+        self.objects[self.path] = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        data = self.objects.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BenchFileStorage(FileStorage):
+    '''
+    对象存储 SDK 客户端替身：创建时建立会话及连接池（不注册为存储后端）。
+    '''
+    endpoint = None
+
+    def __init__(self):
+        super(BenchFileStorage, self).__init__()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=get_storage_pool_size())
+        self.session.mount('http://', adapter)
+
+    def download(self, remoting_path, local_path, progress_callback=None) -> str:
+        resp = self.session.get(f'{self.endpoint}/{remoting_path}', timeout=10)
+        resp.raise_for_status()
+        with open(local_path, 'wb') as f:
+            f.write(resp.content)
+        return local_path
+
+    def upload(self, local_path, remoting_path) -> str:
+        with open(local_path, 'rb') as f:
+            self.session.put(f'{self.endpoint}/{remoting_path}', data=f.read(), timeout=10).raise_for_status()
+        return remoting_path
+
+    def close(self):
+        self.session.close()
+        super(BenchFileStorage, self).close()
+
+
+def per_object(local, key, dst):
+    with BenchFileStorage() as s:
+        s.upload(local, key)
+    with BenchFileStorage() as s:
+        s.download(key, dst)
+
+
+def shared(local, key, dst):
+    s = get_storage(BenchFileStorage)
+    s.upload(local, key)
+    s.download(key, dst)
+
+
+def run(fn, objects: int, threads: int, size: int, work_dir: str) -> float:
+    local = os.path.join(work_dir, 'image.png')
+    with open(local, 'wb') as f:
+        f.write(os.urandom(size))
+
+    def task(i):
+        fn(local, f'bench/{fn.__name__}/{i}.png', os.path.join(work_dir, f'{fn.__name__}-{i}.png'))
+
+    st = time.time()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(task, range(objects)))
+    return (time.time() - st) / objects
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--size', type=int, default=64 * 1024)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ObjectHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    BenchFileStorage.endpoint = f'http://127.0.0.1:{server.server_address[1]}'
+    work_dir = tempfile.mkdtemp(prefix='storage-bench')
+    try:
+        print(f"objects={args.objects}, threads={args.threads}, size={args.size}")
+        for fn in (per_object, shared):
+            cost = run(fn, args.objects, args.threads, args.size, work_dir)
+            print(f"{fn.__name__:>12}: {cost * 1e3:6.2f} ms/object (upload + download)")
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,31 +5,58 @@
 # @Site    : 
 # @File    : __init__.py.py
 # @Software: Hifive
+import atexit
 import os
+import threading
 import typing
 
 from loguru import logger
 from filestorage.storage import FileStorage, PrivatizationFileStorage
 from tools.reflection import find_classes
 from urllib.parse import urlparse
-from tools.environment import Env_EndponitKey
+from tools.environment import Env_EndponitKey, Env_BucketKey, get_file_storage_system_env
+
+
+_storage_classes = {}
+_storages = {}
+_storages_locker = threading.Lock()
 
 
 def find_storage_classes_with_env():
     endpoint = os.getenv(Env_EndponitKey)
+    if endpoint in _storage_classes:
+        return _storage_classes[endpoint]
     if not endpoint:
         logger.warning('[storage] > cannot found storage system config, use local file storage system!!!')
     storages = {}
     domain = get_domain_from_endpoint(endpoint)
     for cls in find_classes('filestorage'):
-        if issubclass(cls, FileStorage) and cls != FileStorage:
-            ins = cls()
-            if ins.name():
-                storages[ins.name()] = cls
-    if domain and domain in storages:
-        return storages[domain]
+        # 使用类属性判断后端，不再为每个存储类创建实例（认证对象、连接）
+        if issubclass(cls, FileStorage) and cls != FileStorage and cls.storage_name:
+            storages[cls.storage_name] = cls
+    cls = storages[domain] if domain and domain in storages else storages.get('default')
+    _storage_classes[endpoint] = cls
+    return cls
+
+
+def get_storage(storage_cls=None) -> FileStorage:
+    '''
+    进程内共享的存储客户端（按存储类及 BUCKET），复用认证对象、BUCKET 句柄和连接池，连接跨任务保持。
+    '''
+    storage_cls = storage_cls or find_storage_classes_with_env()
+    key = (storage_cls, get_file_storage_system_env().get(Env_BucketKey))
+    with _storages_locker:
+        storage = _storages.get(key)
+        if storage is None:
+            storage = _storages[key] = storage_cls()
+        return storage
 
-    return storages.get('default')
+
+def close_storages():
+    with _storages_locker:
+        for storage in _storages.values():
+            storage.close()
+        _storages.clear()
 
 
 def get_domain_from_endpoint(endpoint):
@@ -46,39 +73,29 @@ def get_local_path(remoting, local, storage_cls=None, progress_callback=None, wi
                    locker_exp=None, flocker=True):
     if os.path.isfile(local):
         return local
-    storage_cls = storage_cls or find_storage_classes_with_env()
-    with storage_cls() as s:
-        if not with_locker:
-            return s.download(remoting, local, progress_callback)
-        else:
-            return s.lock_download(remoting, local, progress_callback, locker_exp, flocker)
+    s = get_storage(storage_cls)
+    if not with_locker:
+        return s.download(remoting, local, progress_callback)
+    else:
+        return s.shared_download(remoting, local, progress_callback, locker_exp, flocker)
 
 
 def batch_download(remoting_loc_pairs: typing.Sequence[typing.Tuple[str, str]], storage_cls=None,
                    with_locker=False, locker_exp=None, flocker=True):
-    storage_cls = storage_cls or find_storage_classes_with_env()
-    with storage_cls() as s:
-        return s.multi_download(remoting_loc_pairs, with_locker, flocker=flocker, locker_exp=locker_exp)
+    return get_storage(storage_cls).multi_download(remoting_loc_pairs, with_locker, flocker=flocker, locker_exp=locker_exp)
 
 
 def push_local_path(remoting, local, storage_cls=None):
-    storage_cls = storage_cls or find_storage_classes_with_env()
-    with storage_cls() as s:
-        return s.upload(local, remoting)
+    return get_storage(storage_cls).upload(local, remoting)
 
 
 def signature_url(remoting, storage_cls=None):
-    storage_cls = storage_cls or find_storage_classes_with_env()
-    with storage_cls() as s:
-        return s.preview_url(remoting)
+    return get_storage(storage_cls).preview_url(remoting)
 
 
 def http_down(remoting, local):
-    f = PrivatizationFileStorage()
-    f.download(remoting, local)
+    get_storage(PrivatizationFileStorage).download(remoting, local)
 
 
 FileStorageCls = find_storage_classes_with_env()
-
-
-
+atexit.register(close_storages)
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/20 3:05 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : downloader.py
+# @Software: xingzhe.ai
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import typing
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from requests.adapters import HTTPAdapter
+from tools.environment import get_download_connections, download_verify_tls
+
+# 分片大小
+PartSize = 16 * 1024 * 1024
+# 单次读取/回调粒度
+ChunkSize = 1024 * 1024
+# 临时文件及续传记录后缀
+PartFileSuffix = '.part'
+JournalSuffix = '.part.json'
+_sha256_name = re.compile(r'^[0-9a-fA-F]{64}$')
+
+
+class RemoteFile(typing.NamedTuple):
+    size: int
+    ranges: bool
+    etag: str
+    filename: str
+
+
+class FileDigest(typing.NamedTuple):
+    sha256: str
+    # safetensors 的 addnet 哈希（跳过头部），其他文件为空
+    addnet: typing.Optional[str]
+
+
+def expected_sha256(path: str) -> typing.Optional[str]:
+    '''
+    文件名（不含扩展名）为 sha256 时返回该值，用于下载校验。
+    '''
+    name, _ = os.path.splitext(os.path.basename(path))
+    if _sha256_name.match(name):
+        return name.lower()
+
+
+def _pwrite(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+
+
+class FileHasher:
+    '''
+    按文件顺序增量计算 sha256，safetensors 同时计算 addnet 哈希（与 modules.hashes.addnet_hash_safetensors 一致）。
+    '''
+
+    def __init__(self, addnet: bool = False):
+        self.sha256 = hashlib.sha256()
+        self.addnet = hashlib.sha256() if addnet else None
+        self._header = b''
+        # addnet 哈希需跳过的字节数（8 字节长度 + 头部 JSON），读到长度前为 None
+        self._skip = None
+
+    def update(self, data: bytes):
+        self.sha256.update(data)
+        if self.addnet is None:
+            return
+        view = memoryview(data)
+        if self._skip is None:
+            need = 8 - len(self._header)
+            self._header += bytes(view[:need])
+            view = view[need:]
+            if len(self._header) < 8:
+                return
+            self._skip = int.from_bytes(self._header, 'little')
+        if self._skip:
+            n = min(self._skip, len(view))
+            self._skip -= n
+            view = view[n:]
+        if view:
+            self.addnet.update(view)
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+    def digest(self) -> FileDigest:
+        return FileDigest(self.sha256.hexdigest(), self.addnet.hexdigest() if self.addnet else None)
+
+
+class _Journal:
+    '''
+    续传记录：已完成的分片序号，文件大小或 ETAG 变化时失效。
+    '''
+
+    def __init__(self, path: str, remote: RemoteFile, part_size: int):
+        self.path = path
+        self.meta = {'size': remote.size, 'etag': remote.etag, 'part_size': part_size}
+        self.done = set()
+        self._locker = threading.Lock()
+
+    def load(self) -> bool:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if any(data.get(k) != v for k, v in self.meta.items()):
+                return False
+            self.done = set(data.get('done') or [])
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def mark(self, index: int):
+        with self._locker:
+            self.done.add(index)
+            data = dict(self.meta, done=sorted(self.done))
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class RangedDownloader:
+    '''
+    HTTP 分片并行下载：N 个连接池连接按 Range 下载到预分配文件（pwrite），
+    记录续传信息，按顺序增量计算 sha256 并在完成后校验大小和哈希。
+    '''
+
+    def __init__(self, connections: int = None, part_size: int = PartSize, timeout: int = 30, retries: int = 3,
+                 pool_size: int = None):
+        self.connections = connections or get_download_connections()
+        self.part_size = part_size
+        self.timeout = timeout
+        self.retries = retries
+        self.session = requests.Session()
+        # 多个文件同时下载时共享连接池
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(pool_size or 0, self.connections))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.verify = download_verify_tls()
+
+    def close(self):
+        self.session.close()
+
+    def probe(self, url: str) -> RemoteFile:
+        # 签名 URL 只允许 GET，使用 Range: bytes=0-0 获取文件大小
+        with self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=self.timeout) as resp:
+            resp.raise_for_status()
+            size, ranges = -1, False
+            content_range = resp.headers.get('Content-Range', '')
+            if resp.status_code == 206 and '/' in content_range and not content_range.endswith('*'):
+                size, ranges = int(content_range.rsplit('/', 1)[-1]), True
+            elif resp.headers.get('Content-Length'):
+                size = int(resp.headers['Content-Length'])
+            filename = ''
+            cd = resp.headers.get('Content-Disposition', '')
+            match = re.search(r'filename="?([^";]+)"?', cd)
+            if match:
+                filename = os.path.basename(match.group(1).strip())
+            return RemoteFile(size, ranges, resp.headers.get('ETag', ''), filename)
+
+    def download(self, url: str, local_path: str, progress_callback=None, sha256: str = None,
+                 remote: RemoteFile = None,
+                 hash_callback: typing.Callable[[str, FileDigest], None] = None) -> str:
+        '''
+        下载到 local_path，sha256 为空时使用文件名推断（非哈希文件名不校验）。
+        校验通过并安装后以边下载边计算的哈希调用 hash_callback(local_path, digest)。
+        '''
+        sha256 = sha256 or expected_sha256(local_path)
+        remote = remote or self.probe(url)
+        tmp_file = local_path + PartFileSuffix
+        addnet = local_path.lower().endswith('.safetensors')
+        st = time.time()
+        if remote.ranges and remote.size > self.part_size and self.connections > 1:
+            hasher = self._download_parts(url, tmp_file, remote, progress_callback, addnet)
+        else:
+            hasher = self._download_stream(url, tmp_file, progress_callback, addnet)
+
+        size = os.path.getsize(tmp_file)
+        if 0 <= remote.size != size:
+            self._discard(tmp_file)
+            raise OSError(f'download {local_path} size mismatch, expect {remote.size}, got {size}')
+        if sha256 and hasher.hexdigest() != sha256:
+            self._discard(tmp_file)
+            raise OSError(f'download {local_path} sha256 mismatch, expect {sha256}, got {hasher.hexdigest()}')
+        os.replace(tmp_file, local_path)
+        if callable(hash_callback):
+            hash_callback(local_path, hasher.digest())
+        cost = time.time() - st
+        logger.info(f"download {local_path} ({size} bytes) in {cost:.1f}s, "
+                    f"{size / max(cost, 1e-3) / 1024 / 1024:.1f}MB/s")
+        return local_path
+
+    def _discard(self, tmp_file: str):
+        for p in (tmp_file, tmp_file[:-len(PartFileSuffix)] + JournalSuffix):
+            if os.path.isfile(p):
+                os.remove(p)
+
+    def _download_stream(self, url: str, tmp_file: str, progress_callback=None, addnet: bool = False):
+        hasher = FileHasher(addnet)
+        for i in range(self.retries):
+            hasher, transferred = FileHasher(addnet), 0
+            try:
+                with self.session.get(url, stream=True, timeout=self.timeout) as resp:
+                    resp.raise_for_status()
+                    total = int(resp.headers.get('Content-Length') or 0)
+                    with open(tmp_file, 'wb') as f:
+                        for chunk in resp.iter_content(chunk_size=ChunkSize):
+                            if chunk:
+                                f.write(chunk)
+                                hasher.update(chunk)
+                                transferred += len(chunk)
+                                if callable(progress_callback) and total:
+                                    progress_callback(transferred, total)
+                return hasher
+            except (requests.RequestException, OSError):
+                if i >= self.retries - 1:
+                    raise
+                time.sleep(1)
+        return hasher
+
+    def _download_parts(self, url: str, tmp_file: str, remote: RemoteFile, progress_callback=None,
+                        addnet: bool = False):
+        total = remote.size
+        count = (total + self.part_size - 1) // self.part_size
+        journal = _Journal(tmp_file[:-len(PartFileSuffix)] + JournalSuffix, remote, self.part_size)
+        if not (os.path.isfile(tmp_file) and os.path.getsize(tmp_file) == total and journal.load()):
+            journal.remove()
+            with open(tmp_file, 'wb') as f:
+                # 预分配，避免并发写入产生碎片
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(f.fileno(), 0, total)
+                else:
+                    f.truncate(total)
+        elif journal.done:
+            logger.info(f"resume download {tmp_file}, {len(journal.done)}/{count} parts done")
+
+        locker = threading.Lock()
+        state = {'transferred': sum(self._part_range(i, total)[1] - self._part_range(i, total)[0] + 1
+                                    for i in journal.done), 'cursor': 0}
+        hasher = FileHasher(addnet)
+        hash_locker = threading.Lock()
+        fd = os.open(tmp_file, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+
+        def on_data(n: int):
+            with locker:
+                state['transferred'] += n
+                if callable(progress_callback):
+                    progress_callback(state['transferred'], total)
+
+        def advance_hash():
+            # 按顺序哈希已完成的连续分片（刚写入的数据在页缓存中）
+            with hash_locker:
+                while state['cursor'] < count and state['cursor'] in journal.done:
+                    start, end = self._part_range(state['cursor'], total)
+                    offset = start
+                    while offset <= end:
+                        data = os.pread(fd, min(ChunkSize, end - offset + 1), offset)
+                        if not data:
+                            raise OSError(f'unexpected EOF at {offset} of {tmp_file}')
+                        hasher.update(data)
+                        offset += len(data)
+                    state['cursor'] += 1
+
+        def fetch(index: int):
+            start, end = self._part_range(index, total)
+            for i in range(self.retries):
+                written = 0
+                try:
+                    headers = {'Range': f'bytes={start}-{end}'}
+                    with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as resp:
+                        if resp.status_code != 206:
+                            raise OSError(f'range request failed, status:{resp.status_code}')
+                        for chunk in resp.iter_content(chunk_size=ChunkSize):
+                            if not chunk:
+                                continue
+                            if written + len(chunk) > end - start + 1:
+                                raise OSError(f'range response too long, part:{index}')
+                            _pwrite(fd, chunk, start + written)
+                            written += len(chunk)
+                            on_data(len(chunk))
+                    if written != end - start + 1:
+                        raise OSError(f'range response too short, part:{index}')
+                    journal.mark(index)
+                    advance_hash()
+                    return
+                except (requests.RequestException, OSError):
+                    on_data(-written)
+                    if i >= self.retries - 1:
+                        raise
+                    time.sleep(1)
+
+        try:
+            advance_hash()
+            pending = [i for i in range(count) if i not in journal.done]
+            with ThreadPoolExecutor(max_workers=self.connections, thread_name_prefix='ranged-download') as pool:
+                for future in [pool.submit(fetch, i) for i in pending]:
+                    future.result()
+            advance_hash()
+        finally:
+            os.close(fd)
+        journal.remove()
+        return hasher
+
+    def _part_range(self, index: int, total: int) -> typing.Tuple[int, int]:
+        start = index * self.part_size
+        return start, min(start + self.part_size, total) - 1
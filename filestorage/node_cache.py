@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/21 5:40 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : node_cache.py
+# @Software: xingzhe.ai
+import json
+import os
+import shutil
+import socket
+import socketserver
+import threading
+import time
+import typing
+import uuid
+from loguru import logger
+from tools.locks import LOCK_EX, LOCK_NB, lock
+from tools.environment import get_node_model_cache_dir
+
+# 协调进程监听的 Unix socket 及选举用文件锁
+CoordinatorSocket = 'coordinator.sock'
+CoordinatorLock = 'coordinator.lock'
+# 已下载文件目录、下载中临时目录
+ObjectsDir = 'objects'
+DownloadingDir = 'downloading'
+# Linux FICLONE ioctl（reflink）
+_FICLONE = 0x40049409
+
+
+def _reflink(src: str, dst: str) -> bool:
+    try:
+        import fcntl
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+        return True
+    except (ImportError, OSError):
+        if os.path.isfile(dst):
+            os.remove(dst)
+        return False
+
+
+def link_file(src: str, dst: str):
+    '''
+    硬链接（跨文件系统时 reflink，都不支持时复制）src 到 dst，原子替换。
+    '''
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    tmp = f'{dst}.{uuid.uuid4().hex}.tmp'
+    try:
+        os.link(src, tmp)
+    except OSError:
+        if not _reflink(src, tmp):
+            shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _send(sock: socket.socket, msg: dict):
+    sock.sendall(json.dumps(msg).encode('utf8') + b'\n')
+
+
+class _Coordinator(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    节点内协调进程：同一文件只允许一个请求方下载，其他请求方等待完成通知；
+    下载方断开连接（进程退出）视为失败，由等待者中的一个接替下载。
+    '''
+    daemon_threads = True
+
+    def __init__(self, path: str, objects_dir: str):
+        self.objects_dir = objects_dir
+        self.cond = threading.Condition()
+        # key -> 下载方连接ID
+        self.active = {}
+        # key -> 同节点其他进程已有的本地文件
+        self.peers = {}
+        super(_Coordinator, self).__init__(path, _CoordinatorHandler)
+
+    def cached(self, key: str) -> str:
+        return os.path.join(self.objects_dir, key)
+
+    def acquire(self, key: str, conn_id: str, timeout: float) -> dict:
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                if os.path.isfile(self.cached(key)):
+                    return {'state': 'ready'}
+                if key not in self.active:
+                    self.active[key] = conn_id
+                    peers = [p for p in self.peers.get(key, []) if os.path.isfile(p)]
+                    return {'state': 'download', 'peer': peers[0] if peers else None}
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return {'state': 'timeout'}
+                self.cond.wait(remaining)
+
+    def finish(self, key: str, conn_id: str):
+        with self.cond:
+            if self.active.get(key) == conn_id:
+                del self.active[key]
+                self.cond.notify_all()
+
+    def publish(self, key: str, path: str):
+        with self.cond:
+            peers = self.peers.setdefault(key, [])
+            if path not in peers:
+                peers.append(path)
+                del peers[:-8]
+
+
+class _CoordinatorHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server: _Coordinator = self.server
+        conn_id, holding = uuid.uuid4().hex, set()
+        try:
+            for line in self.rfile:
+                msg = json.loads(line)
+                op, key = msg.get('op'), msg.get('key')
+                if op == 'acquire':
+                    resp = server.acquire(key, conn_id, float(msg.get('timeout') or 1800))
+                    if resp['state'] == 'download':
+                        holding.add(key)
+                    _send(self.connection, resp)
+                elif op == 'done':
+                    holding.discard(key)
+                    server.finish(key, conn_id)
+                    _send(self.connection, {'state': 'ok'})
+                elif op == 'publish':
+                    server.publish(key, msg['path'])
+                    _send(self.connection, {'state': 'ok'})
+                elif op == 'ping':
+                    _send(self.connection, {'state': 'ok', 'pid': os.getpid()})
+        except (OSError, ValueError):
+            pass
+        finally:
+            # 下载方异常断开，唤醒等待者接替
+            for key in holding:
+                server.finish(key, conn_id)
+
+
+class NodeModelCache:
+    '''
+    节点级模型缓存：同节点的 WORKER（进程或 POD，共享 NODE_MODEL_CACHE_DIR）每个文件只下载一次，
+    通过 Unix socket 上的协调进程（首个启动的 WORKER 内的线程）互斥下载，各自的模型目录硬链接到缓存文件。
+    '''
+
+    def __init__(self, root: str):
+        self.root = root
+        self.objects_dir = os.path.join(root, ObjectsDir)
+        self.downloading_dir = os.path.join(root, DownloadingDir)
+        self.socket_path = os.path.join(root, CoordinatorSocket)
+        self._server = None
+        self._lock_file = None
+        self._locker = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.downloading_dir, exist_ok=True)
+
+    def cached(self, key: str) -> str:
+        return os.path.join(self.objects_dir, key)
+
+    def _serve(self) -> bool:
+        # 文件锁保证只有一个进程成为协调进程，进程退出时锁自动释放
+        with self._locker:
+            if self._server:
+                return True
+            f = open(os.path.join(self.root, CoordinatorLock), 'wb')
+            if not lock(f, LOCK_EX | LOCK_NB):
+                f.close()
+                return False
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self._server = _Coordinator(self.socket_path, self.objects_dir)
+            self._lock_file = f
+            threading.Thread(target=self._server.serve_forever, name='node-cache-coordinator', daemon=True).start()
+            logger.info(f"[node cache] coordinator started at {self.socket_path}")
+            return True
+
+    def connect(self, timeout: float = 10) -> socket.socket:
+        deadline = time.time() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+                return sock
+            except OSError:
+                sock.close()
+                if not self._serve() and time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def _request(self, sock: socket.socket, reader, msg: dict) -> dict:
+        _send(sock, msg)
+        line = reader.readline()
+        if not line:
+            raise ConnectionError('node cache coordinator closed')
+        return json.loads(line)
+
+    def publish(self, key: str, path: str):
+        try:
+            with self.connect() as sock, sock.makefile('rb') as reader:
+                self._request(sock, reader, {'op': 'publish', 'key': key, 'path': os.path.abspath(path)})
+        except OSError:
+            logger.warning(f"[node cache] cannot publish {key}")
+
+    def fetch(self, key: str, local_path: str, download: typing.Callable[[str], str], timeout: float = 1800) -> str:
+        '''
+        获取文件到 local_path：节点缓存已有时直接链接；否则由协调进程指定一个请求方下载
+        （优先从同节点其他进程的文件复制，再调用 download 从对象存储下载），其他请求方等待。
+        '''
+        if os.path.isfile(local_path):
+            return local_path
+        cached = self.cached(key)
+        for _ in range(3):
+            if os.path.isfile(cached):
+                link_file(cached, local_path)
+                return local_path
+            with self.connect() as sock, sock.makefile('rb') as reader:
+                sock.settimeout(timeout + 10)
+                try:
+                    resp = self._request(sock, reader, {'op': 'acquire', 'key': key, 'timeout': timeout})
+                except ConnectionError:
+                    # 协调进程退出（所在 WORKER 重启），重新连接时选举新的协调进程
+                    logger.warning(f"[node cache] coordinator lost while waiting {key}, retry")
+                    continue
+                state = resp.get('state')
+                if state == 'timeout':
+                    raise OSError(f'wait node cache timeout:{key}')
+                if state == 'download':
+                    try:
+                        self._download(key, resp.get('peer'), download)
+                    finally:
+                        try:
+                            self._request(sock, reader, {'op': 'done', 'key': key})
+                        except OSError:
+                            pass
+            if os.path.isfile(cached):
+                link_file(cached, local_path)
+                self.publish(key, local_path)
+                return local_path
+        raise OSError(f'cannot fetch {key} to node cache')
+
+    def _download(self, key: str, peer: typing.Optional[str], download: typing.Callable[[str], str]):
+        tmp_dir = os.path.join(self.downloading_dir, key)
+        os.makedirs(tmp_dir, exist_ok=True)
+        # 临时文件保留原文件名（下载校验依赖文件名），固定路径便于断点续传
+        tmp = os.path.join(tmp_dir, key.split('[')[0])
+        if peer and os.path.isfile(peer):
+            logger.info(f"[node cache] copy {key} from peer {peer}")
+            link_file(peer, tmp)
+        else:
+            tmp = download(tmp)
+        if not tmp or not os.path.isfile(tmp):
+            raise OSError(f'cannot download {key}')
+        os.replace(tmp, self.cached(key))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def tidy(self, max_bytes: int):
+        '''
+        缓存超过 max_bytes 时，按修改时间删除没有被任何模型目录链接（nlink=1）的文件。
+        '''
+        files = []
+        for name in os.listdir(self.objects_dir):
+            path = os.path.join(self.objects_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, st.st_nlink, path))
+        total = sum(f[1] for f in files)
+        for _, size, nlink, path in sorted(files):
+            if total <= max_bytes:
+                break
+            if nlink > 1:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+                logger.info(f"[node cache] remove unused {path}")
+            except OSError:
+                continue
+
+
+_node_cache = None
+_node_cache_locker = threading.Lock()
+
+
+def get_node_cache() -> typing.Optional[NodeModelCache]:
+    '''
+    配置 NODE_MODEL_CACHE_DIR 时启用节点缓存。
+    '''
+    global _node_cache
+    root = get_node_model_cache_dir()
+    if not root:
+        return
+    with _node_cache_locker:
+        if _node_cache is None:
+            _node_cache = NodeModelCache(root)
+        return _node_cache
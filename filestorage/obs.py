@@ -6,16 +6,17 @@
 # @File    : obs.py
 # @Software: Hifive
 import os
-import shutil
 
 from obs import PutObjectHeader
 from obs import ObsClient
-from filestorage.storage import FileStorage
+from obs import CompleteMultipartUploadRequest, CompletePart
+from filestorage.storage import FileStorage, MultipartThreshold
 from tools.environment import get_file_storage_system_env, Env_EndponitKey, \
     Env_AccessKey, Env_SecretKey, Env_BucketKey
 
 
 class ObsFileStorage(FileStorage):
+    storage_name = 'myhuaweicloud'
 
     def __init__(self):
         super(ObsFileStorage, self).__init__()
@@ -30,38 +31,32 @@ class ObsFileStorage(FileStorage):
             self.obsClient = ObsClient(
                 access_key_id=access_key_id,
                 secret_access_key=secret_access_key,
-                server=endpoint
+                server=endpoint,
+                # 长连接，复用 TCP/TLS 连接
+                long_conn_mode=True,
             )
 
-    def name(self):
-        return 'myhuaweicloud'
+    def close(self):
+        super(ObsFileStorage, self).close()
+        # 释放长连接
+        if self.obsClient is not None:
+            self.obsClient.close()
+            self.obsClient = None
 
     def download(self, remoting_path, local_path, progress_callback=None) -> str:
-
-        def progress_callback_wrapper(transferred, total, time):
-            if callable(progress_callback):
-                progress_callback(transferred, total)
-
         if self.obsClient and remoting_path and local_path:
-            try:
-                if os.path.isfile(local_path):
-                    return local_path
-
-                # bucket, key = self.extract_buack_key_from_path(remoting_path)
-                key = self.get_keyname(remoting_path, self.bucket_name)
-                self.logger.info(f"download {key} from obs to {local_path}")
-                tmp_file = os.path.join(self.tmp_dir, os.path.basename(local_path))
-                resp = self.obsClient.downloadFile(
-                    self.bucket_name, key, tmp_file, 10 * 1024 * 1024, 4, True, progressCallback=progress_callback_wrapper)
-                if resp.status < 300 and os.path.isfile(tmp_file):
-                    shutil.move(tmp_file, local_path)
-                    return local_path
-                else:
-                    raise OSError(f'cannot download file from obs, resp:{resp.errorMessage}, key: {key}')
-            except Exception:
-                if os.path.isfile(local_path):
-                    os.remove(local_path)
-                raise
+            if os.path.isfile(local_path):
+                return local_path
+
+            # bucket, key = self.extract_buack_key_from_path(remoting_path)
+            key = self.get_keyname(remoting_path, self.bucket_name)
+            self.logger.info(f"download {key} from obs to {local_path}")
+            # 通过签名 URL 多连接分片下载
+            resp = self.obsClient.createSignedUrl('GET', self.bucket_name, key, expires=3600)
+            url = resp.get('signedUrl')
+            if not url:
+                raise OSError(f'cannot sign obs url, key: {key}')
+            return self.ranged_download(url, local_path, progress_callback)
         else:
             raise OSError('cannot init obs or file not found')
 
@@ -85,7 +80,11 @@ class ObsFileStorage(FileStorage):
     def upload_content(self, remoting_path, content) -> str:
         # bucket, key = self.extract_buack_key_from_path(remoting_path)
         headers = PutObjectHeader()
+        headers.contentType = self.mmie(remoting_path)
         key = self.get_keyname(remoting_path, self.bucket_name)
+        if isinstance(content, (bytes, bytearray)) and len(content) > MultipartThreshold:
+            # 分片上传
+            return self._multipart_upload_content(key, content, headers.contentType)
         resp = self.obsClient.putContent(self.bucket_name, key, content, headers=headers)
 
         if resp.status < 300:
@@ -93,6 +92,27 @@ class ObsFileStorage(FileStorage):
         else:
             raise OSError(f'cannot download file from obs, resp:{resp.errorMessage},key: {key}')
 
+    def _multipart_upload_content(self, key, content, content_type) -> str:
+        resp = self.obsClient.initiateMultipartUpload(self.bucket_name, key, contentType=content_type)
+        if resp.status >= 300:
+            raise OSError(f'cannot upload file to obs, resp:{resp.errorMessage},key: {key}')
+        upload_id = resp.body.uploadId
+        try:
+            parts = []
+            for i, data in self.content_parts(content):
+                resp = self.obsClient.uploadPart(self.bucket_name, key, i, upload_id, data)
+                if resp.status >= 300:
+                    raise OSError(f'cannot upload file to obs, resp:{resp.errorMessage},key: {key}')
+                parts.append(CompletePart(partNum=i, etag=resp.body.etag))
+            resp = self.obsClient.completeMultipartUpload(self.bucket_name, key, upload_id,
+                                                          CompleteMultipartUploadRequest(parts=parts))
+            if resp.status >= 300:
+                raise OSError(f'cannot upload file to obs, resp:{resp.errorMessage},key: {key}')
+            return key
+        except:
+            self.obsClient.abortMultipartUpload(self.bucket_name, key, upload_id)
+            raise
+
     def preview_url(self, remoting_path: str) -> str:
         key = self.get_keyname(remoting_path, self.bucket_name)
         resp = self.obsClient.createSignedUrl('GET', self.bucket_name, key, expires=3000)
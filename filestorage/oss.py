@@ -11,10 +11,10 @@ import time
 import uuid
 import oss2
 from tools.redis import RedisLocker
-from filestorage.storage import FileStorage
+from filestorage.storage import FileStorage, MultipartThreshold
 from tools.processor import MultiThreadWorker
 from tools.environment import get_file_storage_system_env, Env_EndponitKey, \
-    Env_AccessKey, Env_SecretKey, Env_BucketKey
+    Env_AccessKey, Env_SecretKey, Env_BucketKey, get_storage_pool_size
 
 
 def download(obj, bucket, local_path, tmp):
@@ -26,6 +26,7 @@ def download(obj, bucket, local_path, tmp):
 
 
 class OssFileStorage(FileStorage):
+    storage_name = 'aliyuncs'
 
     def __init__(self):
         super(OssFileStorage, self).__init__()
@@ -37,16 +38,26 @@ class OssFileStorage(FileStorage):
 
         self.bucket_name = bucket
         self.client = None
+        self._buckets = {}
         if 'aliyun' in endpoint:
             self.endpoint = endpoint
             self.auth = oss2.Auth(access_key_id, secret_access_key)
-            self.bucket = oss2.Bucket(self.auth, self.endpoint, bucket)
+            # 同一实例的所有 bucket 共享连接池（大小与上传、分片下载线程数匹配），只设置在本实例的 session 上
+            self.session = oss2.Session(pool_size=get_storage_pool_size())
+            self.bucket = self.get_bucket(bucket)
         else:
             self.auth = None
             self.bucket = None
 
-    def name(self):
-        return 'aliyuncs'
+    def get_bucket(self, bucket_name: str):
+        if bucket_name not in self._buckets:
+            self._buckets[bucket_name] = oss2.Bucket(self.auth, self.endpoint, bucket_name, session=self.session)
+        return self._buckets[bucket_name]
+
+    def _download_key(self, key, local_path, progress_callback=None) -> str:
+        # 通过签名 URL 多连接分片下载
+        url = self.bucket.sign_url('GET', key, 3600)
+        return self.ranged_download(url, local_path, progress_callback)
 
     def download(self, remoting_path, local_path, progress_callback=None) -> str:
         if self.auth and remoting_path and local_path:
@@ -58,24 +69,10 @@ class OssFileStorage(FileStorage):
             key = self.get_keyname(remoting_path, self.bucket_name)
             # bucket, key = self.extract_buack_key_from_path(remoting_path)
             self.logger.info(f"download {key} from oss to {local_path}")
-            tmp_file = os.path.join(self.tmp_dir, "tmp-" + os.path.basename(local_path))
-            # bucket = oss2.Bucket(self.auth, self.endpoint, bucket)
-            # f = self.acquire_flock(local_path)
-            # acquire file locker
-            if os.path.isfile(local_path):
-                return local_path
-
-            oss2.resumable_download(self.bucket, key, tmp_file, progress_callback=progress_callback)
-
             if os.path.isfile(local_path):
                 return local_path
 
-            if os.path.isfile(tmp_file):
-                shutil.move(tmp_file, local_path)
-                return local_path
-            else:
-
-                raise OSError(f'cannot download file from oss, {remoting_path}')
+            return self._download_key(key, local_path, progress_callback)
 
         else:
             raise OSError('cannot init oss or file not found')
@@ -102,14 +99,30 @@ class OssFileStorage(FileStorage):
         key = self.get_keyname(remoting_path, self.bucket_name)
         self.logger.info(f"upload file:{remoting_path}")
         # bucket = oss2.Bucket(self.auth, self.endpoint, bucket)
-        # 分片上传
         headers = oss2.CaseInsensitiveDict()
+        headers['Content-Type'] = self.mmie(remoting_path)
+        if isinstance(content, (bytes, bytearray)) and len(content) > MultipartThreshold:
+            # 分片上传
+            return self._multipart_upload_content(key, remoting_path, content, headers)
         resp = self.bucket.put_object(key, content, headers)
         if resp.status < 300:
             return remoting_path
         else:
             raise OSError(f'cannot download file from oss, resp:{resp.errorMessage}, key: {remoting_path}')
 
+    def _multipart_upload_content(self, key, remoting_path, content, headers) -> str:
+        upload_id = self.bucket.init_multipart_upload(key, headers=headers).upload_id
+        try:
+            parts = []
+            for i, data in self.content_parts(content):
+                resp = self.bucket.upload_part(key, upload_id, i, data)
+                parts.append(oss2.models.PartInfo(i, resp.etag))
+            self.bucket.complete_multipart_upload(key, upload_id, parts)
+            return remoting_path
+        except:
+            self.bucket.abort_multipart_upload(key, upload_id)
+            raise
+
     def preview_url(self, remoting_path: str) -> str:
         # bucket, key = self.extract_buack_key_from_path(remoting_path)
         # bucket = oss2.Bucket(self.auth, self.endpoint, bucket)
@@ -151,7 +164,6 @@ class OssFileStorage(FileStorage):
             return remoting_path
         locker_key = self.get_lock_key(remoting_path)
         key = self.get_keyname(remoting_path, self.bucket_name)
-        tmp_file = os.path.join(self.tmp_dir, "tmp-" + os.path.basename(local_path))
 
         if os.path.isfile(local_path):
             return local_path
@@ -160,16 +172,7 @@ class OssFileStorage(FileStorage):
                 if os.path.isfile(local_path):
                     return local_path
                 self.logger.info(f"download (with dist locker:{locker_key}) {key} from oss to {local_path}")
-                oss2.resumable_download(self.bucket, key, tmp_file, progress_callback=progress_callback)
-
-                if os.path.isfile(local_path):
-                    return local_path
-
-                if os.path.isfile(tmp_file):
-                    shutil.move(tmp_file, local_path)
-                    return local_path
-                else:
-                    raise OSError(f'cannot download file from oss, {remoting_path}')
+                return self._download_key(key, local_path, progress_callback)
         else:
             f = None
             try:
@@ -179,20 +182,12 @@ class OssFileStorage(FileStorage):
                 self.logger.info(f"download (with file locker) {key} from oss to {local_path}")
                 for i in range(3):
                     try:
-                        oss2.resumable_download(self.bucket, key, tmp_file, progress_callback=progress_callback)
-                        break
+                        # 失败时按续传记录继续下载未完成的分片
+                        return self._download_key(key, local_path, progress_callback)
                     except:
+                        if i >= 2:
+                            raise
                         time.sleep(1)
-                        continue
-
-                if os.path.isfile(local_path):
-                    return local_path
-
-                if os.path.isfile(tmp_file):
-                    shutil.move(tmp_file, local_path)
-                    return local_path
-                else:
-                    raise OSError(f'cannot download file from oss, {remoting_path}')
             except:
                 raise
             finally:
@@ -19,12 +19,17 @@ import random
 import importlib.util
 from loguru import logger
 from tools.redis import dist_locker
+from tools.model_cache import model_cache
 from tools.processor import MultiThreadWorker
 from multiprocessing import cpu_count
 from urllib.parse import urlparse, urlsplit
 from tools.locks import LOCK_EX, LOCK_NB, lock, unlock
+from tools.fswatch import FileWaiter
 from tools.host import get_host_name, get_host_ip
+from tools.environment import get_storage_pool_size
 from functools import partial
+from filestorage.downloader import RangedDownloader, RemoteFile, FileDigest
+from filestorage.node_cache import get_node_cache
 
 USER_AGENTS = [
     "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.1 (KHTML, like Gecko) Chrome/22.0.1207.1 Safari/537.1"
@@ -101,6 +106,11 @@ def http_request(url, method='GET', headers=None, cookies=None, data=None, timeo
     return res
 
 
+# 内存内容（如宫格大图）超过该大小时分片上传
+MultipartThreshold = 8 * 1024 * 1024
+MultipartPartSize = 4 * 1024 * 1024
+
+
 class FileLocker:
 
     def __init__(self, file, mode='r', buffering=None, encoding=None, errors=None, newline=None, closefd=True,
@@ -117,16 +127,36 @@ class FileLocker:
 
 
 class FileStorage:
+    # 存储后端名称，与 StorageEndponit 域名匹配
+    storage_name = None
 
     def __init__(self):
         self.tmp_dir = os.path.join('tmp')
         os.makedirs(self.tmp_dir, exist_ok=True)
         self.device_id = get_host_name() or get_host_ip()
+        self._downloader = None
 
     @property
     def logger(self):
         return logger
 
+    @property
+    def downloader(self) -> RangedDownloader:
+        if self._downloader is None:
+            self._downloader = RangedDownloader(pool_size=get_storage_pool_size())
+        return self._downloader
+
+    def ranged_download(self, url: str, local_path: str, progress_callback=None, remote: RemoteFile = None) -> str:
+        '''
+        多连接分片下载 URL（签名 URL）到本地，支持断点续传及大小、sha256 校验，记录下载时计算的哈希。
+        '''
+        return self.downloader.download(url, local_path, progress_callback, remote=remote,
+                                        hash_callback=self._record_hash)
+
+    def _record_hash(self, local_path: str, digest: FileDigest):
+        # 记录下载时计算的模型哈希，加载、检测模型时不再重新读取文件计算
+        model_cache.record_hash(local_path, digest.sha256, digest.addnet)
+
     @abc.abstractmethod
     def download(self, remoting_path, local_path, progress_callback=None) -> str:
         raise NotImplementedError
@@ -155,27 +185,49 @@ class FileStorage:
             finally:
                 self.release_flock(f, remoting_path)
 
-    @abc.abstractmethod
     def name(self):
-        raise NotImplementedError
+        return self.storage_name
 
     @abc.abstractmethod
     def upload(self, local_path, remoting_path) -> str:
         raise NotImplementedError
 
     def upload_content(self, remoting_path, content) -> str:
+        '''
+        上传内存中的内容（bytes），超过 MultipartThreshold 时分片上传。
+        '''
         raise NotImplementedError
 
+    def content_parts(self, content: bytes) -> typing.Iterator[typing.Tuple[int, bytes]]:
+        # 分片序号从 1 开始，每次只切出一个分片
+        for i, offset in enumerate(range(0, len(content), MultipartPartSize), 1):
+            yield i, content[offset:offset + MultipartPartSize]
+
     def preview_url(self, remoting_path: str) -> str:
         raise NotImplementedError
 
-    def get_lock_key(self, keyname):
+    def shared_download(self, remoting_path, local_path, progress_callback=None, expire=1800, flocker=True) -> str:
+        '''
+        启用节点缓存时同节点只下载一次（其他进程等待后硬链接），否则使用 lock_download。
+        '''
+        node_cache = get_node_cache()
+        if node_cache is None or os.path.isfile(remoting_path):
+            return self.lock_download(remoting_path, local_path, progress_callback, expire or 1800, flocker)
+        return node_cache.fetch(self.cache_key(remoting_path), local_path,
+                                lambda tmp: self.download(remoting_path, tmp, progress_callback),
+                                timeout=expire or 1800)
+
+    def cache_key(self, keyname):
         basename = os.path.basename(keyname)
         md5 = hashlib.md5()
         md5.update(keyname.encode())
         hash_str = md5.hexdigest()[:8]
+        # 文件名[远程路径HASH]
+        return f"{basename}[{hash_str}]"
+
+    def get_lock_key(self, keyname):
         # 设备（机器）ID:文件名[远程路径HASH]
-        return f"{self.device_id}:{basename}[{hash_str}]"
+        return f"{self.device_id}:{self.cache_key(keyname)}"
 
     def get_lock_filename(self, keyname):
         arr = os.path.splitext(os.path.basename(keyname))
@@ -196,31 +248,26 @@ class FileStorage:
             if not ok:
                 if not block:
                     raise OSError("cannot get file lock")
-                start = time.time()
-                while 1:
-                    time.sleep(random.randint(2, 5))
-                    waite_time = int(time.time() - start)
-                    if waite_time % 4 == 0:
-                        logger.debug(
-                            f"acquire file locker:{lock_path}, timeout:{timeout} sec, wait time:{waite_time} sec")
-                    if timeout > 0 and waite_time > timeout:
-                        raise OSError(f"cannot download {keyname}: get file lock timeout")
-
-                    if os.path.isfile(local_path):
-                        atime = os.path.getatime(local_path)
-                        delay = int(time.time() - atime + 6)
-                        if delay > 0:
-                            time.sleep(delay)
-                            logger.debug(f"acquire file locker:{lock_path}, local file existed, sleep {delay} sec")
-                        os.popen(f'touch {local_path}')
-                        logger.debug(f"acquire file locker:{lock_path}, local file existed!")
-                        break
-
-                    f = open(lock_path, "wb+") if f is None else f
-                    ok = lock(f, LOCK_EX | LOCK_NB)
-                    if ok:
-                        logger.debug(f"get file locker:{lock_path}, waite time:{waite_time} sec!")
-                        break
+                start, last_log = time.time(), 0
+                # 下载方完成后原子替换为目标文件，通过 inotify 立即唤醒；下载失败释放锁时最多延迟 1 秒
+                with FileWaiter(local_path) as waiter:
+                    while 1:
+                        if os.path.isfile(local_path):
+                            model_cache.touch(local_path)
+                            logger.debug(f"acquire file locker:{lock_path}, local file existed!")
+                            break
+
+                        waite_time = time.time() - start
+                        if lock(f, LOCK_EX | LOCK_NB):
+                            logger.debug(f"get file locker:{lock_path}, waite time:{waite_time:.1f} sec!")
+                            break
+                        if timeout > 0 and waite_time > timeout:
+                            raise OSError(f"cannot download {keyname}: get file lock timeout")
+                        if waite_time - last_log >= 4:
+                            last_log = waite_time
+                            logger.debug(
+                                f"acquire file locker:{lock_path}, timeout:{timeout} sec, wait time:{int(waite_time)} sec")
+                        waiter.wait(1 if timeout <= 0 else min(1, max(timeout - waite_time, 0.01)))
         except:
             if f:
                 f.close()
@@ -264,7 +311,7 @@ class FileStorage:
             worker_count = cpu_count()
             worker_count = worker_count if worker_count <= 4 else 4
             executor = self.download if not with_locker else partial(
-                self.lock_download, flocker=flocker, expire=locker_exp)
+                self.shared_download, flocker=flocker, expire=locker_exp)
             w = MultiThreadWorker(remoting_loc_pairs, executor, worker_count)
             w.run()
 
@@ -281,7 +328,9 @@ class FileStorage:
         return remoting_path
 
     def close(self):
-        pass
+        if self._downloader is not None:
+            self._downloader.close()
+            self._downloader = None
 
     def top_dir(self, p: str) -> str:
         array = p.strip(os.path.sep).split(os.path.sep)
@@ -312,9 +361,7 @@ class FileStorage:
 
 
 class PrivatizationFileStorage(FileStorage):
-
-    def name(self):
-        return 'default'
+    storage_name = 'default'
 
     def download(self, remoting_path: str, local_path: str, progress_callback=None) -> str:
         if os.path.isfile(local_path):
@@ -329,32 +376,16 @@ class PrivatizationFileStorage(FileStorage):
         if 'http' not in remoting_path.lower():
             raise OSError(f'unsupported file:{remoting_path}')
 
-        filename = os.path.basename(remoting_path)
-        filepath = os.path.join(self.tmp_dir, filename)
-        if not os.path.isfile(filepath):
-            self.logger.info(f"download url: {remoting_path}...")
-            resp = http_request(remoting_path)
-            if resp:
-
-                if 'Content-Disposition' in resp.headers:
-                    cd = resp.headers.get('Content-Disposition')
-                    map = dict(
-                        (item.strip().split('=')[:2] for item in (item for item in cd.split(';') if '=' in item)))
-                    if 'filename' in map:
-                        filename = map['filename'].strip('"')
-
-                chunk_size = 512
-
-                self.logger.info(f"save to {filename} ...")
-                with open(filepath, 'wb') as f:
-                    for chunk in resp.iter_content(chunk_size=chunk_size):
-                        if chunk:
-                            f.write(chunk)
-
-                if os.path.isdir(local_path):
-                    local_path = os.path.join(local_path, filename)
-        shutil.move(filepath, local_path)
-        return local_path
+        remote = None
+        if os.path.isdir(local_path):
+            remote = self.downloader.probe(remoting_path)
+            filename = remote.filename or os.path.basename(urlparse(remoting_path).path)
+            local_path = os.path.join(local_path, filename)
+            if os.path.isfile(local_path):
+                return local_path
+
+        self.logger.info(f"download url: {remoting_path} to {local_path}...")
+        return self.ranged_download(remoting_path, local_path, progress_callback, remote)
 
     def upload(self, local_path, remoting_path) -> str:
         # local file system
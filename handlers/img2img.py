@@ -24,16 +24,24 @@ from modules.img2img import process_batch
 from worker.task import TaskType, TaskProgress, Task, TaskStatus
 from modules.processing import StableDiffusionProcessingImg2Img, process_images, Processed, create_binary_mask
 from handlers.utils import init_script_args, get_selectable_script, init_default_script_args, format_override_settings, \
-    load_sd_model_weights, save_processed_images, get_tmp_local_path, get_model_local_path, batch_model_local_paths
+    load_sd_model_weights, save_processed_images, get_tmp_local_path, get_model_local_path, batch_model_local_paths, \
+    prefetch_sd_model_weights, release_sd_model_weights
 from handlers.extension.controlnet import exec_control_net_annotator
 from worker.dumper import dumper
 from tools.image import plt_show, encode_pil_to_base64
+from tools.model_cache import model_cache
+from handlers.preview import PreviewThrottle, make_latent_preview
 from modules import sd_models
 
 AlwaysonScriptsType = typing.Dict[str, typing.Mapping[str, typing.Any]]
 PixelDeviation = 2
 
 
+# 任务中的输入图片字段
+Img2ImgImageKeys = ('init_img', 'sketch', 'init_img_with_mask', 'inpaint_color_sketch',
+                    'inpaint_color_sketch_orig', 'init_img_inpaint', 'init_mask_inpaint')
+
+
 class Img2ImgMinorTaskType(IntEnum):
     Default = 0
     Img2Img = 1
@@ -316,7 +324,7 @@ class Img2ImgTask(StableDiffusionProcessingImg2Img):
             select_script_name = task.get('select_script_name')
             select_script_args = task.get('select_script_args')
 
-        kwargs = task.data.copy()
+        kwargs = task.resolved()
         kwargs.pop('base_model_path')
         kwargs.pop('prompt')
         kwargs.pop('negative_prompt')
@@ -414,6 +422,7 @@ class Img2ImgTaskHandler(TaskHandler):
     def __init__(self):
         super(Img2ImgTaskHandler, self).__init__(TaskType.Image2Image)
         self._default_script_args_load_t = 0
+        self.preview_throttle = PreviewThrottle()
 
     def _refresh_default_script_args(self):
         if time.time() - self._default_script_args_load_t > 3600 * 4:
@@ -478,10 +487,37 @@ class Img2ImgTaskHandler(TaskHandler):
         else:
             return base_model_path
 
+    def stage(self, task: Task):
+        '''
+        预取大模型、小模型和输入图片，并预读大模型权重到内存。
+        '''
+        base_model_path = get_model_local_path(task.sd_model_path, ModelType.CheckPoint)
+        if task.get('refiner_checkpoint'):
+            get_model_local_path(task['refiner_checkpoint'], ModelType.CheckPoint)
+        for mi in task.get('select_script_nets') or []:
+            model_info = ModelInfo(**mi)
+            get_model_local_path(model_info.key, model_info.type)
+        for model_type, key in ((ModelType.Lora, 'lora_models'),
+                                (ModelType.Embedding, 'embeddings'),
+                                (ModelType.LyCORIS, 'lycoris_models')):
+            if task.get(key):
+                batch_model_local_paths(model_type, *task[key])
+        for key in Img2ImgImageKeys:
+            value = task.get(key)
+            images = value.values() if isinstance(value, dict) else [value]
+            for image in images:
+                if image and isinstance(image, str):
+                    get_tmp_local_path(image)
+        if base_model_path:
+            prefetch_sd_model_weights(base_model_path, task.model_hash, owner=task.id)
+
+    def unstage(self, task: Task):
+        release_sd_model_weights(task.id)
+
     def _get_local_embedding_dirs(self, embeddings: typing.Sequence[str]) -> typing.Set[str]:
         # embeddings = [get_model_local_path(p, ModelType.Embedding) for p in embeddings]
         embeddings = batch_model_local_paths(ModelType.Embedding, *embeddings)
-        os.popen(f'touch {" ".join(embeddings)}')
+        model_cache.touch(*embeddings)
         return set((os.path.dirname(p) for p in embeddings if p and os.path.isfile(p)))
 
     def _get_select_script_models(self, progress: TaskProgress):
@@ -516,7 +552,7 @@ class Img2ImgTaskHandler(TaskHandler):
                     # 防止有重名导致问题~
                     shutil.copy(local, dst)
                 logger.debug(f'{local} copy to {dst}')
-                os.popen(f'touch {local} {dst}')
+                model_cache.touch(local, dst)
 
                 # 修改路径
                 task['select_script_nets'][i]['local'] = dst
@@ -526,14 +562,14 @@ class Img2ImgTaskHandler(TaskHandler):
     def _get_local_loras(self, loras: typing.Sequence[str]) -> typing.Sequence[str]:
         loras = batch_model_local_paths(ModelType.Lora, *loras)
         local_models = [p for p in loras if p and os.path.isfile(p)]
-        os.popen(f'touch {" ".join(local_models)}')
+        model_cache.touch(*local_models)
 
         return local_models
 
     def _get_local_lycoris(self, lycoris: typing.Sequence[str]) -> typing.Sequence[str]:
         local_models = batch_model_local_paths(ModelType.LyCORIS, *lycoris)
         local_models = [p for p in local_models if p and os.path.isfile(p)]
-        os.popen(f'touch {" ".join(local_models)}')
+        model_cache.touch(*local_models)
 
         return local_models
 
@@ -624,21 +660,23 @@ class Img2ImgTaskHandler(TaskHandler):
         shared.state.end()
         process_args.close()
         inference_time = time.time() - inference_start
-        progress.status = TaskStatus.Uploading
-        yield progress
-
-        images = save_processed_images(processed,
-                                       process_args.outpath_samples,
-                                       process_args.outpath_grids,
-                                       process_args.outpath_scripts,
-                                       task.id,
-                                       inspect=process_args.kwargs.get("need_audit", False),
-                                       detect_multi_face=process_args.kwargs.get("detect_multi_face", False),
-                                       forbidden_review=process_args.kwargs.get("forbidden_review", False))
-        images.update({'inference_time': inference_time})
-        progress = TaskProgress.new_finish(task, images)
-        progress.update_seed(processed.all_seeds, processed.all_subseeds)
 
+        def upload():
+            images = save_processed_images(processed,
+                                           process_args.outpath_samples,
+                                           process_args.outpath_grids,
+                                           process_args.outpath_scripts,
+                                           task.id,
+                                           inspect=process_args.kwargs.get("need_audit", False),
+                                           detect_multi_face=process_args.kwargs.get("detect_multi_face", False),
+                                           forbidden_review=process_args.kwargs.get("forbidden_review", False))
+            images.update({'inference_time': inference_time})
+            p = TaskProgress.new_finish(task, images)
+            p.update_seed(processed.all_seeds, processed.all_subseeds)
+            return p
+
+        # 图片保存、上传和审核在上传流水线执行
+        progress.set_async_upload(upload)
         yield progress
 
     def _set_task_status(self, p: TaskProgress):
@@ -680,15 +718,16 @@ class Img2ImgTaskHandler(TaskHandler):
         progress.eta_relative = int(eta - time_since_start)
         # print(f"-> progress: {progress.task_progress}, real:{p}\n")
 
-        shared.state.set_current_image()
-        if shared.state.current_image:
-            current = encode_pil_to_base64(shared.state.current_image, 30)
-            if current:
-                progress.preview = current
-            print("\n>>set preview!!\n")
-        else:
-            print('has prev')
-        self._set_task_status(progress)
+        # 预览图按时间间隔生成（TAESD 解码缩小后的 latent，编码为 WEBP），任务不需要时跳过
+        if progress.task.get('need_preview', True) and self.preview_throttle.ready(progress.task.id):
+            try:
+                current = make_latent_preview(shared.state.current_latent)
+                if current:
+                    progress.preview = current
+            except Exception:
+                logger.exception("cannot create preview")
+        shared.state.current_image_sampling_step = shared.state.sampling_step
+        self._report_progress(progress)
 
     def _exec_interrogate(self, task: Task):
         model = task.get('interrogate_model')
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/18 10:26 AM
+# @Author  : wangdongming
+# @Site    :
+# @File    : preview.py
+# @Software: xingzhe.ai
+import base64
+import time
+import typing
+import numpy as np
+import torch
+import torch.nn.functional as F
+from io import BytesIO
+from PIL import Image
+from loguru import logger
+from modules import sd_samplers_common
+from tools.environment import get_preview_interval
+
+# 预览图最长边（像素）
+PreviewMaxSide = 256
+PreviewQuality = 50
+# 解码方式：TAESD 失败时（模型不存在等）退化为 Approx cheap
+PreviewApproxTAESD = sd_samplers_common.approximation_indexes["TAESD"]
+PreviewApproxCheap = sd_samplers_common.approximation_indexes["Approx cheap"]
+
+
+class PreviewThrottle:
+    '''
+    按时间间隔限制每个任务的预览图生成频率。
+    '''
+
+    def __init__(self, interval: float = None):
+        self.interval = get_preview_interval() if interval is None else interval
+        self._last = {}
+
+    def ready(self, key: str) -> bool:
+        if self.interval <= 0:
+            return False
+        now = time.time()
+        if now - self._last.get(key, 0) < self.interval:
+            return False
+        if len(self._last) > 100:
+            self._last.clear()
+        self._last[key] = now
+        return True
+
+
+def _downscale_latent(latent: torch.Tensor, max_side: int) -> torch.Tensor:
+    h, w = latent.shape[-2:]
+    scale = max_side / max(h, w)
+    if scale >= 1:
+        return latent
+    size = (max(int(h * scale), 1), max(int(w * scale), 1))
+    return F.interpolate(latent, size=size, mode='bilinear', align_corners=False)
+
+
+def decode_latent_preview(latent: torch.Tensor, max_side: int = PreviewMaxSide) -> typing.Optional[Image.Image]:
+    '''
+    使用 TAESD 解码缩小后的 latent（首张图片），输出最长边不超过 max_side 的预览图。
+    '''
+    if latent is None:
+        return
+    sample = latent[:1].float()
+    x = None
+    try:
+        # TAESD 输出为 latent 的 8 倍大小
+        x = sd_samplers_common.samples_to_images_tensor(
+            _downscale_latent(sample, max_side // 8), PreviewApproxTAESD)
+    except Exception as err:
+        logger.debug(f"taesd preview failed:{err}")
+    if x is None:
+        # Approx cheap 输出与 latent 同大小
+        x = sd_samplers_common.samples_to_images_tensor(_downscale_latent(sample, max_side), PreviewApproxCheap)
+    x = torch.clamp(x[0].float() * 0.5 + 0.5, min=0.0, max=1.0)
+    x = (255. * np.moveaxis(x.cpu().numpy(), 0, 2)).astype(np.uint8)
+    return Image.fromarray(x)
+
+
+def encode_preview(image: Image.Image, quality: int = PreviewQuality) -> str:
+    '''
+    预览图编码为 WEBP（不支持时使用 JPEG）的 data URI。
+    '''
+    image = image.convert('RGB')
+    with BytesIO() as output:
+        try:
+            image.save(output, format='WEBP', quality=quality, method=0)
+            mime = 'webp'
+        except Exception:
+            output.seek(0)
+            output.truncate()
+            image.save(output, format='JPEG', quality=quality)
+            mime = 'jpeg'
+        return f'data:image/{mime};base64,' + base64.b64encode(output.getvalue()).decode('ascii')
+
+
+def make_latent_preview(latent: torch.Tensor, max_side: int = PreviewMaxSide,
+                        quality: int = PreviewQuality) -> typing.Optional[str]:
+    with torch.no_grad():
+        image = decode_latent_preview(latent, max_side)
+    if image:
+        return encode_preview(image, quality)
@@ -11,10 +11,12 @@ import typing
 import modules.scripts
 import modules.shared as shared
 from enum import IntEnum
+from loguru import logger
 from handlers.typex import ModelType
 from modules.generation_parameters_copypaste import create_override_settings_dict
 from worker.task import TaskType, TaskProgress, Task, TaskStatus
-from modules.processing import StableDiffusionProcessingTxt2Img, process_images, Processed
+from worker.batching import BatchSpec, task_images
+from modules.processing import StableDiffusionProcessingTxt2Img, process_images, Processed, get_fixed_seed
 from handlers.utils import init_script_args, get_selectable_script, init_default_script_args, \
     load_sd_model_weights, save_processed_images, format_override_settings
 from handlers.extension.controlnet import exec_control_net_annotator
@@ -27,6 +29,34 @@ class Txt2ImgMinorTaskType(IntEnum):
     RunControlnetAnnotator = 100
 
 
+# 可合批任务需要完全相同的字段，prompt、negative_prompt、seed、subseed、batch_size 可以不同
+Txt2ImgBatchFields = (
+    'task_type', 'minor_type', 'model_hash', 'base_model_path', 'width', 'height', 'sampler_name', 'steps',
+    'cfg_scale', 'restore_faces', 'tiling', 'enable_hr', 'n_iter', 'subseed_strength', 'seed_resize_from_h',
+    'seed_resize_from_w', 'seed_enable_extras', 'select_script', 'select_script_name', 'select_script_args',
+    'alwayson_scripts', 'override_settings_texts', 'lora_models', 'embeddings', 'lycoris_models',
+    'disable_ad_face', 'is_fast', 'enable_refiner', 'refiner_checkpoint', 'need_audit', 'detect_multi_face',
+    'forbidden_review', 'compress_pnginfo',
+)
+# 单次合批的最大像素数（8张512*512）
+Txt2ImgBatchMaxPixels = 8 * 512 * 512
+
+
+class BatchItemProcessed:
+    '''
+    合批结果中属于单个任务的部分，供 save_processed_images 使用。
+    '''
+
+    def __init__(self, images: typing.List, infotexts: typing.List[str],
+                 all_seeds: typing.List[int], all_subseeds: typing.List[int]):
+        self.images = images
+        self.infotexts = infotexts
+        self.all_seeds = all_seeds
+        self.all_subseeds = all_subseeds
+        self.index_of_first_image = 0
+        self.index_of_end_image = len(images) - 1
+
+
 class Txt2ImgTask(StableDiffusionProcessingTxt2Img):
 
     def __init__(self, base_model_path: str,
@@ -114,9 +144,7 @@ class Txt2ImgTask(StableDiffusionProcessingTxt2Img):
         self.hr_resize_x = hr_resize_x
         self.hr_resize_y = hr_resize_y
         self.override_settings = override_settings
-        self.outpath_samples = f"output/{user_id}/txt2img/samples/"
-        self.outpath_grids = f"output/{user_id}/txt2img/grids/"
-        self.outpath_scripts = f"output/{user_id}/img2img/scripts/"
+        self.outpath_samples, self.outpath_grids, self.outpath_scripts = self.outpaths(user_id)
         self.hr_sampler_name = hr_sampler_name
         self.hr_prompt = hr_prompt or ""
         self.hr_negative_prompt = hr_negative_prompt or ""
@@ -146,6 +174,20 @@ class Txt2ImgTask(StableDiffusionProcessingTxt2Img):
                     if hasattr(v, 'close'):
                         v.close()
 
+    @staticmethod
+    def format_prompt(prompt: str) -> str:
+        if "nsfw" in prompt.lower():
+            prompt = prompt.lower().replace('nsfw', '')
+        return prompt
+
+    @staticmethod
+    def outpaths(user_id: str) -> typing.Tuple[str, str, str]:
+        '''
+        用户的输出目录：samples, grids, scripts。
+        '''
+        return f"output/{user_id}/txt2img/samples/", f"output/{user_id}/txt2img/grids/", \
+            f"output/{user_id}/img2img/scripts/"
+
     @classmethod
     def from_task(cls, task: Task, default_script_args: typing.Sequence, refiner_checkpoint: str = None):
         base_model_path = task['base_model_path']
@@ -164,7 +206,7 @@ class Txt2ImgTask(StableDiffusionProcessingTxt2Img):
         else:
             select_script_name = task.get('select_script_name')
             select_script_args = task.get('select_script_args')
-        kwargs = task.data.copy()
+        kwargs = task.resolved()
         kwargs.pop('base_model_path')
         kwargs.pop('alwayson_scripts')
         kwargs.pop('prompt')
@@ -177,8 +219,7 @@ class Txt2ImgTask(StableDiffusionProcessingTxt2Img):
         if 'select_script_args' in kwargs:
             kwargs.pop('select_script_args')
 
-        if "nsfw" in prompt.lower():
-            prompt = prompt.lower().replace('nsfw', '')
+        prompt = cls.format_prompt(prompt)
         kwargs['refiner_checkpoint'] = refiner_checkpoint
 
         return cls(base_model_path,
@@ -277,23 +318,144 @@ class Txt2ImgTaskHandler(Img2ImgTaskHandler):
         shared.state.end()
         process_args.close()
         inference_time = time.time() - inference_start
-        progress.status = TaskStatus.Uploading
-        yield progress
 
-        images = save_processed_images(processed,
-                                       process_args.outpath_samples,
-                                       process_args.outpath_grids,
-                                       process_args.outpath_scripts,
-                                       task.id,
-                                       inspect=process_args.kwargs.get("need_audit", False),
-                                       detect_multi_face=process_args.kwargs.get("detect_multi_face", False),
-                                       forbidden_review=process_args.kwargs.get("forbidden_review", False))
-        images.update({'inference_time': inference_time})
-        progress = TaskProgress.new_finish(task, images)
-        progress.update_seed(processed.all_seeds, processed.all_subseeds)
+        def upload():
+            images = save_processed_images(processed,
+                                           process_args.outpath_samples,
+                                           process_args.outpath_grids,
+                                           process_args.outpath_scripts,
+                                           task.id,
+                                           inspect=process_args.kwargs.get("need_audit", False),
+                                           detect_multi_face=process_args.kwargs.get("detect_multi_face", False),
+                                           forbidden_review=process_args.kwargs.get("forbidden_review", False))
+            images.update({'inference_time': inference_time})
+            p = TaskProgress.new_finish(task, images)
+            p.update_seed(processed.all_seeds, processed.all_subseeds)
+            return p
 
+        # 图片保存、上传和审核在上传流水线执行
+        progress.set_async_upload(upload)
         yield progress
 
+    def batch_spec(self, task: Task) -> typing.Optional[BatchSpec]:
+        '''
+        无脚本、无高清修复、无精描的普通文生图任务可以合批。
+        '''
+        if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
+            return
+        if task.minor_type > Txt2ImgMinorTaskType.Txt2Img:
+            return
+        if task.get('enable_hr') or task.get('enable_refiner') or task.get('refiner_checkpoint'):
+            return
+        if task.get('select_script') or task.get('select_script_name') or task.get('alwayson_scripts'):
+            return
+        if int(task.get('n_iter') or 1) > 1:
+            return
+        # ADetailer 按图片处理，不参与合批
+        if not task.get('disable_ad_face', True) and not task.get('is_fast', True):
+            return
+        pixels = int(task.get('width') or 512) * int(task.get('height') or 512)
+        max_images = Txt2ImgBatchMaxPixels // max(pixels, 1)
+        if max_images <= task_images(task):
+            return
+        return BatchSpec(Txt2ImgBatchFields, max_images)
+
+    def _update_batch_progress(self, progresses: typing.Sequence[TaskProgress]):
+        # 合批时图片来自不同用户，只更新进度不生成预览图
+        if shared.state.sampling_step - shared.state.current_image_sampling_step < 5 \
+                or shared.state.sampling_steps <= 0:
+            return
+        shared.state.current_image_sampling_step = shared.state.sampling_step
+        p = shared.state.sampling_step / shared.state.sampling_steps
+        time_since_start = time.time() - shared.state.time_start
+        for progress in progresses:
+            progress.task_progress = min(p * 100, 99)
+            progress.eta_relative = int(time_since_start / p - time_since_start) if p > 0 else 60
+            # 经过进度回调，采样期间租约丢失时中断执行
+            self._report_progress(progress)
+
+    def _exec_txt2img_batch(self, tasks: typing.Sequence[Task]) -> typing.Iterable[TaskProgress]:
+        leader = tasks[0]
+        base_model_path = self._get_local_checkpoint(leader)
+        if isinstance(base_model_path, tuple):
+            base_model_path = base_model_path[0]
+        load_sd_model_weights(base_model_path, leader.model_hash)
+        progresses = [TaskProgress.new_ready(t, f'model loaded, run t2i...') for t in tasks]
+        yield from progresses
+
+        process_args = self._build_txt2img_arg(progresses[0])
+        shared.state.current_latent_changed_callback = lambda: self._update_batch_progress(progresses)
+        self._set_little_models(process_args)
+
+        prompts, negative_prompts, seeds, subseeds, sizes = [], [], [], [], []
+        for t in tasks:
+            n = task_images(t)
+            seed = get_fixed_seed(t.get('seed', -1))
+            subseed = get_fixed_seed(t.get('subseed', -1))
+            prompts.extend([Txt2ImgTask.format_prompt(t.get('prompt', ''))] * n)
+            negative_prompts.extend([t.get('negative_prompt', '')] * n)
+            seeds.extend(seed + (k if process_args.subseed_strength == 0 else 0) for k in range(n))
+            subseeds.extend(subseed + k for k in range(n))
+            sizes.append(n)
+        process_args.prompt = prompts
+        process_args.negative_prompt = negative_prompts
+        process_args.seed = seeds
+        process_args.subseed = subseeds
+        process_args.batch_size = len(prompts)
+        process_args.n_iter = 1
+        process_args.do_not_save_grid = True
+
+        for progress in progresses:
+            progress.status = TaskStatus.Running
+            progress.task_desc = f't2i task({progress.task.id}) running, batch size:{len(tasks)}'
+            yield progress
+        shared.state.begin()
+        inference_start = time.time()
+        try:
+            processed = process_images(process_args)
+        finally:
+            shared.state.end()
+            process_args.close()
+        inference_time = time.time() - inference_start
+
+        if processed.index_of_first_image != 0 or len(processed.images) != len(prompts):
+            # 脚本改变了输出图片数量，无法按任务拆分：进度重置后逐个重新执行
+            logger.warning(f"batch output mismatch, images:{len(processed.images)}, expect:{len(prompts)}")
+            for progress in progresses:
+                progress.status = TaskStatus.Ready
+                progress.task_progress = 0
+                progress.eta_relative = 0
+                progress.task_desc = f't2i task({progress.task.id}) batch output mismatch, waiting to rerun'
+                yield progress
+            for t in tasks:
+                yield from self._exec_txt2img(t)
+            return
+
+        def upload(t: Task, item: BatchItemProcessed) -> TaskProgress:
+            images = save_processed_images(item,
+                                           *Txt2ImgTask.outpaths(t['user_id']),
+                                           t.id,
+                                           inspect=t.get("need_audit", False),
+                                           detect_multi_face=t.get("detect_multi_face", False),
+                                           forbidden_review=t.get("forbidden_review", False))
+            images.update({'inference_time': inference_time, 'batch_size': len(tasks)})
+            p = TaskProgress.new_finish(t, images)
+            p.update_seed(item.all_seeds, item.all_subseeds)
+            return p
+
+        offset = 0
+        for progress, n in zip(progresses, sizes):
+            item = BatchItemProcessed(processed.images[offset: offset + n],
+                                      processed.infotexts[offset: offset + n],
+                                      processed.all_seeds[offset: offset + n],
+                                      processed.all_subseeds[offset: offset + n])
+            offset += n
+            progress.set_async_upload(lambda t=progress.task, item=item: upload(t, item))
+            yield progress
+
+    def _exec_batch(self, tasks: typing.Sequence[Task]) -> typing.Iterable[TaskProgress]:
+        yield from self._exec_txt2img_batch(tasks)
+
     def _exec(self, task: Task) -> typing.Iterable[TaskProgress]:
         minor_type = Txt2ImgMinorTaskType(task.minor_type)
         if minor_type <= Txt2ImgMinorTaskType.Txt2Img:
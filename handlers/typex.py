@@ -6,7 +6,7 @@
 # @File    : typex.py
 # @Software: Hifive
 import os.path
-import shutil
+import itertools
 import typing
 from enum import IntEnum
 from collections import UserDict, defaultdict
@@ -14,9 +14,10 @@ from collections import UserDict, defaultdict
 import requests
 
 from loguru import logger
-from tools.image import compress_image
+from PIL import Image
+from tools.image import compress_image, compress_image_content
 from PIL.PngImagePlugin import PngInfo
-from filestorage import find_storage_classes_with_env, signature_url
+from filestorage import get_storage, signature_url
 from tools.environment import S3SDWEB, S3ImageBucket, Env_DtAppKey
 from tools.processor import MultiThreadWorker
 
@@ -104,16 +105,32 @@ class ImageKeys(UserDict):
         return dict(self)
 
 
-def get_upload_image_key(file_storage_system, file: str, key: str, key_outs: typing.List[str]):
-    r = file_storage_system.upload(file, key)
+def get_upload_image_key(file_storage_system, file: typing.Union[str, bytes], key: str, key_outs: typing.List[str]):
+    # file 为字节时直接从内存上传
+    if isinstance(file, (bytes, bytearray)):
+        r = file_storage_system.upload_content(key, file)
+    else:
+        r = file_storage_system.upload(file, key)
     if r:
         key_outs.append(r)
 
 
+class ImageContent(typing.NamedTuple):
+    # 输出路径（输出目录 + 文件名），用于生成 KEY，不写入磁盘
+    path: str
+    data: bytes
+    image: typing.Optional[Image.Image]
+
+
+def compress_image_to(content: ImageContent, low_path: str, outs: typing.Dict[str, ImageContent]):
+    outs[low_path] = ImageContent(low_path, compress_image_content(content.data, image=content.image), None)
+
+
 class ImageOutput:
 
     def __init__(self, image_type: OutImageType, local_output_dir: str):
         self.local_files = []
+        self.contents = []
         self.image_type = image_type
         self.output_dir = local_output_dir
         os.makedirs(local_output_dir, exist_ok=True)
@@ -140,15 +157,55 @@ class ImageOutput:
 
         return local_low_images
 
+    def get_low_contents(self) -> typing.List[ImageContent]:
+        low_contents, args = {}, []
+        for content in self.contents:
+            filename = os.path.basename(content.path)
+            # 不转GIF
+            if os.path.splitext(filename)[-1].lower() == ".gif":
+                continue
+            args.append((content, os.path.join(self.output_dir, 'low-' + filename), low_contents))
+        if args:
+            worker = MultiThreadWorker(args, compress_image_to, 4)
+            worker.run()
+        return [low_contents[low_path] for _, low_path, _ in args if low_path in low_contents]
+
+    def add_image_content(self, path: str, data: bytes, image: Image.Image = None):
+        '''
+        添加内存中已编码的图片（path 为输出路径，不写入磁盘），上传时直接从内存上传。
+        '''
+        self.contents.append(ImageContent(path, data, image))
+
+    def write_contents(self):
+        # 本地存储（或不支持内存上传时）将内存中的图片写入输出路径
+        for content in self.contents:
+            with open(content.path, 'wb') as f:
+                f.write(content.data)
+            self.local_files.append(content.path)
+        self.contents = []
+
+    def remote_key(self, path: str) -> str:
+        if S3SDWEB not in path:
+            return os.path.join(S3SDWEB, path)
+        return path
+
     def add_image(self, image: str):
         if os.path.isfile(image):
             self.local_files.append(image)
         else:
             raise OSError(f'cannot found image:{image}')
 
+    def remove_local_files(self, low_files: typing.Sequence[str]):
+        # 只删除本次上传的文件，同一目录下可能有其他任务正在后台上传
+        for f in itertools.chain(self.local_files, low_files):
+            try:
+                os.remove(f)
+            except:
+                pass
+
     def upload_keys(self, clean_upload_file: bool = True):
-        file_storage_system_cls = find_storage_classes_with_env()
-        file_storage_system = file_storage_system_cls()
+        file_storage_system = get_storage()
+        self.write_contents()
 
         low_files = self.get_local_low_images()
         # push s3
@@ -172,10 +229,7 @@ class ImageOutput:
                 keys.append(key)
 
             if clean_upload_file:
-                try:
-                    shutil.rmtree(self.output_dir)
-                except:
-                    pass
+                self.remove_local_files(low_files)
 
             return ImageKeys(keys, low_keys)
 
@@ -183,36 +237,34 @@ class ImageOutput:
         return ImageKeys(self.local_files, low_files)
 
     def multi_upload_keys(self, clean_upload_file: bool = True):
-        file_storage_system_cls = find_storage_classes_with_env()
-        file_storage_system = file_storage_system_cls()
+        file_storage_system = get_storage()
+        if file_storage_system.name() == 'default':
+            self.write_contents()
         low_files = self.get_local_low_images()
+        low_contents = self.get_low_contents()
 
         if file_storage_system.name() != 'default':
             low_keys, high_keys, worker_args = [], [], []
             for low_file in low_files:
-                relative_path = low_file
-                if S3SDWEB not in low_file:
-                    relative_path = os.path.join(S3SDWEB, low_file)
-                low_key = relative_path
-                worker_args.append((file_storage_system, low_file, low_key, low_keys))
+                worker_args.append((file_storage_system, low_file, self.remote_key(low_file), low_keys))
+            for low in low_contents:
+                worker_args.append((file_storage_system, low.data, self.remote_key(low.path), low_keys))
 
-            relative_path = self.output_dir
-            if S3SDWEB not in self.output_dir:
-                relative_path = os.path.join(S3SDWEB, self.output_dir)
+            relative_path = self.remote_key(self.output_dir)
             for file_path in self.local_files:
                 filename = os.path.basename(file_path)
                 key = os.path.join(relative_path, filename)
                 # file_storage_system.upload(file_path, key)
                 worker_args.append((file_storage_system, file_path, key, high_keys))
+            for content in self.contents:
+                key = os.path.join(relative_path, os.path.basename(content.path))
+                worker_args.append((file_storage_system, content.data, key, high_keys))
             if worker_args:
                 worker = MultiThreadWorker(worker_args, get_upload_image_key, 4)
                 worker.run()
 
                 if clean_upload_file:
-                    try:
-                        shutil.rmtree(self.output_dir)
-                    except:
-                        pass
+                    self.remove_local_files(low_files)
 
                 return ImageKeys(high_keys, low_keys)
 
@@ -11,38 +11,44 @@ import time
 import typing
 import uuid
 import hashlib
-import cv2
-import dlib
+import threading
+import psutil
 from PIL import Image
 from loguru import logger
 from datetime import datetime
 from tools import TempDir as Tmp
 from PIL.PngImagePlugin import PngInfo
 from tools.wrapper import FuncExecTimeWrapper
+from tools.model_cache import model_cache
+from tools.face import face_detector
 from modules.shared import cmd_opts
 from modules.processing import Processed
 from modules.scripts import Script, ScriptRunner
-from tools.environment import S3Tmp, S3SDWEB, enable_download_locker
-from filestorage import FileStorageCls, get_local_path, batch_download
+from tools.environment import S3Tmp, S3SDWEB, enable_download_locker, output_to_disk
+from filestorage import get_storage, get_local_path, batch_download
 from handlers.formatter import format_alwayson_script_args, format_select_script_args
 from handlers.typex import ModelLocation, ModelType, ImageOutput, OutImageType, UserModelLocation
-from modules.sd_models import reload_model_weights, CheckpointInfo, get_closet_checkpoint_match, list_models
+from modules.sd_models import reload_model_weights, CheckpointInfo, get_closet_checkpoint_match, list_models, \
+    prefetch_checkpoint_state_dict, release_prefetched_checkpoint, model_data
 
 StrMapMap = typing.Dict[str, typing.Mapping[str, typing.Any]]
+# 当前加载的大模型在模型缓存中的持有者
+LoadedModelOwner = 'loaded-checkpoint'
 
+# 同一文件的下载互斥（预取线程与执行线程可能同时下载同一个文件）
+_download_lockers = {}
+_download_lockers_guard = threading.Lock()
 
-def detect_faces(image_path) -> int:
-    # 加载图像
-    image = cv2.imread(image_path)
 
-    # 将图像转换为灰度图
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+def _download_locker(dst: str) -> threading.Lock:
+    with _download_lockers_guard:
+        if dst not in _download_lockers:
+            _download_lockers[dst] = threading.Lock()
+        return _download_lockers[dst]
+
 
-    # 使用人脸检测器检测人脸
-    detector = dlib.get_frontal_face_detector()
-    faces = detector(gray, 1)
-    logger.debug(f"image face detector:{len(faces)},{os.path.basename(image_path)}")
-    return len(faces)
+def detect_faces(image_path) -> int:
+    return face_detector.count(image_path)
 
 
 def get_model_local_path(remoting_path: str, model_type: ModelType, progress_callback=None):
@@ -52,6 +58,8 @@ def get_model_local_path(remoting_path: str, model_type: ModelType, progress_cal
         return remoting_path
 
     def ckpt_register(model_path: str):
+        # 记录访问（在任务中时同时 pin）
+        model_cache.touch(model_path)
         if model_type == ModelType.CheckPoint and os.path.isfile(model_path):
             checkpoint = CheckpointInfo(model_path)
             checkpoint.register()
@@ -69,8 +77,9 @@ def get_model_local_path(remoting_path: str, model_type: ModelType, progress_cal
         ckpt_register(dst)
         return dst
     with_locker = enable_download_locker()
-    dst = get_local_path(
-        remoting_path, dst, progress_callback=progress_callback, locker_exp=1800, with_locker=with_locker)
+    with _download_locker(dst):
+        dst = get_local_path(
+            remoting_path, dst, progress_callback=progress_callback, locker_exp=1800, with_locker=with_locker)
     if os.path.isfile(dst):
         ckpt_register(dst)
         return dst
@@ -92,6 +101,7 @@ def batch_model_local_paths(model_type: ModelType, *remoting_paths: str) \
         if not os.path.isfile(dst):
             remoting_key_dst_pairs.append((p, dst))
     batch_download(remoting_key_dst_pairs, with_locker=True)
+    model_cache.touch(*loc)
     return loc
 
 
@@ -115,14 +125,15 @@ def get_tmp_local_path(remoting_path: str):
     hash_str = md5.hexdigest()[:16]
 
     dst = os.path.join(Tmp, hash_str + ex)
-    return get_local_path(remoting_path, dst, with_locker=False)
+    with _download_locker(dst):
+        return get_local_path(remoting_path, dst, with_locker=False)
 
 
 def upload_files(is_tmp, *files, dirname=None):
     keys = []
     if files:
         date = datetime.today().strftime('%Y/%m/%d')
-        file_storage_system = FileStorageCls()
+        file_storage_system = get_storage()
         relative = S3Tmp if is_tmp else S3SDWEB
         if dirname:
             relative = os.path.join(relative, dirname)
@@ -138,7 +149,7 @@ def upload_files(is_tmp, *files, dirname=None):
 def upload_content(is_tmp, content, name=None, dirname=None):
     date = datetime.today().strftime('%Y/%m/%d')
 
-    file_storage_system = FileStorageCls()
+    file_storage_system = get_storage()
     relative = S3Tmp if is_tmp else S3SDWEB
     if dirname:
         relative = os.path.join(relative, dirname)
@@ -277,8 +288,8 @@ def init_script_args(default_script_args: typing.Sequence,
         basename = os.path.basename(refiner_checkpoint)
         name_for_extra, _ = os.path.splitext(basename)
 
-        # 防止文件过期被删
-        os.popen(f'touch {refiner_checkpoint}')
+        # 记录访问，防止文件被清理
+        model_cache.touch(refiner_checkpoint)
         checkpoint = CheckpointInfo(refiner_checkpoint)
         logger.debug(f"[XL REFINER] => register refiner model({name_for_extra}) ids:{checkpoint.ids}")
         checkpoint.register()
@@ -351,14 +362,43 @@ def init_script_args(default_script_args: typing.Sequence,
 
 @FuncExecTimeWrapper()
 def load_sd_model_weights(filename, sha256=None):
-    # 修改文件mtime，便于后续清理
+    # 当前加载的模型不会被清理
     if filename:
-        os.popen(f'touch {filename}')
+        model_cache.release(LoadedModelOwner)
+        model_cache.pin(LoadedModelOwner, filename)
         checkpoint = CheckpointInfo(filename, sha256)
         res = reload_model_weights(info=checkpoint)
         return res
 
 
+def prefetch_sd_model_weights(filename: str, sha256: str = None, owner: str = None) -> bool:
+    '''
+    预读模型权重到内存，切换模型时直接使用。内存不足（预读后可能触发 OOM 退出）时跳过。
+    owner 为预取的任务ID，任务结束后通过 release_sd_model_weights 释放。
+    '''
+    if not filename or not os.path.isfile(filename):
+        return False
+    # 不使用 shared.sd_model，避免未加载模型时触发加载
+    sd_model = model_data.sd_model
+    if sd_model and getattr(sd_model, 'sd_model_checkpoint', None) == filename:
+        return False
+    size = os.path.getsize(filename)
+    mem = psutil.virtual_memory()
+    used = mem.total - mem.available + size
+    if used > mem.total * 0.75 and mem.total - used < 26 * 2 ** 30:
+        logger.info(f"skip prefetch {filename}, memory used:{used / 2 ** 30:.1f}/{mem.total / 2 ** 30:.1f}GB")
+        return False
+    prefetch_checkpoint_state_dict(CheckpointInfo(filename, sha256), owner)
+    return True
+
+
+def release_sd_model_weights(owner: str = None):
+    '''
+    释放任务预读的模型权重（任务未切换到该模型：失败、超时或交还时），不传 owner 释放全部。
+    '''
+    release_prefetched_checkpoint(owner)
+
+
 def close_pil(image: Image):
     image.close()
 
@@ -392,8 +432,10 @@ def save_processed_images(proc: Processed,
     out_grid_image = ImageOutput(OutImageType.Grid, grid_dir)
     out_image = ImageOutput(OutImageType.Image, output_dir)
     out_script_image = ImageOutput(OutImageType.Script, script_dir)
-    faces = {}
+    faces, face_images = {}, {}
     size = ''
+    # 非本地存储时在内存中编码并直接上传，不写临时文件
+    in_memory = not output_to_disk() and get_storage().name() != 'default'
 
     for n, processed_image in enumerate(proc.images):
         ex = '.png'
@@ -436,14 +478,21 @@ def save_processed_images(proc: Processed,
             pnginfo_data.add_text(k, str(v))
         pnginfo_data.add_text('parameters', infotexts)
 
-        processed_image.save(full_path, pnginfo=pnginfo_data)
         if detect_multi_face:
-            # 忽略此图
-            faces.update({
-                os.path.basename(full_path): detect_faces(full_path)
-            })
+            # 使用内存中的图片检测，不再重新读取文件
+            face_images[os.path.basename(full_path)] = processed_image
+
+        if in_memory:
+            with io.BytesIO() as buffer:
+                image_format = Image.registered_extensions().get(ex.lower(), 'PNG')
+                processed_image.save(buffer, format=image_format, pnginfo=pnginfo_data)
+                out_obj.add_image_content(full_path, buffer.getvalue(), processed_image)
+        else:
+            processed_image.save(full_path, pnginfo=pnginfo_data)
+            out_obj.add_image(full_path)
 
-        out_obj.add_image(full_path)
+    if face_images:
+        faces = dict(zip(face_images, face_detector.batch_count(list(face_images.values()))))
 
     grid_keys = out_grid_image.multi_upload_keys(clean_upload_files)
     image_keys = out_image.multi_upload_keys(clean_upload_files)
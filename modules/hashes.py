@@ -9,6 +9,9 @@ from modules import shared
 from modules.paths import data_path
 from tools.mysql import get_mysql_cli, MySQLClient
 
+# 已记录的文件哈希查询（由 worker 注册，如下载时计算的哈希）：(文件路径, 是否 addnet 哈希) -> 哈希或 None
+recorded_hash_hook = None
+
 # dump_cache = modules.cache.dump_cache
 cache = modules.cache.cache
 
@@ -91,7 +94,17 @@ def calculate_sha256(filename):
     return hash_sha256.hexdigest()
 
 
+def register_recorded_hash_hook(hook):
+    global recorded_hash_hook
+    recorded_hash_hook = hook
+
+
 def sha256_from_cache(filename, title, use_addnet_hash=False):
+    # 下载时已计算并记录的哈希
+    recorded = recorded_hash_hook(filename, use_addnet_hash) if recorded_hash_hook else None
+    if recorded:
+        return recorded
+
     if shared.cmd_opts.worker:
         basename, _ = os.path.splitext(os.path.basename(filename))
         return basename
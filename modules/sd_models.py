@@ -26,6 +26,9 @@ checkpoints_list = {}
 checkpoint_aliases = {}
 checkpoint_alisases = checkpoint_aliases  # for compatibility with old name
 checkpoints_loaded = collections.OrderedDict()
+# 预读到内存中的权重（worker 预取下一个任务的模型），最多保留一个：文件路径 -> (预取任务ID, state_dict)
+checkpoints_prefetched = {}
+checkpoints_prefetch_lock = threading.Lock()
 # tss 模型
 user_loras = []
 user_embedding_dirs = []
@@ -335,6 +338,13 @@ def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
         print(f"Loading weights [{sd_model_hash}] from cache")
         return checkpoints_loaded[checkpoint_info]
 
+    with checkpoints_prefetch_lock:
+        prefetched = checkpoints_prefetched.pop(checkpoint_info.filename, None)
+    if prefetched is not None:
+        print(f"Loading weights [{sd_model_hash}] from prefetched")
+        timer.record("load weights from prefetched")
+        return prefetched[1]
+
     print(f"Loading weights [{sd_model_hash}] from {checkpoint_info.filename}")
     res = read_state_dict(checkpoint_info.filename)
     timer.record("load weights from disk")
@@ -342,6 +352,31 @@ def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
     return res
 
 
+def prefetch_checkpoint_state_dict(checkpoint_info: CheckpointInfo, owner: str = None):
+    """reads the checkpoint into RAM (CPU) ahead of switching to it; only the latest prefetched checkpoint is kept"""
+    filename = checkpoint_info.filename
+    if checkpoint_info in checkpoints_loaded:
+        return
+    with checkpoints_prefetch_lock:
+        if filename in checkpoints_prefetched:
+            checkpoints_prefetched[filename] = (owner, checkpoints_prefetched[filename][1])
+            return
+        checkpoints_prefetched.clear()
+
+    state_dict = read_state_dict(filename, map_location='cpu')
+    with checkpoints_prefetch_lock:
+        checkpoints_prefetched.clear()
+        checkpoints_prefetched[filename] = (owner, state_dict)
+
+
+def release_prefetched_checkpoint(owner: str = None):
+    """drops the prefetched state_dict of the given owner (all when owner is None), e.g. when the staged task failed or was handed back"""
+    with checkpoints_prefetch_lock:
+        for filename, (prefetch_owner, _) in list(checkpoints_prefetched.items()):
+            if owner is None or prefetch_owner == owner:
+                del checkpoints_prefetched[filename]
+
+
 class SkipWritingToConfig:
     """This context manager prevents load_model_weights from writing checkpoint name to the config when it loads weight."""
 
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/4 3:20 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : test_claim.py
+# @Software: xingzhe.ai
+import json
+import time
+import unittest
+import threading
+import fakeredis
+from worker.claim import TaskClaimer, TaskWorkerKeyPrefix, TrainRetryDelay
+from worker.queue_registry import QueueRegistry
+from worker.wakeup import TaskWakeupListener, TaskWakeupAnyChannel, wakeup_channel
+from worker.lease import TaskLeaseManager
+
+
+class TestTaskClaimer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        self.rds = fakeredis.FakeRedis(server=self.server)
+        self.now = int(time.time() * 1000)
+
+    def push(self, queue, task_id, score=None, **meta):
+        meta.setdefault('task_id', task_id)
+        self.rds.set(task_id, json.dumps(meta), 3600)
+        self.rds.zadd(queue, {task_id: self.now if score is None else score})
+
+    def test_no_double_claim(self):
+        queue, total = 'task_abcdef1234', 500
+        for i in range(total):
+            self.push(queue, f'task-{i}', self.now - total + i)
+
+        claimed, lock = [], threading.Lock()
+
+        def worker(n):
+            rds = fakeredis.FakeRedis(server=self.server)
+            claimer = TaskClaimer(f'worker-{n}')
+            while 1:
+                c = claimer.claim(rds, queue)
+                if not c:
+                    break
+                with lock:
+                    claimed.append((c.task_id, n))
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        ids = [x[0] for x in claimed]
+        self.assertEqual(len(ids), total)
+        self.assertEqual(len(set(ids)), total)
+        self.assertEqual(self.rds.zcard(queue), 0)
+        for task_id, n in claimed:
+            self.assertEqual(self.rds.get(TaskWorkerKeyPrefix + task_id).decode(), f'worker-{n}')
+
+    def test_lowest_due_score_first(self):
+        queue = 'task_order'
+        self.push(queue, 'late', self.now + 60 * 1000)
+        self.push(queue, 'b', self.now - 10)
+        self.push(queue, 'a', self.now - 20)
+        claimer = TaskClaimer('w')
+        self.assertEqual(claimer.claim(self.rds, queue).task_id, 'a')
+        self.assertEqual(claimer.claim(self.rds, queue).task_id, 'b')
+        self.assertIsNone(claimer.claim(self.rds, queue))
+        self.assertEqual(self.rds.zcard(queue), 1)
+
+    def test_score_limit(self):
+        queue = 'task_limit'
+        self.push(queue, 'big_20', self.now - 20)
+        self.push(queue, 'small_5', self.now - 10)
+        c = TaskClaimer('low-vram', score_limit=10).claim(self.rds, queue)
+        self.assertEqual(c.task_id, 'small_5')
+        # 超限任务保留在队列中
+        self.assertEqual(self.rds.zscore(queue, 'big_20'), self.now - 20)
+
+    def test_expired_meta_dropped(self):
+        queue = 'task_expired'
+        self.rds.zadd(queue, {'gone': self.now - 10})
+        self.push(queue, 'ok', self.now)
+        self.assertEqual(TaskClaimer('w').claim(self.rds, queue).task_id, 'ok')
+        self.assertEqual(self.rds.zcard(queue), 0)
+
+    def test_train_concurrency(self):
+        queue = 'task_train'
+        for i in range(3):
+            self.push(queue, f'train-{i}', self.now - 10 + i, task_type=4, user_id='u1', paralle_count=2)
+
+        w1 = TaskClaimer('w1')
+        self.assertEqual(w1.claim(self.rds, queue, self.now).task_id, 'train-0')
+        self.assertEqual(TaskClaimer('w2').claim(self.rds, queue, self.now).task_id, 'train-1')
+        self.assertEqual(w1.permits.count(self.rds, 'u1', self.now), 2)
+        # 满额：任务延后，不阻塞领取
+        self.assertIsNone(TaskClaimer('w3').claim(self.rds, queue, self.now))
+        self.assertEqual(self.rds.zscore(queue, 'train-2'), self.now + TrainRetryDelay)
+
+        # 释放许可后，延后时间到期即可领取
+        w1.permits.release(self.rds, 'u1', 'train-0')
+        self.assertIsNone(TaskClaimer('w3').claim(self.rds, queue, self.now))
+        later = self.now + TrainRetryDelay
+        self.assertEqual(TaskClaimer('w3').claim(self.rds, queue, later).task_id, 'train-2')
+
+    def test_train_permit_expire(self):
+        queue = 'task_train'
+        for i in range(2):
+            self.push(queue, f'train-{i}', self.now - 10 + i, task_type=4, user_id='u1', paralle_count=1)
+        w1 = TaskClaimer('w1')
+        self.assertEqual(w1.claim(self.rds, queue, self.now).task_id, 'train-0')
+        self.assertEqual(w1.permits.renew(self.rds, self.now + 30 * 1000), [])
+        # 续期后未过期
+        later = self.now + TrainRetryDelay
+        self.assertIsNone(TaskClaimer('w2').claim(self.rds, queue, later + 60 * 1000))
+        # w1 掉线，许可到期自动释放
+        expired = later + 60 * 1000 + TrainRetryDelay + w1.permits.ttl * 1000
+        self.assertEqual(TaskClaimer('w2').claim(self.rds, queue, expired).task_id, 'train-1')
+        self.assertEqual(w1.permits.renew(self.rds, expired), ['train-0'])
+
+    def test_claim_batch(self):
+        queue = 'task_batch'
+        fields = ['width', 'steps', 'lora_models']
+        self.push(queue, 'lead', self.now - 50, width=512, steps=20, lora_models=['x'], prompt='a')
+        self.push(queue, 'same-1', self.now - 40, width=512, steps=20, lora_models=['x'], prompt='b', batch_size=2)
+        self.push(queue, 'other', self.now - 30, width=768, steps=20, lora_models=['x'], prompt='c')
+        self.push(queue, 'same-2', self.now - 20, width=512, steps=20, lora_models=['x'], prompt='d', batch_size=4)
+        self.push(queue, 'same-3', self.now - 10, width=512, steps=20, lora_models=['x'], prompt='e')
+        claimer = TaskClaimer('w')
+        lead = claimer.claim(self.rds, queue)
+        batch = claimer.claim_batch(self.rds, queue, lead.meta, fields, 3)
+        # 不兼容的任务和超出图片数上限的任务留在队列中
+        self.assertEqual([c.task_id for c in batch], ['same-1', 'same-3'])
+        self.assertEqual([v.decode() for v in self.rds.zrange(queue, 0, -1)], ['other', 'same-2'])
+        self.assertEqual(self.rds.zcard(claimer.leases.lease_key), 3)
+
+    def test_release(self):
+        queue = 'task_release'
+        self.push(queue, 'x', self.now - 5)
+        claimer = TaskClaimer('w')
+        c = claimer.claim(self.rds, queue)
+        claimer.release(self.rds, c, queue)
+        self.assertEqual(self.rds.zscore(queue, 'x'), self.now - 5)
+        self.assertIsNone(self.rds.get(TaskWorkerKeyPrefix + 'x'))
+
+    def test_queue_registry(self):
+        registry = QueueRegistry()
+        registry.push(self.rds, 'task_a', 'a-1', self.now - 10, json.dumps({'task_id': 'a-1'}), 60)
+        registry.push(self.rds, 'task_a', 'a-2', self.now - 30, json.dumps({'task_id': 'a-2'}), 60)
+        registry.push(self.rds, 'task_b', 'b-1', self.now - 20, json.dumps({'task_id': 'b-1'}), 60)
+        registry.push(self.rds, 'task_c', 'c-1', self.now + 60 * 1000, json.dumps({'task_id': 'c-1'}), 60)
+
+        stats = registry.snapshot(self.rds, self.now)
+        self.assertEqual([(s.name, s.depth) for s in stats], [('task_a', 2), ('task_b', 1)])
+
+        claimer = TaskClaimer('w')
+        self.assertEqual(claimer.claim(self.rds, 'task_a').task_id, 'a-2')
+        self.assertEqual(claimer.claim(self.rds, 'task_b').task_id, 'b-1')
+        stats = registry.snapshot(self.rds, self.now)
+        self.assertEqual([(s.name, s.depth, s.oldest_score) for s in stats], [('task_a', 1, self.now - 10)])
+
+        claimer.claim(self.rds, 'task_a')
+        self.assertEqual(registry.snapshot(self.rds, self.now), [])
+        self.assertEqual(self.rds.zcard(registry.registry_key), 1)
+
+    def test_rebuild_registry(self):
+        self.push('task_old', 'x', self.now - 10)
+        registry = QueueRegistry()
+        self.assertEqual(registry.rebuild(self.rds, 'task_'), 1)
+        # 互斥键存在时不重复扫描
+        self.assertEqual(registry.rebuild(self.rds, 'task_'), 0)
+        self.assertEqual(registry.snapshot(self.rds, self.now)[0].name, 'task_old')
+
+    def test_empty_registry_fallback(self):
+        registry = QueueRegistry()
+        self.assertEqual(registry.snapshot_or_probe(self.rds, 'task_'), [])
+        # 绕过 push 直接 ZADD：注册表为空时检查已加载模型的队列
+        self.push('task_loaded', 'x', self.now - 10)
+        stats = registry.snapshot_or_probe(self.rds, 'task_', ['task_loaded', 'task_none'])
+        self.assertEqual([s.name for s in stats], ['task_loaded'])
+        # 注册表非空时不再检查
+        self.push('task_other', 'y', self.now - 10)
+        self.assertEqual(len(registry.snapshot_or_probe(self.rds, 'task_')), 1)
+
+    def test_empty_registry_rebuild(self):
+        self.push('task_scan', 'x', self.now - 10)
+        registry = QueueRegistry()
+        # 注册表为空时限频 SCAN 修复
+        self.assertEqual([s.name for s in registry.snapshot_or_probe(self.rds, 'task_')], ['task_scan'])
+
+    def test_wakeup(self):
+        server = self.server
+
+        class Pool:
+            def get_connection(self):
+                return fakeredis.FakeRedis(server=server)
+
+        listener = TaskWakeupListener(Pool())
+        # 调用方传入本轮计算好的频道
+        listener.subscribe([wakeup_channel('task_w')])
+        other = TaskWakeupListener(Pool(), lambda: [wakeup_channel('task_x'), TaskWakeupAnyChannel])
+        other.subscribe()
+
+        def push(queue, task_id):
+            time.sleep(0.2)
+            QueueRegistry().push(fakeredis.FakeRedis(server=server), queue, task_id, self.now,
+                                 json.dumps({'task_id': task_id}), 60)
+
+        threading.Thread(target=push, args=('task_w', 'w-1')).start()
+        st = time.time()
+        self.assertEqual(listener.wait(5), ['task_w'])
+        self.assertLess(time.time() - st, 2)
+        self.assertEqual(listener.wait(0.2), [])
+        # 只通知订阅了该队列的 worker
+        self.assertEqual(other.wait(0.2), [])
+
+        # 没有订阅者的队列通过公共频道通知
+        threading.Thread(target=push, args=('task_y', 'y-1')).start()
+        self.assertEqual(other.wait(5), ['task_y'])
+        self.assertEqual(listener.wait(0.2), [])
+        listener.close()
+        other.close()
+
+    def test_lease_requeue(self):
+        queue = 'task_lease'
+        self.push(queue, 'l-1', self.now - 100)
+        leases = TaskLeaseManager(ttl=0, max_retries=1)
+        claimer = TaskClaimer('dead-worker', leases=leases)
+
+        meta = claimer.claim(self.rds, queue).meta
+        self.assertEqual(self.rds.zcard(queue), 0)
+        # 租约信息只记录回收需要的字段
+        self.assertEqual(set(json.loads(self.rds.hget(leases.info_key, 'l-1'))), {'queue', 'score', 'worker'})
+        # 执行期间任务键被进度快照覆盖
+        snapshot = {'task_id': 'l-1', 'status': 1, 'task': json.loads(meta)}
+        self.rds.set('l-1', json.dumps(snapshot), 1200)
+        expired = leases.reap(self.rds)
+        self.assertEqual([(e.task_id, e.requeued) for e in expired], [('l-1', True)])
+        # 以原始分数回到原队列，重新领取时从快照中取出任务数据
+        self.assertEqual(self.rds.zscore(queue, 'l-1'), self.now - 100)
+        self.assertGreater(self.rds.ttl('l-1'), 1200)
+        self.assertEqual(QueueRegistry().snapshot(self.rds, self.now)[0].name, queue)
+        self.assertEqual(json.loads(claimer.claim(self.rds, queue).meta), json.loads(meta))
+
+        # 超过重试次数后不再入队
+        self.rds.set('l-1', json.dumps(snapshot), 1200)
+        expired = leases.reap(self.rds)
+        self.assertEqual([(e.task_id, e.requeued) for e in expired], [('l-1', False)])
+        self.assertEqual(json.loads(expired[0].meta), json.loads(meta))
+        self.assertEqual(self.rds.zcard(queue), 0)
+
+    def test_lease_renew_complete(self):
+        queue = 'task_lease_ok'
+        self.push(queue, 'l-2', self.now - 100)
+        leases = TaskLeaseManager(ttl=60)
+        TaskClaimer('w', leases=leases).claim(self.rds, queue)
+        leases.hold('l-2')
+        leases.hold('lost')
+        self.assertEqual(leases.renew(self.rds), ['lost'])
+        self.assertEqual(leases.reap(self.rds), [])
+        leases.complete(self.rds, 'l-2')
+        self.assertEqual(self.rds.zcard(leases.lease_key), 0)
+        # 丢失租约的任务不再续约，释放时不删除其他 worker 的租约
+        self.assertTrue(leases.lost('lost'))
+        self.assertEqual(leases.holding(), [])
+        self.rds.zadd(leases.lease_key, {'lost': self.now + 60000})
+        leases.complete(self.rds, 'lost')
+        self.assertEqual(self.rds.zcard(leases.lease_key), 1)
+        self.assertFalse(leases.lost('lost'))
+
+
+if __name__ == '__main__':
+    unittest.main()
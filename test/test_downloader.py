@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/20 5:20 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : test_downloader.py
+# @Software: xingzhe.ai
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from filestorage.downloader import RangedDownloader, PartFileSuffix, JournalSuffix
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    content = b''
+    requests = []
+
+    def do_GET(self):
+        RangeHandler.requests.append(self.headers.get('Range'))
+        data, status = self.content, 200
+        headers = {'ETag': '"v1"', 'Content-Disposition': 'attachment; filename="model.bin"'}
+        rng = self.headers.get('Range')
+        if rng:
+            start, end = rng.split('=')[1].split('-')
+            start, end = int(start), min(int(end), len(self.content) - 1)
+            data, status = self.content[start:end + 1], 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{len(self.content)}'
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRangedDownloader(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        RangeHandler.content = os.urandom(1024 * 1024 + 123)
+        cls.sha256 = hashlib.sha256(RangeHandler.content).hexdigest()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}/model.bin'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        RangeHandler.requests = []
+        self.downloader = RangedDownloader(connections=4, part_size=64 * 1024)
+
+    def tearDown(self):
+        self.downloader.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_download(self):
+        dst = os.path.join(self.dir, self.sha256 + '.safetensors')
+        progress = []
+        self.downloader.download(self.url, dst, lambda a, b: progress.append((a, b)))
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), RangeHandler.content)
+        self.assertEqual(progress[-1], (len(RangeHandler.content), len(RangeHandler.content)))
+        self.assertFalse(os.path.exists(dst + PartFileSuffix))
+        self.assertFalse(os.path.exists(dst + JournalSuffix))
+
+    def test_resume(self):
+        dst = os.path.join(self.dir, 'model.bin')
+        remote = self.downloader.probe(self.url)
+        size = len(RangeHandler.content)
+        count = (size + 64 * 1024 - 1) // (64 * 1024)
+        # 模拟中断：前 10 个分片已写入
+        with open(dst + PartFileSuffix, 'wb') as f:
+            f.write(RangeHandler.content[:10 * 64 * 1024])
+            f.truncate(size)
+        with open(dst + JournalSuffix, 'w') as f:
+            json.dump({'size': size, 'etag': remote.etag, 'part_size': 64 * 1024, 'done': list(range(10))}, f)
+        RangeHandler.requests = []
+        self.downloader.download(self.url, dst, sha256=self.sha256, remote=remote)
+        self.assertEqual(len(RangeHandler.requests), count - 10)
+        with open(dst, 'rb') as f:
+            self.assertEqual(hashlib.sha256(f.read()).hexdigest(), self.sha256)
+
+    def test_checksum_mismatch(self):
+        dst = os.path.join(self.dir, '0' * 64 + '.safetensors')
+        with self.assertRaises(OSError):
+            self.downloader.download(self.url, dst)
+        self.assertFalse(os.path.exists(dst))
+        self.assertFalse(os.path.exists(dst + PartFileSuffix))
+
+    def test_hash_callback(self):
+        header = json.dumps({'__metadata__': {'format': 'pt'}}).encode()
+        content = len(header).to_bytes(8, 'little') + header + os.urandom(512 * 1024 + 7)
+        origin, RangeHandler.content = RangeHandler.content, content
+        try:
+            digests = []
+            dst = os.path.join(self.dir, 'lora.safetensors')
+            self.downloader.download(self.url, dst, hash_callback=lambda p, d: digests.append((p, d)))
+        finally:
+            RangeHandler.content = origin
+        self.assertEqual(digests[0][0], dst)
+        self.assertEqual(digests[0][1].sha256, hashlib.sha256(content).hexdigest())
+        # addnet 哈希跳过 safetensors 头部
+        self.assertEqual(digests[0][1].addnet, hashlib.sha256(content[8 + len(header):]).hexdigest())
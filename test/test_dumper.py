@@ -6,10 +6,13 @@
 # @File    : dumper_test.py
 # @Software: Hifive
 import os
+import json
 import time
 import unittest
+import fakeredis
 from worker.task import TaskProgress, Task
-from worker.dumper import dumper
+from worker.dumper import dumper, DumpInfo, CoalescingBuffer, ProgressCache, TaskProgressStreamPrefix, \
+    TaskPreviewKeyPrefix
 from tools.environment import Env_MgoHost, Env_MgoPass, Env_MgoUser
 
 
@@ -29,5 +32,54 @@ class TestMgoDumper(unittest.TestCase):
         dumper.stop()
 
 
+class TestCoalescingBuffer(unittest.TestCase):
+
+    def info(self, task_id, progress):
+        return DumpInfo({'task_id': task_id}, {'$set': {'task_progress': progress}}, multi=False)
+
+    def test_coalesce(self):
+        buffer = CoalescingBuffer(capacity=2)
+        for p in range(0, 100, 10):
+            buffer.put(self.info('a', p))
+        buffer.put(self.info('b', 10))
+        self.assertFalse(buffer.wait(0, 10))
+        # 终态立即写入，之后的中间进度被丢弃
+        buffer.put(self.info('a', 100), terminal=True)
+        buffer.put(self.info('a', 50))
+        self.assertTrue(buffer.wait(0, 10))
+        # 超出容量丢弃最早的中间进度
+        buffer.put(self.info('c', 10))
+        items = dict((x.id, x.set['$set']['task_progress']) for x in buffer.drain())
+        self.assertEqual(items, {'task_id=a': 100, 'task_id=c': 10})
+        self.assertEqual(buffer.metrics.coalesced, 11)
+        self.assertEqual(buffer.metrics.evicted, 1)
+        self.assertEqual(len(buffer), 0)
+
+
+class TestProgressCache(unittest.TestCase):
+
+    def test_delta(self):
+        rds = fakeredis.FakeRedis()
+        cache = ProgressCache()
+        cache.put('t1', {'status': 2, 'task_progress': 10, 'eta_relative': 30, 'task': {'prompt': 'x'}})
+        cache.put('t1', {'status': 2, 'task_progress': 20, 'eta_relative': 30, 'preview': 'abc'})
+        cache.put('t1', {'status': 2, 'task_progress': 20, 'eta_relative': 30, 'preview': 'abc'})
+        self.assertEqual(cache.flush(rds), 1)
+        # 状态变化时写入快照，预览图单独存放
+        self.assertEqual(json.loads(rds.get('t1'))['task_progress'], 10)
+        self.assertEqual(rds.get(TaskPreviewKeyPrefix + 't1'), b'abc')
+        entries = rds.xrange(TaskProgressStreamPrefix + 't1')
+        self.assertEqual(len(entries), 1)
+        delta = entries[0][1]
+        self.assertEqual(json.loads(delta[b'progress']), 20)
+        self.assertNotIn(b'task', delta)
+
+        cache.put('t1', {'status': 10, 'task_progress': 100, 'eta_relative': 0}, terminal=True)
+        cache.put('t1', {'status': 2, 'task_progress': 99, 'eta_relative': 0})
+        cache.flush(rds)
+        self.assertEqual(json.loads(rds.get('t1'))['status'], 10)
+        self.assertEqual(rds.xlen(TaskProgressStreamPrefix + 't1'), 2)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/25 6:40 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : test_face.py
+# @Software: xingzhe.ai
+import threading
+import unittest
+from PIL import Image
+from tools.face import FaceDetector
+
+
+class _Rect:
+
+    def __init__(self, left, top, right, bottom):
+        self.left, self.top, self.right, self.bottom = lambda: left, lambda: top, lambda: right, lambda: bottom
+
+
+class _FakeDetector:
+    # 在检测图中返回一个固定位置的人脸框，并记录输入尺寸
+    calls = []
+    locker = threading.Lock()
+
+    def __call__(self, gray, upsample):
+        with self.locker:
+            self.calls.append(gray.shape)
+        return [_Rect(10, 20, 110, 120)]
+
+
+class TestFaceDetector(unittest.TestCase):
+
+    def setUp(self):
+        _FakeDetector.calls = []
+        self.loads = 0
+
+        def loader():
+            self.loads += 1
+            return _FakeDetector()
+
+        self.detector = FaceDetector(max_side=512, workers=2, loader=loader)
+
+    def tearDown(self):
+        self.detector.close()
+
+    def test_downscale_and_rescale(self):
+        boxes = self.detector.detect(Image.new('RGB', (1024, 2048), (200, 100, 50)))
+        self.assertEqual(_FakeDetector.calls, [(512, 256)])
+        self.assertEqual(boxes, [(40, 80, 440, 480)])
+
+    def test_batch_and_cache(self):
+        images = [Image.new('RGB', (768, 768), (i, i, i)) for i in range(4)]
+        self.assertEqual(self.detector.batch_count(images), [1] * 4)
+        self.assertEqual(self.detector.batch_count(images), [1] * 4)
+        # 相同图片只检测一次，检测器每个线程只加载一次
+        self.assertEqual(len(_FakeDetector.calls), 4)
+        self.assertLessEqual(self.loads, 2)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/22 4:00 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : test_fswatch.py
+# @Software: xingzhe.ai
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from tools.fswatch import FileWaiter
+
+
+class TestFileWaiter(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'model.safetensors')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def install_later(self, delay):
+        def install():
+            time.sleep(delay)
+            tmp = self.path + '.part'
+            with open(tmp, 'wb') as f:
+                f.write(b'weights')
+            os.replace(tmp, self.path)
+
+        threading.Thread(target=install, daemon=True).start()
+
+    def wait_file(self, waiter: FileWaiter, timeout: float) -> float:
+        st = time.time()
+        while not os.path.isfile(self.path) and time.time() - st < timeout:
+            waiter.wait(timeout)
+        return time.time() - st
+
+    def test_inotify(self):
+        with FileWaiter(self.path) as waiter:
+            if not waiter.inotify:
+                self.skipTest('inotify not supported')
+            self.install_later(0.3)
+            cost = self.wait_file(waiter, 5)
+        self.assertTrue(os.path.isfile(self.path))
+        self.assertLess(cost, 0.5)
+
+    def test_poll(self):
+        with FileWaiter(self.path, use_inotify=False) as waiter:
+            self.install_later(0.3)
+            cost = self.wait_file(waiter, 5)
+        self.assertTrue(os.path.isfile(self.path))
+        self.assertLess(cost, 1.5)
+
+    def test_timeout(self):
+        with FileWaiter(self.path) as waiter:
+            st = time.time()
+            self.assertFalse(waiter.wait(0.2))
+            self.assertLess(time.time() - st, 0.5)
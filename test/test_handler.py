@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/26 10:20 AM
+# @Author  : wangdongming
+# @Site    :
+# @File    : test_handler.py
+# @Software: xingzhe.ai
+import unittest
+from worker.lease import TaskLeaseLost
+from worker.task import Task, TaskProgress, TaskType
+
+try:
+    from worker.handler import TaskHandler
+except Exception:
+    # 需要完整的 webui 运行环境（torch 等）
+    TaskHandler = None
+
+
+@unittest.skipIf(TaskHandler is None, 'webui dependencies not installed')
+class TestTaskHandler(unittest.TestCase):
+
+    def test_lease_lost_stop_writing(self):
+        written = []
+
+        class Handler(TaskHandler):
+
+            def _exec(self, task):
+                for i in range(5):
+                    yield TaskProgress.new_running(task, 'running', i * 20)
+
+            def _set_task_status(self, p):
+                written.append(p.task_progress)
+
+        lost = set()
+
+        def progress_callback(p):
+            if not p.completed and p.task.id in lost:
+                raise TaskLeaseLost(p.task.id)
+            if p.task_progress == 20:
+                # 执行期间续约发现租约已被回收
+                lost.add(p.task.id)
+
+        task = Task(task_id='t1', user_id='u1', task_type=TaskType.Txt2Image)
+        handler = Handler(TaskType.Txt2Image)
+        handler._run([task], handler._exec(task), progress_callback)
+        # 租约丢失后不再写入任何进度（包括失败状态）
+        self.assertEqual(written, [0, 20])
+
+    def test_report_progress_check_lease(self):
+        written = []
+
+        class Handler(TaskHandler):
+
+            def _exec(self, task):
+                yield TaskProgress.new_running(task, 'running', 0)
+                # 采样回调中上报的进度同样经过进度回调
+                for i in range(1, 5):
+                    self._report_progress(TaskProgress.new_running(task, 'sampling', i * 20))
+                yield TaskProgress.new_running(task, 'running', 100)
+
+            def _set_task_status(self, p):
+                written.append(p.task_progress)
+
+        def progress_callback(p):
+            if p.task_progress > 40:
+                raise TaskLeaseLost(p.task.id)
+
+        task = Task(task_id='t2', user_id='u1', task_type=TaskType.Txt2Image)
+        handler = Handler(TaskType.Txt2Image)
+        handler._run([task], handler._exec(task), progress_callback)
+        self.assertEqual(written, [0, 20, 40])
+        self.assertIsNone(handler._progress_callback)
+
+
+if __name__ == '__main__':
+    unittest.main()
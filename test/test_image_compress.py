@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/25 2:10 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : test_image_compress.py
+# @Software: xingzhe.ai
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+from PIL import Image
+from benchmark.image_compress_bench import make_corpus
+from tools.image import compress_image, encode_to_size, support_format
+
+
+class TestEncodeToSize(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.images = make_corpus(3, 768)
+
+    def test_jpeg_within_target(self):
+        for im in self.images:
+            data = encode_to_size(im, 60)
+            self.assertLessEqual(len(data), 60 * 1024)
+            self.assertEqual(Image.open(BytesIO(data)).size, im.size)
+
+    def test_webp(self):
+        if not support_format('WEBP'):
+            self.skipTest('webp not supported')
+        data = encode_to_size(self.images[0], 40, 'WEBP')
+        self.assertLessEqual(len(data), 40 * 1024)
+        self.assertEqual(Image.open(BytesIO(data)).format, 'WEBP')
+
+    def test_compress_image(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            src, dst = os.path.join(work_dir, 'a.png'), os.path.join(work_dir, 'low-a.png')
+            self.images[0].save(src)
+            compress_image(src, dst, kb=80)
+            self.assertLessEqual(os.path.getsize(dst), 80 * 1024)
+            self.assertEqual(Image.open(dst).format, 'JPEG')
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
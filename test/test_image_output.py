@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/26 3:20 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : test_image_output.py
+# @Software: xingzhe.ai
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+from unittest import mock
+from PIL import Image
+from filestorage.storage import FileStorage
+from handlers.typex import ImageOutput, OutImageType
+from benchmark.image_compress_bench import make_corpus
+
+
+class MemoryFileStorage(FileStorage):
+    storage_name = 'memory'
+
+    def __init__(self):
+        super(MemoryFileStorage, self).__init__()
+        self.objects = {}
+        self.parts = {}
+
+    def download(self, remoting_path, local_path, progress_callback=None) -> str:
+        raise NotImplementedError
+
+    def upload(self, local_path, remoting_path) -> str:
+        with open(local_path, 'rb') as f:
+            self.objects[remoting_path] = f.read()
+        return remoting_path
+
+    def upload_content(self, remoting_path, content) -> str:
+        # 按分片拼接，校验分片切分
+        parts = list(self.content_parts(content))
+        self.parts[remoting_path] = len(parts)
+        self.objects[remoting_path] = b''.join(data for _, data in parts)
+        return remoting_path
+
+
+class TestImageOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage = MemoryFileStorage()
+        patcher = mock.patch('handlers.typex.get_storage', return_value=self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('filestorage.storage.MultipartPartSize', 512 * 1024)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_upload_contents(self):
+        out = ImageOutput(OutImageType.Image, os.path.join(self.dir, 'output'))
+        image = make_corpus(1, 1024)[0]
+        with BytesIO() as buffer:
+            image.save(buffer, format='PNG')
+            data = buffer.getvalue()
+        out.add_image_content(os.path.join(out.output_dir, 'task-1.png'), data, image)
+        keys = out.multi_upload_keys()
+
+        self.assertEqual(os.listdir(out.output_dir), [])
+        self.assertEqual(len(keys['high']), 1)
+        self.assertEqual(self.storage.objects[keys['high'][0]], data)
+        self.assertEqual(self.storage.parts[keys['high'][0]], (len(data) + 512 * 1024 - 1) // (512 * 1024))
+        low = self.storage.objects[keys['low'][0]]
+        self.assertTrue(os.path.basename(keys['low'][0]).startswith('low-'))
+        self.assertLessEqual(len(low), 300 * 1024)
+        self.assertEqual(Image.open(BytesIO(low)).size, image.size)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/21 3:10 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : test_model_cache.py
+# @Software: xingzhe.ai
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from tools.model_cache import ModelCache
+
+
+class TestModelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.files = []
+        for i in range(5):
+            self.files.append(self.write(f'models/Stable-diffusion/ckpt-{i}.safetensors', 100))
+        self.sha = 'a' * 64
+        self.write(f'models/Lora/{self.sha}.safetensors', 10)
+        self.user = self.write('user-models/Stable-diffusion/mine.safetensors', 1000)
+        now = time.time()
+        for i, f in enumerate(self.files):
+            os.utime(f, (now - 1000 + i, now))
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write(self, name, size):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'0' * size)
+        return path
+
+    def cache(self, **budgets):
+        return ModelCache(self.root, budgets=budgets)
+
+    def test_index(self):
+        cache = self.cache()
+        # 用户模型只索引不计入预算
+        self.assertEqual(cache.usage()['checkpoint'], 500)
+        self.assertEqual(cache.usage()['lora'], 10)
+        self.assertEqual(cache.lookup(self.sha.upper()), os.path.join(self.root, f'models/Lora/{self.sha}.safetensors'))
+
+    def test_evict_lru(self):
+        cache = self.cache(checkpoint=250)
+        cache.touch(self.files[0])
+        cache.evict()
+        # ckpt-0 刚被访问，按访问时间删除 1、2、3
+        self.assertEqual([os.path.isfile(f) for f in self.files], [True, False, False, False, True])
+        self.assertTrue(os.path.isfile(self.user))
+        self.assertEqual(cache.usage()['checkpoint'], 200)
+
+    def test_pin(self):
+        cache = self.cache(checkpoint=0)
+        with cache.holding('task-1'):
+            cache.touch(self.files[1])
+        cache.pin('loaded', self.files[2])
+        cache.evict(max_files=2)
+        self.assertEqual(sum(os.path.isfile(f) for f in self.files), 3)
+        cache.evict()
+        self.assertEqual([os.path.isfile(f) for f in self.files], [False, True, True, False, False])
+        cache.release('task-1')
+        cache.evict()
+        self.assertEqual([os.path.isfile(f) for f in self.files], [False, False, True, False, False])
+
+    def test_compact_per_category(self):
+        for i in range(30):
+            self.write(f'models/VAE/vae-{i}.pt', 1)
+        cache = self.cache(checkpoint=1000)
+        lora = os.path.join(self.root, f'models/Lora/{self.sha}.safetensors')
+        for _ in range(100):
+            cache.touch(lora)
+        cache.evict()
+        # 过期节点按该类别的文件数判断，不受其他类别文件数影响
+        self.assertEqual(len(cache._heaps['lora']), 1)
+
+    def test_default_budgets(self):
+        # 默认只清理大模型和 LORA，embedding、vae 没有预算
+        self.assertEqual(set(ModelCache(self.root).budgets()), {'checkpoint', 'lora'})
+
+    def test_persist(self):
+        cache = self.cache()
+        cache.touch(self.files[0])
+        cache.flush()
+        # 重新加载后使用记录的访问时间，而不是文件 atime
+        cache = self.cache(checkpoint=100)
+        cache.evict()
+        self.assertEqual([os.path.isfile(f) for f in self.files], [True, False, False, False, False])
+
+    def test_record_hash(self):
+        cache = self.cache()
+        path = self.files[0]
+        cache.record_hash(path, 'b' * 64, 'c' * 64)
+        self.assertEqual(cache.lookup('b' * 64), path)
+        # 重新加载后按 inode 查询，硬链接同样有效
+        link = os.path.join(self.root, 'models', 'Stable-diffusion', 'link.safetensors')
+        os.link(path, link)
+        cache = self.cache()
+        self.assertEqual(cache.file_hash(link), 'b' * 64)
+        self.assertEqual(cache.file_hash(link, addnet=True), 'c' * 64)
+        # 文件修改后失效
+        with open(path, 'ab') as f:
+            f.write(b'1')
+        self.assertIsNone(cache.file_hash(path))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/22 10:05 AM
+# @Author  : wangdongming
+# @Site    :
+# @File    : test_node_cache.py
+# @Software: xingzhe.ai
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from filestorage.node_cache import NodeModelCache
+
+Key = 'model.safetensors[0a1b2c3d]'
+
+
+def _fetch(root, local_path, counter, fail=False):
+    def download(tmp):
+        with open(counter, 'a') as f:
+            f.write(f'{os.getpid()}\n')
+        time.sleep(0.5)
+        if fail:
+            # 模拟下载进程异常退出
+            os._exit(1)
+        with open(tmp, 'wb') as f:
+            f.write(b'weights')
+        return tmp
+
+    NodeModelCache(root).fetch(Key, local_path, download, timeout=30)
+
+
+class TestNodeModelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='nc')
+        self.counter = os.path.join(self.root, 'downloads.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def spawn(self, name, fail=False):
+        local = os.path.join(self.root, name, 'model.safetensors')
+        p = multiprocessing.Process(target=_fetch, args=(self.root, local, self.counter, fail))
+        p.start()
+        return p, local
+
+    def downloads(self):
+        with open(self.counter) as f:
+            return len(f.read().split())
+
+    def test_download_once(self):
+        procs = [self.spawn(f'pod-{i}') for i in range(4)]
+        for p, _ in procs:
+            p.join(30)
+            self.assertEqual(p.exitcode, 0)
+        self.assertEqual(self.downloads(), 1)
+        for _, local in procs:
+            with open(local, 'rb') as f:
+                self.assertEqual(f.read(), b'weights')
+        # 各 POD 的文件为缓存文件的硬链接
+        self.assertEqual(os.stat(procs[0][1]).st_nlink, 5)
+
+    def test_downloader_crash(self):
+        p, _ = self.spawn('pod-crash', fail=True)
+        time.sleep(0.2)
+        waiter, local = self.spawn('pod-wait')
+        p.join(30)
+        waiter.join(30)
+        self.assertEqual(waiter.exitcode, 0)
+        # 下载进程退出后由等待者接替下载
+        self.assertEqual(self.downloads(), 2)
+        self.assertTrue(os.path.isfile(local))
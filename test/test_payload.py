@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/19 3:40 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : test_payload.py
+# @Software: xingzhe.ai
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from worker import payload
+from worker.payload import LocalBlobStore, offload_payload, resolve_payload, PayloadKeysField, is_payload_ref
+from worker.task import Task
+
+try:
+    from handlers.img2img import Img2ImgTask
+except Exception:
+    # 需要完整的 webui 运行环境（torch 等）
+    Img2ImgTask = None
+
+
+class TestPayload(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = LocalBlobStore(self.root)
+        self.image = 'data:image/png;base64,' + 'A' * 4096
+        self.meta = {
+            'task_id': 't1',
+            'user_id': 'u1',
+            'task_type': 2,
+            'prompt': 'a cat',
+            'init_img': self.image,
+            'alwayson_scripts': {'ControlNet': {'args': [{'image': self.image, 'enabled': True}]}},
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_offload_resolve(self):
+        meta = offload_payload(self.meta, self.store, 1024)
+        self.assertEqual(meta['prompt'], 'a cat')
+        self.assertTrue(is_payload_ref(meta['init_img']))
+        self.assertEqual(sorted(meta[PayloadKeysField]), ['alwayson_scripts', 'init_img'])
+        # 相同内容只存储一份
+        self.assertEqual(meta['init_img'], meta['alwayson_scripts']['ControlNet']['args'][0]['image'])
+        self.assertLess(len(json.dumps(meta)), 1024)
+        self.assertEqual(resolve_payload(meta['alwayson_scripts'], self.store), self.meta['alwayson_scripts'])
+        # 未超过阈值不改动
+        self.assertNotIn(PayloadKeysField, offload_payload(self.meta, self.store, 8192))
+
+    def test_task_lazy_resolve(self):
+        meta = offload_payload(self.meta, self.store, 1024)
+        task = Task.from_json_str(json.dumps(meta))
+        with mock.patch.object(payload, '_store', self.store):
+            self.assertEqual(task['init_img'], self.image)
+            self.assertEqual(task.get('alwayson_scripts'), self.meta['alwayson_scripts'])
+        # 已解析的值缓存在任务中，序列化时仍保留引用
+        self.assertEqual(task['init_img'], self.image)
+        self.assertTrue(is_payload_ref(json.loads(task.json())['init_img']))
+        # 落库的数据展开引用
+        with mock.patch.object(payload, '_store', self.store):
+            self.assertEqual(task.to_dict(), dict(self.meta, create_at=task.create_at))
+        task['init_img'] = 'x'
+        self.assertEqual(task['init_img'], 'x')
+
+    def test_disabled_by_default(self):
+        with mock.patch.dict('os.environ', {'PAYLOAD_INLINE_LIMIT': '1024'}, clear=True), \
+                mock.patch.object(payload, '_store', None):
+            # 未配置共享存储时不替换
+            self.assertEqual(offload_payload(self.meta), self.meta)
+        with mock.patch.dict('os.environ', {}, clear=True), mock.patch.object(payload, '_store', self.store):
+            self.assertEqual(offload_payload(self.meta), self.meta)
+
+    @unittest.skipIf(Img2ImgTask is None, 'webui dependencies not installed')
+    def test_img2img_from_task(self):
+        meta = dict(self.meta, base_model_path='m.safetensors', negative_prompt='', mode=0)
+        meta = offload_payload(meta, self.store, 1024)
+        task = Task.from_json_str(json.dumps(meta))
+        with mock.patch.object(payload, '_store', self.store), \
+                mock.patch.object(Img2ImgTask, '__init__', return_value=None) as init:
+            Img2ImgTask.from_task(task, [])
+        args, kwargs = init.call_args
+        # 传给处理类的参数为展开后的值，不含引用记录字段
+        self.assertEqual(kwargs['init_img'], self.image)
+        self.assertEqual(kwargs['alwayson_scripts'], self.meta['alwayson_scripts'])
+        self.assertNotIn(PayloadKeysField, kwargs)
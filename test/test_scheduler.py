@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/11 5:02 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : test_scheduler.py
+# @Software: xingzhe.ai
+import unittest
+from worker.queue_registry import QueueStat
+from worker.scheduler import CostBasedPolicy, AffinityFirstPolicy
+
+
+class TestSchedulePolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000 * 1000
+        self.loaded = ['aaaaaaaaaa', 'bbbbbbbbbb']
+        self.local = {'cccccccccc'}
+
+    def _stat(self, name, wait_seconds, depth=1):
+        return QueueStat('task_' + name, depth, self.now - wait_seconds * 1000)
+
+    def test_affinity_first(self):
+        policy = AffinityFirstPolicy(lambda: self.loaded)
+        stats = [self._stat('dddddddddd', 30), self._stat('others', 20), self._stat('aaaaaaaaaa', 1)]
+        self.assertEqual(policy.order(stats, self.now), ['task_aaaaaaaaaa', 'task_others', 'task_dddddddddd'])
+
+    def test_switch_cost_order(self):
+        policy = CostBasedPolicy(lambda: self.loaded, self.local)
+        stats = [self._stat('dddddddddd', 10), self._stat('cccccccccc', 10),
+                 self._stat('aaaaaaaaaa', 10), self._stat('bbbbbbbbbb', 10)]
+        # 当前模型 > 内存中的模型 > 本地磁盘 > 需要下载
+        self.assertEqual(policy.order(stats, self.now),
+                         ['task_bbbbbbbbbb', 'task_aaaaaaaaaa', 'task_cccccccccc', 'task_dddddddddd'])
+        # 等待时间足够长时抵消切换代价
+        stats[2] = self._stat('aaaaaaaaaa', 200)
+        self.assertEqual(policy.order(stats, self.now)[0], 'task_aaaaaaaaaa')
+
+    def test_starvation_bound(self):
+        policy = CostBasedPolicy(lambda: self.loaded, self.local, starvation_seconds=60)
+        stats = [self._stat('dddddddddd', 61), self._stat('aaaaaaaaaa', 1)]
+        self.assertEqual(policy.order(stats, self.now)[0], 'task_dddddddddd')
+        # 当前模型的队列还有任务时不切换
+        stats.append(self._stat('bbbbbbbbbb', 1))
+        self.assertEqual(policy.order(stats, self.now)[0], 'task_bbbbbbbbbb')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/20 11:30 AM
+# @Author  : wangdongming
+# @Site    :
+# @File    : test_sweeper.py
+# @Software: xingzhe.ai
+import time
+import unittest
+import fakeredis
+import mongomock
+from worker.sweeper import TaskTimeoutSweeper, TaskSweeperReportKey
+
+
+class TestTaskTimeoutSweeper(unittest.TestCase):
+
+    def setUp(self):
+        self.collect = mongomock.MongoClient().db.tasks
+        self.rds = fakeredis.FakeRedis()
+        self.now = int(time.time())
+        docs = []
+        for i in range(25):
+            docs.append({'task_id': f'old-{i}', 'status': 0, 'task': {'create_at': self.now - 3600 * 20}})
+        docs.append({'task_id': 'new', 'status': 0, 'task': {'create_at': self.now - 60}})
+        docs.append({'task_id': 'done', 'status': 2, 'task': {'create_at': self.now - 3600 * 20}})
+        self.collect.insert_many(docs)
+
+    def sweeper(self, worker_id, **kwargs):
+        sweeper = TaskTimeoutSweeper(self.collect, worker_id, batch_size=10, **kwargs)
+        sweeper.ensure_index()
+        return sweeper
+
+    def test_sweep(self):
+        self.assertEqual(self.sweeper('w1').sweep(self.now), 25)
+        self.assertEqual(self.collect.count_documents({'status': -1}), 25)
+        self.assertEqual(self.collect.find_one({'task_id': 'new'})['status'], 0)
+        self.assertEqual(self.collect.find_one({'task_id': 'done'})['status'], 2)
+        # 批次数受限
+        self.collect.update_many({}, {'$set': {'status': 0}})
+        self.assertEqual(self.sweeper('w1', max_batches=2).sweep(self.now), 20)
+
+    def test_leader(self):
+        w1, w2 = self.sweeper('w1'), self.sweeper('w2')
+        self.assertEqual(w1.run(self.rds, self.now), 25)
+        self.assertIsNone(w2.run(self.rds, self.now))
+        self.assertEqual(self.rds.hget(TaskSweeperReportKey, 'count'), b'25')
+        self.assertEqual(self.rds.hget(TaskSweeperReportKey, 'worker'), b'w1')
+        # 本地检查间隔内不再竞争锁
+        self.rds.flushall()
+        self.assertIsNone(w2.run(self.rds, self.now + 1))
+        self.assertEqual(w2.run(self.rds, self.now + 61), 0)
@@ -52,12 +52,36 @@ Env_TaskGroupQueueOnly = "WORKER_GROUP_QUEUE_ONLY"
 Env_WorkerRunTrainRatio = "RUN_TRAIN_RATIO"
 # 不开启定期清除未使用模型文件
 Env_DontCleanModels = "DONT_CLEAN_MODELS"
+# 模型缓存各类别预算（GB），如 checkpoint=200,lora=30,embedding=1,vae=10，未配置时按磁盘容量比例
+Env_ModelCacheBudgets = "MODEL_CACHE_BUDGETS"
 # 谛听审核APP KEY
 Env_DtAppKey = "DT_APPKEY"
 # 下载启用文件锁
 Env_DownloadLocker = "DOWNLOAD_LOCKER"
+# 分片下载并发连接数
+Env_DownloadConnections = "DOWNLOAD_CONNECTIONS"
+# 分片下载跳过 HTTPS 证书校验（1-跳过），默认校验
+Env_DownloadInsecure = "DOWNLOAD_INSECURE"
+# 节点级模型缓存目录（同节点 POD 共享的 hostPath），不配置时不启用
+Env_NodeModelCacheDir = "NODE_MODEL_CACHE_DIR"
+# 存储客户端连接池大小，默认为分片下载连接数 + 上传线程数
+Env_StoragePoolSize = "STORAGE_POOL_SIZE"
 # 维护模式key
 Env_Maintain = "MAINTAIN"
+# 预取任务数（执行当前任务时提前领取并准备的任务数，0-不预取）
+Env_TaskLookahead = "TASK_LOOKAHEAD"
+Env_PreviewInterval = "PREVIEW_INTERVAL"
+# 任务 META 中超过该大小（字节）的字符串存入 payload store，0-不启用（默认）；
+# 还需配置 PAYLOAD_REMOTE_PREFIX 或 PAYLOAD_STORE_DIR 之一才会启用
+Env_PayloadInlineLimit = "PAYLOAD_INLINE_LIMIT"
+# payload 本地目录：只配置该项时为生产者与 worker 共享的存储目录，配置了对象存储时为节点缓存目录
+Env_PayloadStoreDir = "PAYLOAD_STORE_DIR"
+# payload 对象存储路径前缀
+Env_PayloadRemotePrefix = "PAYLOAD_REMOTE_PREFIX"
+# 缩略图（LOW）编码格式：JPEG/WEBP/AVIF
+Env_LowImageFormat = "LOW_IMAGE_FORMAT"
+# 结果图先写入本地文件再上传（调试用），默认在内存中编码后直接上传
+Env_OutputToDisk = "OUTPUT_TO_DISK"
 
 cache = {}
 
@@ -68,6 +92,37 @@ def enable_download_locker():
     return v == "1"
 
 
+def get_download_connections():
+    try:
+        v = int(os.getenv(Env_DownloadConnections, 8))
+    except:
+        v = 8
+    return min(max(v, 1), 32)
+
+
+def download_verify_tls():
+    return os.getenv(Env_DownloadInsecure, '0') != '1'
+
+
+def get_storage_pool_size():
+    try:
+        return int(os.getenv(Env_StoragePoolSize, 0)) or get_download_connections() + 8
+    except:
+        return get_download_connections() + 8
+
+
+def get_low_image_format():
+    return (os.getenv(Env_LowImageFormat) or 'JPEG').upper()
+
+
+def output_to_disk():
+    return os.getenv(Env_OutputToDisk, '0') == '1'
+
+
+def get_node_model_cache_dir():
+    return os.getenv(Env_NodeModelCacheDir)
+
+
 def is_flexible_worker():
     return os.getenv(Env_Flexible_Res_Token, "") != ""
 
@@ -88,6 +143,29 @@ def mongo_doc_expire_seconds():
     return exp
 
 
+def get_task_lookahead():
+    try:
+        v = int(os.getenv(Env_TaskLookahead, 1))
+    except:
+        v = 1
+    return min(max(v, 0), 2)
+
+
+def get_preview_interval():
+    # 实时预览图最小间隔（秒），小于等于0不生成预览图
+    try:
+        return float(os.getenv(Env_PreviewInterval, 2))
+    except:
+        return 2
+
+
+def get_payload_inline_limit():
+    try:
+        return int(os.getenv(Env_PayloadInlineLimit, 0))
+    except:
+        return 0
+
+
 def run_train_ratio():
     v = os.getenv(Env_WorkerRunTrainRatio, 0.8)
     v = float(v)
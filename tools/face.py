@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/25 4:30 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : face.py
+# @Software: xingzhe.ai
+import hashlib
+import os
+import threading
+import typing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from loguru import logger
+
+# 检测用图片最长边（dlib 正脸检测窗口 80px，upsample=1 时可检出缩小图中约 40px 以上的人脸）
+FaceDetectMaxSide = 512
+FaceDetectWorkers = 4
+FaceCacheSize = 1024
+
+# 人脸框（原图坐标）：left, top, right, bottom
+FaceBox = typing.Tuple[int, int, int, int]
+ImageSource = typing.Union[str, Image.Image]
+
+
+def _load_dlib_detector():
+    import dlib
+    return dlib.get_frontal_face_detector()
+
+
+class FaceDetector:
+    '''
+    人脸检测（输出图多人脸审核）：检测器按线程加载一次后复用（dlib 检测器对象非线程安全），
+    在长边缩小到 max_side 的灰度图上检测并将坐标还原到原图，同一任务的多张图片在线程池中并行，
+    结果按缩小后图片内容哈希缓存。
+    '''
+
+    def __init__(self, max_side: int = FaceDetectMaxSide, workers: int = FaceDetectWorkers,
+                 cache_size: int = FaceCacheSize, upsample: int = 1,
+                 loader: typing.Callable[[], typing.Any] = _load_dlib_detector):
+        self.max_side = max_side
+        self.workers = workers
+        self.cache_size = cache_size
+        self.upsample = upsample
+        self._loader = loader
+        self._local = threading.local()
+        self._cache = OrderedDict()
+        self._locker = threading.Lock()
+        self._pool = None
+
+    @property
+    def detector(self):
+        detector = getattr(self._local, 'detector', None)
+        if detector is None:
+            detector = self._local.detector = self._loader()
+        return detector
+
+    def _prepare(self, image: ImageSource) -> typing.Tuple[np.ndarray, float]:
+        if isinstance(image, str):
+            with Image.open(image) as im:
+                size = im.size
+                # JPEG 解码时直接缩小
+                im.draft('L', (self.max_side, self.max_side))
+                gray = im.convert('L')
+        else:
+            size = image.size
+            gray = image.convert('L')
+        w, h = size
+        scale = min(1.0, self.max_side / max(w, h))
+        if scale < 1:
+            gray = gray.resize((max(round(w * scale), 1), max(round(h * scale), 1)), Image.BILINEAR)
+        return np.asarray(gray), w / gray.width
+
+    def detect(self, image: ImageSource) -> typing.List[FaceBox]:
+        '''
+        检测人脸，返回原图坐标的人脸框。
+        '''
+        gray, ratio = self._prepare(image)
+        key = f'{gray.shape}:{hashlib.blake2b(gray.tobytes(), digest_size=16).hexdigest()}'
+        with self._locker:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        rects = self.detector(gray, self.upsample)
+        boxes = [(round(r.left() * ratio), round(r.top() * ratio), round(r.right() * ratio), round(r.bottom() * ratio))
+                 for r in rects]
+        with self._locker:
+            self._cache[key] = boxes
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return boxes
+
+    def count(self, image: ImageSource) -> int:
+        faces = len(self.detect(image))
+        if isinstance(image, str):
+            logger.debug(f"image face detector:{faces},{os.path.basename(image)}")
+        return faces
+
+    def batch_count(self, images: typing.Sequence[ImageSource]) -> typing.List[int]:
+        '''
+        并行检测多张图片，按输入顺序返回人脸数。
+        '''
+        if len(images) <= 1:
+            return [self.count(image) for image in images]
+        with self._locker:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='face-detect')
+        return list(self._pool.map(self.count, images))
+
+    def close(self):
+        with self._locker:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+
+face_detector = FaceDetector()
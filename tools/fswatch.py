@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/22 2:30 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : fswatch.py
+# @Software: xingzhe.ai
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+import typing
+
+# inotify 事件（linux/inotify.h）
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_event_header = struct.Struct('iIII')
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1, libc.inotify_add_watch
+            _libc = libc
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc
+
+
+class FileWaiter:
+    '''
+    等待文件出现（创建、写入完成或被 rename 到目标路径）：
+    Linux 使用 inotify 监听所在目录，事件到达时立即唤醒；不支持时退化为指数退避轮询（最长 1 秒）。
+    '''
+
+    def __init__(self, path: str, use_inotify: bool = True):
+        self.path = os.path.abspath(path)
+        self.dirname, self.basename = os.path.split(self.path)
+        self._fd = None
+        self._poll_interval = 0.05
+        if use_inotify:
+            self._init_inotify()
+
+    def _init_inotify(self):
+        libc = _load_libc()
+        if not libc or not os.path.isdir(self.dirname):
+            return
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(fd, self.dirname.encode(), mask) < 0:
+            os.close(fd)
+            return
+        self._fd = fd
+
+    @property
+    def inotify(self) -> bool:
+        return self._fd is not None
+
+    def _read_events(self) -> typing.List[str]:
+        names = []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset + _event_header.size <= len(data):
+            _, _, _, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            names.append(data[offset:offset + length].rstrip(b'\0').decode('utf8', 'ignore'))
+            offset += length
+        return names
+
+    def wait(self, timeout: float) -> bool:
+        '''
+        等待目标文件相关事件，返回是否收到事件（轮询模式下返回文件是否存在）。
+        '''
+        if self._fd is None:
+            time.sleep(max(min(self._poll_interval, timeout), 0))
+            self._poll_interval = min(self._poll_interval * 2, 1)
+            return os.path.isfile(self.path)
+        deadline = time.time() + max(timeout, 0)
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([self._fd], [], [], remaining)
+            if readable and self.basename in self._read_events():
+                return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -11,6 +11,7 @@ import shutil
 from io import BytesIO
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
+from tools.environment import get_low_image_format
 
 Image.MAX_IMAGE_PIXELS = 933120000
 
@@ -30,45 +31,135 @@ def encode_pil_to_base64(image, quality=50):
         return 'data:image/png;base64,' + base64.b64encode(bytes_data).decode('ascii')
 
 
+# 预览图边长及采样块大小（JPEG MCU 的整数倍），用于估算压缩质量
+PreviewSide = 256
+PreviewTile = 64
+# 可输出的压缩格式
+CompressFormats = ('JPEG', 'WEBP', 'AVIF')
+
+
+def _encode(im: Image.Image, format: str, quality: int) -> bytes:
+    with BytesIO() as out:
+        im.save(out, format=format, quality=quality)
+        return out.getvalue()
+
+
+def _search_quality(im: Image.Image, format: str, budget: float, low: int, high: int) -> int:
+    # 二分查找编码大小不超过 budget 的最高质量（最高质量满足时只编码一次）
+    if len(_encode(im, format, high)) <= budget:
+        return high
+    best, high = low, high - 1
+    while low <= high:
+        mid = (low + high) // 2
+        if len(_encode(im, format, mid)) <= budget:
+            best, low = mid, mid + 1
+        else:
+            high = mid - 1
+    return best
+
+
+def _sample_preview(im: Image.Image) -> Image.Image:
+    # 从原图均匀截取原分辨率小块拼接为预览图：缩放会丢失高频细节导致低估编码大小
+    n = PreviewSide // PreviewTile
+    w, h = im.size
+    preview = Image.new(im.mode, (n * PreviewTile, n * PreviewTile))
+    for i in range(n):
+        for j in range(n):
+            x = (w - PreviewTile) * i // (n - 1)
+            y = (h - PreviewTile) * j // (n - 1)
+            tile = im.crop((x, y, x + PreviewTile, y + PreviewTile))
+            preview.paste(tile, (i * PreviewTile, j * PreviewTile))
+    return preview
+
+
+def support_format(format: str) -> bool:
+    format = format.upper()
+    Image.init()
+    if format == 'AVIF' and format not in Image.SAVE:
+        try:
+            # Pillow < 11.2 需要 pillow-avif-plugin
+            import pillow_avif
+        except ImportError:
+            return False
+    return format in Image.SAVE
+
+
+def encode_to_size(im: Image.Image, kb: float, format: str = 'JPEG', quality: int = 70,
+                   min_quality: int = 10) -> bytes:
+    """不改变图片尺寸压缩到指定大小（内存中完成）
+    在原图采样拼接的预览图上二分查找质量（编码大小按像素数折算），再对原图编码一次；
+    超出目标时按实际与预估大小的比例修正后再编码一次，仍超出时使用最低质量。
+    :param im: 源图片
+    :param kb: 压缩目标，KB
+    :param format: 输出格式，JPEG/WEBP/AVIF
+    :param quality: 最高质量
+    :param min_quality: 最低质量
+    :return: 压缩后字节
+    """
+    format = format.upper()
+    if im.mode not in ('RGB', 'L'):
+        im = im.convert('RGB')  # 兼容处理png和jpg
+    target = kb * 1024
+    w, h = im.size
+    if w * h <= PreviewSide * PreviewSide * 2 or min(w, h) < PreviewTile:
+        return _encode(im, format, _search_quality(im, format, target, min_quality, quality))
+
+    preview = _sample_preview(im)
+    ratio = w * h / (preview.width * preview.height)
+    budget = target / ratio
+    for _ in range(2):
+        q = _search_quality(preview, format, budget, min_quality, quality)
+        data = _encode(im, format, q)
+        if len(data) <= target or q <= min_quality:
+            return data
+        # 预览图细节密度与原图不同，按实际大小修正预算（留 3% 余量）
+        budget = budget * target / len(data) * 0.97
+    return _encode(im, format, min_quality)
+
+
+def _low_image_format(format: str = None) -> str:
+    format = (format or get_low_image_format()).upper()
+    if format not in CompressFormats or not support_format(format):
+        format = 'JPEG'
+    return format
+
+
+def compress_image_content(data: bytes, kb=300, quality=70, format=None, image: Image.Image = None) -> bytes:
+    """内存中不改变图片尺寸压缩到指定大小
+    :param data: 源图片编码后的字节
+    :param kb: 压缩目标，KB，源图片不超过时原样返回
+    :param quality: 最高压缩质量
+    :param format: 输出格式，默认读取环境变量 LOW_IMAGE_FORMAT（JPEG）
+    :param image: 已解码的源图片，不为空时不再解码 data
+    :return: 压缩后字节
+    """
+    if len(data) / 1024 <= kb:
+        return data
+    if image is not None:
+        return encode_to_size(image, kb, _low_image_format(format), quality)
+    with Image.open(BytesIO(data)) as im:
+        return encode_to_size(im, kb, _low_image_format(format), quality)
+
+
 # compress_image 压缩图片函数，减轻网络压力
-def compress_image(infile, outfile, kb=300, step=30, quality=70):
+def compress_image(infile, outfile, kb=300, step=30, quality=70, format=None):
     """不改变图片尺寸压缩到指定大小
     :param infile: 压缩源文件
     :param outfile: 输出路径。
     :param kb: 压缩目标，KB
-    :param step: 每次调整的压缩比率
-    :param quality: 初始压缩比率
-    :return: 压缩文件字节流
+    :param step: 已废弃，保留兼容（原按该步长逐次降低质量全图重编码）
+    :param quality: 最高压缩质量
+    :param format: 输出格式，默认读取环境变量 LOW_IMAGE_FORMAT（JPEG）
     """
-    o_size = os.path.getsize(infile) / 1024
-    # print(f'  > 原始大小：{o_size}')
-    if o_size <= kb:
+    if os.path.getsize(infile) / 1024 <= kb:
         # 大小满足要求
         shutil.copy(infile, outfile)
+        return
 
-    pnginfo_data = PngInfo()
-    im = Image.open(infile)
-    if hasattr(im, "text"):
-        for k, v in im.text.items():
-            pnginfo_data.add_text(k, str(v))
-
-    im = im.convert("RGB")  # 兼容处理png和jpg
-    img_bytes = None
-
-    while o_size > kb:
-        out = BytesIO()
-        im.save(out, format="JPEG", quality=quality, pnginfo=pnginfo_data)
-        if quality - step < 0:
-            break
-        img_bytes = out.getvalue()
-        o_size = len(img_bytes) / 1024
-        out.close()  # 销毁对象
-        quality -= step  # 质量递减
-    if img_bytes:
-        with open(outfile, "wb+") as f:
-            f.write(img_bytes)
-    else:
-        shutil.copy(infile, outfile)
+    with Image.open(infile) as im:
+        data = encode_to_size(im, kb, _low_image_format(format), quality)
+    with open(outfile, "wb+") as f:
+        f.write(data)
 
 
 def thumbnail(infile, outfile, scale=0.4, w=0, h=0, quality=70):
@@ -78,6 +78,11 @@ class MongoClient(object):
             res = self.collect.update_one(query, data, upsert)
         return res
 
+    def bulk_update(self, operations, ordered=False):
+        if not operations:
+            return
+        return self.collect.bulk_write(operations, ordered=ordered)
+
     def insert(self, data):
         query = self._get_query(data)
         exist = self.collect.find_one(query)
@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/21 10:20 AM
+# @Author  : wangdongming
+# @Site    :
+# @File    : model_cache.py
+# @Software: xingzhe.ai
+import atexit
+import heapq
+import os
+import re
+import sqlite3
+import threading
+import time
+import typing
+from collections import Counter
+from contextlib import contextmanager, closing
+from loguru import logger
+from tools.disk import get_free_space_mb
+from tools.environment import Env_ModelCacheBudgets, Env_DontCleanModels
+
+# 模型类别 -> 目录，user-models 为用户上传的模型，只索引不清理
+ModelCacheDirs = {
+    'checkpoint': ['models/Stable-diffusion'],
+    'lora': ['models/Lora', 'models/LyCORIS'],
+    'embedding': ['embeddings'],
+    'vae': ['models/VAE'],
+}
+UserModelCacheDirs = {
+    'checkpoint': ['user-models/Stable-diffusion'],
+    'lora': ['user-models/Lora', 'user-models/LyCORIS'],
+    'embedding': ['embendings'],
+}
+# 默认预算：占模型目录所在磁盘容量的比例，没有预算的类别（embedding、vae）默认不清理，
+# 需要时通过 MODEL_CACHE_BUDGETS 配置
+ModelCacheBudgetRatio = {
+    'checkpoint': 0.5,
+    'lora': 0.15,
+}
+# 磁盘剩余空间低于该比例时，按超出预算比例最多的类别继续清理
+ModelCacheMinFreeRatio = 0.1
+ModelCacheDBPath = os.path.join('models', 'model-cache.db')
+# 不清理的模型
+ModelCacheKeepFiles = {'v1-5-pruned-emaonly.safetensors'}
+# 下载中的临时文件
+_ignore_suffixes = ('.part', '.part.json', '.tmp', '.lock', '.db', '.db-journal')
+_hash_name = re.compile(r'^[0-9a-fA-F]{64}$')
+# 下载时记录哈希的模型文件
+HashedExtensions = ('.safetensors', '.ckpt', '.pt', '.pth', '.bin')
+
+
+class CacheEntry:
+    __slots__ = ('path', 'category', 'size', 'atime', 'digest', 'pins', 'evictable')
+
+    def __init__(self, path: str, category: str, size: int, atime: float, digest: str = None,
+                 evictable: bool = True):
+        self.path = path
+        self.category = category
+        self.size = size
+        self.atime = atime
+        self.digest = digest
+        self.pins = 0
+        self.evictable = evictable
+
+
+def parse_budgets(value: str) -> typing.Dict[str, int]:
+    '''
+    解析预算配置，如 "checkpoint=200,lora=30"（单位 GB）。
+    '''
+    budgets = {}
+    for item in (value or '').split(','):
+        if '=' not in item:
+            continue
+        k, v = item.split('=', 1)
+        try:
+            budgets[k.strip().lower()] = int(float(v) * 1024 ** 3)
+        except ValueError:
+            logger.warning(f"invalid model cache budget:{item}")
+    return budgets
+
+
+class ModelCache:
+    '''
+    本地模型缓存：索引模型目录下的文件（内容哈希、大小、最近访问时间），
+    访问记录保存在内存中并定期写入 SQLite，按类别字节预算做 LRU 清理（最小堆，单次 O(log n)）。
+    任务使用或预取中的模型被 pin，不会被清理。
+    '''
+
+    def __init__(self, root: str = '.', db_path: str = ModelCacheDBPath,
+                 budgets: typing.Mapping[str, int] = None, flush_interval: int = 60):
+        self.root = root
+        self.db_path = os.path.join(root, db_path)
+        self.flush_interval = flush_interval
+        self._budgets = dict(budgets) if budgets is not None else None
+        self._entries = {}
+        self._digests = {}
+        self._heaps = dict((c, []) for c in ModelCacheDirs)
+        self._bytes = dict((c, 0) for c in ModelCacheDirs)
+        self._owners = {}
+        self._dirty = set()
+        self._deleted = set()
+        self._locker = threading.RLock()
+        # 数据库写入按快照顺序进行，不占用索引锁
+        self._db_locker = threading.Lock()
+        self._local = threading.local()
+        self._loaded = False
+        self._flush_time = time.time()
+        self._dir_categories = []
+        # (st_dev, st_ino) -> (size, mtime_ns, sha256, addnet)
+        self._hashes = None
+
+    # ---------------- 索引 ----------------
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.execute('CREATE TABLE IF NOT EXISTS models (path TEXT PRIMARY KEY, category TEXT, '
+                     'size INTEGER, atime REAL, digest TEXT)')
+        conn.execute('CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, '
+                     'sha256 TEXT, addnet TEXT, PRIMARY KEY (dev, ino))')
+        return conn
+
+    @contextmanager
+    def _db(self):
+        # sqlite3 连接的 with 只提交或回滚，不会关闭连接
+        with closing(self._connect()) as conn:
+            with conn:
+                yield conn
+
+    def _norm(self, path: str) -> str:
+        return os.path.abspath(path if os.path.isabs(path) else os.path.join(self.root, path))
+
+    def _category(self, path: str) -> typing.Tuple[typing.Optional[str], bool]:
+        for d, category, evictable in self._dir_categories:
+            if path.startswith(d + os.sep):
+                return category, evictable
+        return None, False
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.scan()
+
+    def scan(self):
+        '''
+        对比数据库与模型目录：新文件加入索引（首次使用文件 atime 作为访问时间），不存在的文件移出索引。
+        '''
+        with self._locker:
+            # 先写入未保存的访问记录
+            self.flush()
+            self._loaded = True
+            self._dir_categories = []
+            for dirs, evictable in ((ModelCacheDirs, True), (UserModelCacheDirs, False)):
+                for category, items in dirs.items():
+                    for d in items:
+                        self._dir_categories.append((self._norm(d), category, evictable))
+            known = {}
+            try:
+                with self._db() as conn:
+                    for path, category, size, atime, digest in conn.execute(
+                            'SELECT path, category, size, atime, digest FROM models'):
+                        known[path] = (size, atime, digest)
+            except sqlite3.Error:
+                logger.exception('cannot load model cache db')
+            seen = set()
+            for d, category, evictable in self._dir_categories:
+                if not os.path.isdir(d):
+                    continue
+                for dirpath, _, filenames in os.walk(d):
+                    for name in filenames:
+                        if name.endswith(_ignore_suffixes):
+                            continue
+                        path = os.path.join(dirpath, name)
+                        try:
+                            st = os.stat(path)
+                        except OSError:
+                            continue
+                        seen.add(path)
+                        size, atime, digest = known.get(path, (st.st_size, st.st_atime, None))
+                        if path not in known:
+                            self._dirty.add(path)
+                        self._add(CacheEntry(path, category, st.st_size, atime, digest, evictable))
+            for path in set(known) - seen:
+                self._deleted.add(path)
+            for path in list(self._entries):
+                if path not in seen:
+                    self._remove_entry(path)
+            self.flush()
+            logger.info(f"[model cache] indexed {len(self._entries)} files, bytes:{self._bytes}")
+
+    def _add(self, entry: CacheEntry):
+        old = self._entries.get(entry.path)
+        if old:
+            entry.pins = old.pins
+            self._remove_entry(entry.path)
+        if not entry.digest:
+            name, _ = os.path.splitext(os.path.basename(entry.path))
+            if _hash_name.match(name):
+                entry.digest = name.lower()
+        if os.path.basename(entry.path) in ModelCacheKeepFiles:
+            entry.evictable = False
+        self._entries[entry.path] = entry
+        if entry.digest:
+            self._digests[entry.digest] = entry.path
+        if entry.evictable:
+            self._bytes[entry.category] += entry.size
+            heapq.heappush(self._heaps[entry.category], (entry.atime, entry.path))
+
+    def _remove_entry(self, path: str) -> typing.Optional[CacheEntry]:
+        entry = self._entries.pop(path, None)
+        if entry:
+            if entry.evictable:
+                self._bytes[entry.category] -= entry.size
+            if entry.digest and self._digests.get(entry.digest) == path:
+                del self._digests[entry.digest]
+        return entry
+
+    def lookup(self, digest: str) -> typing.Optional[str]:
+        '''
+        按内容哈希查找本地文件。
+        '''
+        with self._locker:
+            self._ensure_loaded()
+            path = self._digests.get(digest.lower())
+            if path and os.path.isfile(path):
+                return path
+
+    # ---------------- 文件哈希 ----------------
+
+    def _load_hashes(self):
+        if self._hashes is None:
+            self._hashes = {}
+            try:
+                with self._db() as conn:
+                    for dev, ino, size, mtime, sha256, addnet in conn.execute(
+                            'SELECT dev, ino, size, mtime, sha256, addnet FROM hashes'):
+                        self._hashes[(dev, ino)] = (size, mtime, sha256, addnet)
+            except sqlite3.Error:
+                logger.exception('cannot load model hashes')
+
+    def record_hash(self, path: str, sha256: str, addnet: str = None):
+        '''
+        记录下载时计算的模型文件哈希。按 inode 记录（rename、硬链接后仍有效），文件大小或修改时间变化后失效。
+        '''
+        if not sha256 or not path.lower().endswith(HashedExtensions):
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        with self._locker:
+            self._load_hashes()
+            self._hashes[(st.st_dev, st.st_ino)] = (st.st_size, st.st_mtime_ns, sha256, addnet)
+        try:
+            with self._db() as conn:
+                conn.execute('INSERT OR REPLACE INTO hashes (dev, ino, size, mtime, sha256, addnet) '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, sha256, addnet))
+        except sqlite3.Error:
+            logger.exception('cannot write model hash')
+        self.touch(path, digest=sha256)
+
+    def file_hash(self, path: str, addnet: bool = False) -> typing.Optional[str]:
+        '''
+        查询已记录的文件哈希（addnet=True 时返回 safetensors 的 addnet 哈希），没有记录或文件已修改时返回 None。
+        '''
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self._locker:
+            self._load_hashes()
+            item = self._hashes.get((st.st_dev, st.st_ino))
+        if not item or item[0] != st.st_size or item[1] != st.st_mtime_ns:
+            return None
+        return item[3] if addnet else item[2]
+
+    # ---------------- 访问记录 ----------------
+
+    def touch(self, *paths: str, digest: str = None):
+        '''
+        记录模型访问（替代 touch 命令修改 atime），当前线程持有任务时同时 pin。
+        '''
+        owner = getattr(self._local, 'owner', None)
+        now = time.time()
+        with self._locker:
+            self._ensure_loaded()
+            for p in paths:
+                if not p:
+                    continue
+                path = self._norm(p)
+                entry = self._entries.get(path)
+                if entry is None:
+                    category, evictable = self._category(path)
+                    if not category or not os.path.isfile(path):
+                        continue
+                    entry = CacheEntry(path, category, os.path.getsize(path), now, digest, evictable)
+                    self._add(entry)
+                else:
+                    entry.atime = now
+                    if digest and not entry.digest:
+                        entry.digest = digest
+                        self._digests[digest] = path
+                    if entry.evictable:
+                        heapq.heappush(self._heaps[entry.category], (now, path))
+                self._dirty.add(path)
+                if owner:
+                    self._pin(owner, path)
+            need_flush = now - self._flush_time > self.flush_interval
+            if need_flush:
+                self._flush_time = now
+        # 在锁外写入数据库，不阻塞其他线程的模型访问
+        if need_flush:
+            self.flush()
+
+    def _pin(self, owner: str, path: str):
+        paths = self._owners.setdefault(owner, set())
+        entry = self._entries.get(path)
+        if entry and path not in paths:
+            paths.add(path)
+            entry.pins += 1
+
+    def pin(self, owner: str, *paths: str):
+        self._local.owner, prev = owner, getattr(self._local, 'owner', None)
+        try:
+            self.touch(*paths)
+        finally:
+            self._local.owner = prev
+
+    def release(self, owner: str):
+        with self._locker:
+            for path in self._owners.pop(owner, ()):
+                entry = self._entries.get(path)
+                if entry:
+                    entry.pins -= 1
+
+    @contextmanager
+    def holding(self, owner: str):
+        '''
+        上下文内当前线程访问的模型都 pin 到 owner（任务ID），任务结束后调用 release。
+        '''
+        prev = getattr(self._local, 'owner', None)
+        self._local.owner = owner
+        try:
+            yield
+        finally:
+            self._local.owner = prev
+
+    # ---------------- 清理 ----------------
+
+    def budgets(self) -> typing.Dict[str, int]:
+        if self._budgets is None:
+            budgets = {}
+            try:
+                st = os.statvfs(os.path.join(self.root, 'models'))
+                total = st.f_blocks * st.f_frsize
+                budgets = dict((c, int(total * r)) for c, r in ModelCacheBudgetRatio.items())
+            except (OSError, AttributeError):
+                pass
+            budgets.update(parse_budgets(os.getenv(Env_ModelCacheBudgets)))
+            self._budgets = budgets
+        return self._budgets
+
+    def usage(self) -> typing.Dict[str, int]:
+        with self._locker:
+            self._ensure_loaded()
+            return dict(self._bytes)
+
+    def _pop_lru(self, category: str) -> typing.Optional[CacheEntry]:
+        heap, skipped, entry = self._heaps[category], [], None
+        while heap:
+            atime, path = heapq.heappop(heap)
+            e = self._entries.get(path)
+            # 过期的堆节点（已被删除或再次访问）直接丢弃
+            if e is None or not e.evictable or e.atime != atime:
+                continue
+            if e.pins > 0:
+                skipped.append((atime, path))
+                continue
+            entry = e
+            break
+        for item in skipped:
+            heapq.heappush(heap, item)
+        return entry
+
+    def _evict_one(self, category: str) -> int:
+        entry = self._pop_lru(category)
+        if not entry:
+            return 0
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logger.exception(f'cannot remove model:{entry.path}')
+            return 0
+        self._remove_entry(entry.path)
+        self._deleted.add(entry.path)
+        logger.info(f"[model cache] evict {entry.path}, size:{entry.size // 1024 // 1024}MB")
+        return entry.size or 1
+
+    def evict(self, max_files: int = 10) -> int:
+        '''
+        增量清理：每次最多删除 max_files 个文件，返回释放的字节数。
+        '''
+        freed, count = 0, 0
+        with self._locker:
+            self._ensure_loaded()
+            budgets = self.budgets()
+            for category in ModelCacheDirs:
+                budget = budgets.get(category)
+                while budget is not None and self._bytes[category] > budget and count < max_files:
+                    n = self._evict_one(category)
+                    if not n:
+                        break
+                    freed, count = freed + n, count + 1
+            # 磁盘空间不足时继续清理超出预算比例最多的类别（只清理有预算的类别）
+            while count < max_files and self._low_disk():
+                candidates = sorted((c for c in ModelCacheDirs if budgets.get(c) is not None),
+                                    key=lambda c: -self._bytes[c] / max(budgets[c], 1))
+                n = 0
+                for category in candidates:
+                    n = self._evict_one(category)
+                    if n:
+                        break
+                if not n:
+                    break
+                freed, count = freed + n, count + 1
+            self._compact()
+        self.flush()
+        return freed
+
+    def _low_disk(self) -> bool:
+        try:
+            folder = os.path.join(self.root, 'models')
+            st = os.statvfs(folder)
+            total = st.f_blocks * st.f_frsize / 1024 / 1024
+            return get_free_space_mb(folder) < total * ModelCacheMinFreeRatio
+        except (OSError, AttributeError):
+            return False
+
+    def _compact(self):
+        # 频繁访问会在堆中留下过期节点，超过该类别文件数的 4 倍时重建
+        counts = Counter(e.category for e in self._entries.values() if e.evictable)
+        for category, heap in self._heaps.items():
+            if len(heap) > 64 and len(heap) > 4 * counts[category]:
+                self._heaps[category] = [(e.atime, e.path) for e in self._entries.values()
+                                         if e.category == category and e.evictable]
+                heapq.heapify(self._heaps[category])
+
+    def tidy(self) -> int:
+        if os.getenv(Env_DontCleanModels):
+            return 0
+        freed = self.evict()
+        if freed:
+            logger.info(f"[model cache] release {freed // 1024 // 1024}MB, usage:{self._bytes}")
+        return freed
+
+    # ---------------- 持久化 ----------------
+
+    def flush(self):
+        '''
+        在索引锁内取出待写入的记录，锁外写入数据库。
+        '''
+        with self._db_locker:
+            with self._locker:
+                self._flush_time = time.time()
+                if not self._dirty and not self._deleted:
+                    return
+                rows = [(e.path, e.category, e.size, e.atime, e.digest)
+                        for e in (self._entries.get(p) for p in self._dirty) if e]
+                deleted = [(p,) for p in self._deleted]
+                self._dirty, self._deleted = set(), set()
+            try:
+                with self._db() as conn:
+                    conn.executemany('INSERT OR REPLACE INTO models (path, category, size, atime, digest) '
+                                     'VALUES (?, ?, ?, ?, ?)', rows)
+                    conn.executemany('DELETE FROM models WHERE path = ?', deleted)
+            except sqlite3.Error:
+                logger.exception('cannot write model cache db')
+
+
+model_cache = ModelCache()
+atexit.register(model_cache.flush)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/18 3:12 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : serialize.py
+# @Software: xingzhe.ai
+import json
+import typing
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _default(obj):
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, (set, tuple)):
+        return list(obj)
+    raise TypeError(f'Type is not JSON serializable: {type(obj).__name__}')
+
+
+def dumps(obj: typing.Any) -> str:
+    '''
+    JSON 序列化，优先使用 orjson（比标准库快数倍），支持 to_dict 对象。
+    '''
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS).decode('utf8')
+    return json.dumps(obj, default=_default)
+
+
+def loads(data: typing.Union[str, bytes]) -> typing.Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def packb(obj: typing.Any) -> bytes:
+    '''
+    二进制序列化：安装 msgpack 时使用 msgpack，否则为 JSON 的 UTF8 字节。
+    '''
+    if msgpack is not None:
+        return msgpack.packb(obj, default=_default, use_bin_type=True)
+    return dumps(obj).encode('utf8')
+
+
+def unpackb(data: bytes) -> typing.Any:
+    if msgpack is not None:
+        return msgpack.unpackb(data, raw=False)
+    return loads(data)
@@ -15,7 +15,7 @@ from tools import TempDir as Tmp
 from datetime import datetime
 from insightface.app import FaceAnalysis
 from tools.environment import S3Tmp, S3SDWEB, enable_download_locker
-from filestorage import FileStorageCls, get_local_path, batch_download, http_down
+from filestorage import get_storage, get_local_path, batch_download, http_down
 
 
 class ModelType(IntEnum):
@@ -89,7 +89,7 @@ def upload_files(is_tmp, *files, dirname=None, task_id=None):
     if files:
         date = datetime.today().strftime('%Y/%m/%d')
 
-        file_storage_system = FileStorageCls()
+        file_storage_system = get_storage()
         relative = S3Tmp if is_tmp else S3SDWEB
         if dirname:
             relative = os.path.join(relative, dirname)
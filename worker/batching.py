@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/12 10:08 AM
+# @Author  : wangdongming
+# @Site    :
+# @File    : batching.py
+# @Software: xingzhe.ai
+import typing
+from collections import UserList
+from .task import Task
+
+# 合批时等待兼容任务的最长时间（秒）
+BatchWaitSeconds = 0.3
+# 合批轮询间隔（秒）
+BatchPollInterval = 0.05
+
+
+class BatchSpec(typing.NamedTuple):
+    '''
+    合批规则：fields 中的字段全部相同的任务可以合并执行，合并后的图片总数不超过 max_images。
+    '''
+    fields: typing.Sequence[str]
+    max_images: int
+    wait: float = BatchWaitSeconds
+
+
+class TaskBatch(UserList):
+    '''
+    合并执行的一组任务，第一个为领取到的首个任务。
+    '''
+
+    @property
+    def leader(self) -> Task:
+        return self.data[0]
+
+    @property
+    def id(self):
+        return ','.join(t.id for t in self.data)
+
+    def desc(self) -> str:
+        return f'batch:[{", ".join(t.desc() for t in self.data)}]'
+
+
+def task_images(task: typing.Mapping) -> int:
+    try:
+        return max(int(task.get('batch_size') or 1), 1) * max(int(task.get('n_iter') or 1), 1)
+    except (TypeError, ValueError):
+        return 1
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/4 10:12 AM
+# @Author  : wangdongming
+# @Site    :
+# @File    : claim.py
+# @Software: xingzhe.ai
+import json
+import time
+import typing
+from .queue_registry import QueueRegistry, RefreshRegistryLua
+from .lease import TaskLeaseManager, TaskWorkerKeyPrefix, TaskDataLua, task_meta
+from .semaphore import DistributedSemaphore, AcquirePermitLua, TrainPermitKeyPrefix
+
+SDWorkerZset = 'sd-workers'
+# 训练任务用户并发满额时延后的时间（ms），延后期间任务不会被扫描到
+TrainRetryDelay = 15 * 1000
+
+# 原子领取任务：
+# 1. 按分数从小到大扫描至多 scan 个已到期任务；
+# 2. 跳过超出 worker 分数上限的任务（留给其他 worker）；
+# 3. 训练任务获取用户并发许可（按任务过期的信号量），满额则延后任务分数，不阻塞领取；
+# 4. ZREM + 写入 task:worker:<id> + 创建租约（租约信息只记录 queue/score/worker），返回 {task_id, score, meta}；
+# 5. 同步刷新队列注册表（队首分数、队列长度）。
+# 整个过程在 REDIS 服务端一次执行完成，不需要分布式锁。
+# KEYS: 队列, 注册表, 长度表, 租约, 租约信息（任务 META、归属、并发许可键由任务ID拼接，不在 KEYS 中）
+ClaimTaskScript = """
+local queue = KEYS[1]
+local registry = KEYS[2]
+local depth = KEYS[3]
+local leases = KEYS[4]
+local lease_info = KEYS[5]
+""" + RefreshRegistryLua + AcquirePermitLua + TaskDataLua + """
+local max_score = ARGV[1]
+local worker_id = ARGV[2]
+local owner_ttl = tonumber(ARGV[3])
+local score_limit = tonumber(ARGV[4])
+local scan = tonumber(ARGV[5])
+local now = tonumber(ARGV[6])
+local retry_delay = tonumber(ARGV[7])
+local owner_prefix = ARGV[8]
+local permit_prefix = ARGV[9]
+local lease_ttl = tonumber(ARGV[10])
+local now_ms = tonumber(ARGV[11])
+
+local values = redis.call('ZRANGEBYSCORE', queue, '-inf', max_score, 'WITHSCORES', 'LIMIT', 0, scan)
+for i = 1, #values, 2 do
+    local task_id = values[i]
+    local score = values[i + 1]
+    local skip = false
+
+    if score_limit > 0 then
+        local s = string.match(task_id, '^[^_]*_(%-?%d+)$')
+        if s and tonumber(s) > score_limit then
+            skip = true
+        end
+    end
+
+    if not skip then
+        local meta = redis.call('GET', task_id)
+        if not meta then
+            -- META 已过期，任务无法执行，直接出队
+            redis.call('ZREM', queue, task_id)
+            skip = true
+        elseif string.find(meta, '"paralle_count"', 1, true) then
+            local ok, t = pcall(cjson.decode, meta)
+            if ok and type(t) == 'table' then
+                t = task_data(t)
+            end
+            local limit = ok and type(t) == 'table' and tonumber(t['paralle_count']) or 0
+            if limit > 0 and tonumber(t['task_type']) == 4 and type(t['user_id']) == 'string' then
+                if not acquire_permit(permit_prefix .. t['user_id'], task_id, limit, now_ms, lease_ttl) then
+                    -- 满额：延后任务，之后的扫描不再命中
+                    redis.call('ZADD', queue, math.max(tonumber(score), now_ms) + retry_delay, task_id)
+                    skip = true
+                end
+            end
+        end
+
+        if not skip then
+            redis.call('ZREM', queue, task_id)
+            redis.call('SET', owner_prefix .. task_id, worker_id, 'EX', owner_ttl)
+            redis.call('ZADD', leases, now * 1000 + lease_ttl, task_id)
+            redis.call('HSET', lease_info, task_id, cjson.encode({queue = queue, score = score, worker = worker_id}))
+            refresh_registry(queue)
+            return {task_id, score, meta}
+        end
+    end
+end
+refresh_registry(queue)
+return false
+"""
+
+
+# 领取与首个任务兼容的任务（合批执行）：
+# 兼容键由 ARGV 中的字段列表计算，首个任务与候选任务使用同一函数，保证比较结果一致；
+# 不兼容的任务留在队列中，合计图片数超过上限时停止。
+# KEYS: 同 ClaimTaskScript
+# ARGV: 最高分数, worker id, 归属过期时间, 分数上限, 扫描数量, 当前时间（秒）, 归属键前缀, 租约时长（ms）,
+#       首个任务META, 图片数上限, 字段...
+ClaimBatchScript = """
+local queue = KEYS[1]
+local registry = KEYS[2]
+local depth = KEYS[3]
+local leases = KEYS[4]
+local lease_info = KEYS[5]
+""" + RefreshRegistryLua + TaskDataLua + """
+local max_score = ARGV[1]
+local worker_id = ARGV[2]
+local owner_ttl = tonumber(ARGV[3])
+local score_limit = tonumber(ARGV[4])
+local scan = tonumber(ARGV[5])
+local now = tonumber(ARGV[6])
+local owner_prefix = ARGV[7]
+local lease_ttl = tonumber(ARGV[8])
+local budget = tonumber(ARGV[10])
+
+local function batch_key(t)
+    local parts = {}
+    for i = 11, #ARGV do
+        local v = t[ARGV[i]]
+        if type(v) == 'table' then
+            v = cjson.encode(v)
+        end
+        table.insert(parts, tostring(v))
+    end
+    return table.concat(parts, '\\1')
+end
+
+local ok, leader = pcall(cjson.decode, ARGV[9])
+if not ok or type(leader) ~= 'table' then
+    return {}
+end
+local key = batch_key(leader)
+
+local result = {}
+local values = redis.call('ZRANGEBYSCORE', queue, '-inf', max_score, 'WITHSCORES', 'LIMIT', 0, scan)
+for i = 1, #values, 2 do
+    if budget <= 0 then
+        break
+    end
+    local task_id = values[i]
+    local score = values[i + 1]
+    local skip = false
+    if score_limit > 0 then
+        local s = string.match(task_id, '^[^_]*_(%-?%d+)$')
+        if s and tonumber(s) > score_limit then
+            skip = true
+        end
+    end
+    if not skip then
+        local meta = redis.call('GET', task_id)
+        if not meta then
+            redis.call('ZREM', queue, task_id)
+        else
+            local ok, t = pcall(cjson.decode, meta)
+            if ok and type(t) == 'table' then
+                t = task_data(t)
+            end
+            if ok and type(t) == 'table' and batch_key(t) == key then
+                local images = math.max(tonumber(t['batch_size']) or 1, 1)
+                if images <= budget then
+                    budget = budget - images
+                    redis.call('ZREM', queue, task_id)
+                    redis.call('SET', owner_prefix .. task_id, worker_id, 'EX', owner_ttl)
+                    redis.call('ZADD', leases, now * 1000 + lease_ttl, task_id)
+                    redis.call('HSET', lease_info, task_id, cjson.encode({queue = queue, score = score, worker = worker_id}))
+                    table.insert(result, {task_id, score, meta})
+                end
+            end
+        end
+    end
+end
+refresh_registry(queue)
+return result
+"""
+
+
+class ClaimedTask(typing.NamedTuple):
+    task_id: str
+    score: float
+    meta: str
+
+
+def _decode(v):
+    return v.decode('utf8') if isinstance(v, bytes) else v
+
+
+class TaskClaimer:
+    '''
+    基于 LUA 脚本的任务领取器，一次 REDIS 调用完成“出队-读取META-记录归属”。
+    不支持 REDIS CLUSTER：脚本按任务ID访问了 KEYS 以外的键（任务 META、归属、训练并发许可），
+    这些键与队列不保证在同一个 slot。
+    '''
+
+    def __init__(self, worker_id: str, score_limit: int = -1, scan_size: int = 8,
+                 owner_ttl: int = 2 * 3600, leases: TaskLeaseManager = None):
+        self.worker_id = worker_id
+        self.score_limit = score_limit
+        self.scan_size = scan_size
+        self.owner_ttl = owner_ttl
+        self.registry = QueueRegistry()
+        self.leases = leases or TaskLeaseManager()
+        # 训练任务用户并发许可，与租约同时长、同周期续期
+        self.permits = DistributedSemaphore(TrainPermitKeyPrefix, self.leases.ttl)
+        self._script = None
+        self._batch_script = None
+
+    def _get_script(self, rds):
+        if self._script is None:
+            self._script = rds.register_script(ClaimTaskScript)
+        return self._script
+
+    def claim(self, rds, queue_name: str, now_ms: int = None) -> typing.Optional[ClaimedTask]:
+        now_ms = now_ms or int(time.time() * 1000)
+        # 当前时间（ms）+ 偏移量1秒 之前的任务都可以执行
+        max_score = now_ms + 1000
+        script = self._get_script(rds)
+        r = script(keys=[queue_name, self.registry.registry_key, self.registry.depth_key,
+                         self.leases.lease_key, self.leases.info_key],
+                   args=[max_score, self.worker_id, self.owner_ttl, self.score_limit, self.scan_size,
+                         now_ms // 1000, TrainRetryDelay, self.leases.owner_prefix, self.permits.prefix,
+                         self.leases.ttl * 1000, now_ms],
+                   client=rds)
+        if not r:
+            return None
+        task_id, score, meta = r
+        claimed = ClaimedTask(_decode(task_id), float(score), task_meta(_decode(meta)))
+        self._hold_permit(claimed)
+        return claimed
+
+    def _hold_permit(self, claimed: ClaimedTask):
+        # 脚本中已获取许可的训练任务，由当前 worker 续期和释放
+        if '"paralle_count"' not in claimed.meta:
+            return
+        try:
+            t = json.loads(claimed.meta)
+            limit = int(t.get('paralle_count') or 0)
+            task_type = int(t.get('task_type') or 0)
+        except (ValueError, TypeError):
+            return
+        if task_type == 4 and limit > 0 and isinstance(t.get('user_id'), str):
+            self.permits.hold(t['user_id'], claimed.task_id)
+
+    def claim_batch(self, rds, queue_name: str, leader_meta: str, fields: typing.Sequence[str],
+                    max_images: int, scan_size: int = 32, now_ms: int = None) -> typing.List[ClaimedTask]:
+        '''
+        领取队列中与 leader_meta 在 fields 上完全相同的任务，合计图片数不超过 max_images。
+        '''
+        if max_images <= 0 or not fields:
+            return []
+        if self._batch_script is None:
+            self._batch_script = rds.register_script(ClaimBatchScript)
+        now_ms = now_ms or int(time.time() * 1000)
+        r = self._batch_script(keys=[queue_name, self.registry.registry_key, self.registry.depth_key,
+                                     self.leases.lease_key, self.leases.info_key],
+                               args=[now_ms + 1000, self.worker_id, self.owner_ttl, self.score_limit, scan_size,
+                                     now_ms // 1000, self.leases.owner_prefix, self.leases.ttl * 1000,
+                                     leader_meta, max_images, *fields],
+                               client=rds)
+        return [ClaimedTask(_decode(task_id), float(score), task_meta(_decode(meta)))
+                for task_id, score, meta in r or []]
+
+    def release(self, rds, claimed: ClaimedTask, queue_name: str):
+        '''
+        归还已领取的任务（原分数重新入队）。
+        '''
+        self.leases.complete(rds, claimed.task_id)
+        self.registry.push(rds, queue_name, claimed.task_id, claimed.score)
+        rds.delete(self.leases.owner_prefix + claimed.task_id)
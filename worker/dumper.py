@@ -6,18 +6,20 @@
 # @File    : dumper.py
 # @Software: Hifive
 import abc
-import json
 import os.path
-import queue
 import time
 import typing
 from loguru import logger
-from threading import Thread
+from pymongo import UpdateOne
+from collections import OrderedDict
+from threading import Thread, Condition, Lock
 from datetime import datetime
+from tools import serialize
 from tools.mgo import MongoClient
 from tools.host import get_host_ip
 from tools.redis import RedisPool
 from worker.task import TaskProgress
+from worker.sweeper import TaskTimeoutSweeper
 from tools.environment import pod_host, mongo_doc_expire_seconds
 from modules.shared import cmd_opts
 
@@ -51,8 +53,200 @@ class DumpInfo:
                 self.set,
                 **self.kwargs
             )
+            return True
         except:
             logger.exception("cannot update data.")
+            return False
+
+    def to_operation(self) -> UpdateOne:
+        return UpdateOne(self.query, self.set, upsert=self.kwargs.get('upsert', True))
+
+
+class DumperMetrics:
+    '''
+    写库统计：写入批次大小、耗时，被合并（覆盖）的中间进度数。
+    '''
+
+    def __init__(self):
+        self.flushes = 0
+        self.docs = 0
+        self.max_flush_size = 0
+        self.total_latency = 0
+        self.max_latency = 0
+        self.coalesced = 0
+        self.evicted = 0
+        self.failed = 0
+        self._locker = Lock()
+
+    def record_flush(self, size: int, latency: float, failed: int = 0):
+        with self._locker:
+            self.flushes += 1
+            self.docs += size
+            self.failed += failed
+            self.max_flush_size = max(self.max_flush_size, size)
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def record_drop(self, coalesced: int = 0, evicted: int = 0):
+        with self._locker:
+            self.coalesced += coalesced
+            self.evicted += evicted
+
+    def snapshot(self) -> typing.Dict[str, float]:
+        with self._locker:
+            return {
+                'flushes': self.flushes,
+                'docs': self.docs,
+                'avg_flush_size': self.docs / self.flushes if self.flushes else 0,
+                'max_flush_size': self.max_flush_size,
+                'avg_latency_ms': self.total_latency / self.flushes * 1000 if self.flushes else 0,
+                'max_latency_ms': self.max_latency * 1000,
+                'coalesced': self.coalesced,
+                'evicted': self.evicted,
+                'failed': self.failed,
+            }
+
+
+class CoalescingBuffer:
+    '''
+    按任务合并的写库缓冲区：同一任务只保留最新进度，写入不阻塞。
+    超出容量时丢弃最早的中间进度，终态（完成、失败）不会被丢弃。
+    '''
+
+    def __init__(self, capacity: int = 1000, metrics: DumperMetrics = None):
+        self.capacity = capacity
+        self.metrics = metrics or DumperMetrics()
+        self._items = OrderedDict()
+        self._terminal = set()
+        # 最近进入终态的任务，之后到达的中间进度直接丢弃
+        self._finished = OrderedDict()
+        self._cond = Condition(Lock())
+        self._urgent = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, info: DumpInfo, terminal: bool = False):
+        with self._cond:
+            key = info.id
+            # 终态之后到达的中间进度（上传线程与执行线程乱序）不覆盖终态
+            if not terminal and key in self._finished:
+                self.metrics.record_drop(coalesced=1)
+                return
+            if key in self._items:
+                self.metrics.record_drop(coalesced=1)
+            elif len(self._items) >= self.capacity:
+                self._evict()
+            self._items[key] = info
+            if terminal:
+                self._terminal.add(key)
+                self._finished[key] = True
+                if len(self._finished) > self.capacity:
+                    self._finished.popitem(last=False)
+                self._urgent = True
+                self._cond.notify_all()
+            elif len(self._items) >= self.capacity:
+                self._cond.notify_all()
+
+    def _evict(self):
+        for key in self._items:
+            if key not in self._terminal:
+                self._items.pop(key)
+                self.metrics.record_drop(evicted=1)
+                return
+
+    def wait(self, timeout: float, min_size: int) -> bool:
+        '''
+        等待终态进度或缓冲数量达到 min_size，返回是否需要立即写入。
+        '''
+        with self._cond:
+            if not self._urgent and len(self._items) < min_size:
+                self._cond.wait(timeout)
+            return self._urgent or len(self._items) >= min_size
+
+    def wakeup(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def drain(self) -> typing.List[DumpInfo]:
+        with self._cond:
+            items = list(self._items.values())
+            self._items = OrderedDict()
+            self._terminal = set()
+            self._urgent = False
+            return items
+
+
+# 任务进度增量：STREAM，每个任务一个，客户端 XREAD BLOCK 订阅
+TaskProgressStreamPrefix = 'task-progress:'
+# 任务预览图：预览图单独存放，增量中只带引用
+TaskPreviewKeyPrefix = 'task-preview:'
+ProgressCacheExpire = 1200
+ProgressStreamMaxLen = 100
+
+
+class ProgressCache:
+    '''
+    REDIS 进度缓存：每次进度只发布变化的字段（状态、进度、预计时间、预览图引用）到任务的 STREAM，
+    完整快照（task_id 键）仅在状态变化时写入；写入在 dumper 线程通过 PIPELINE 批量执行。
+    '''
+
+    def __init__(self):
+        self._locker = Lock()
+        # 任务ID -> 待写入的增量、预览图、快照
+        self._pending = OrderedDict()
+        # 任务ID -> 最近一次发布的字段
+        self._published = OrderedDict()
+
+    def put(self, task_id: str, data: typing.Mapping[str, typing.Any], terminal: bool = False):
+        preview = data.get('preview')
+        fields = {
+            'status': data.get('status'),
+            'progress': data.get('task_progress'),
+            'eta': data.get('eta_relative'),
+            'desc': data.get('task_desc'),
+            'preview': hash(preview) if preview else None,
+        }
+        with self._locker:
+            last = self._published.get(task_id) or {}
+            # 终态之后到达的中间进度不再发布
+            if last.get('terminal') and not terminal:
+                return
+            delta = dict((k, v) for k, v in fields.items() if v is not None and last.get(k) != v)
+            if not delta:
+                return
+            fields['terminal'] = terminal
+            self._published[task_id] = fields
+            self._published.move_to_end(task_id)
+            if len(self._published) > 1000:
+                self._published.popitem(last=False)
+
+            item = self._pending.setdefault(task_id, {'delta': {}, 'preview': None, 'snapshot': None})
+            if 'preview' in delta:
+                item['preview'] = preview
+                delta['preview'] = TaskPreviewKeyPrefix + task_id
+            item['delta'].update(delta)
+            if 'status' in delta or terminal:
+                item['snapshot'] = dict((k, v) for k, v in data.items() if k != 'preview' and
+                                        not isinstance(v, datetime))
+
+    def flush(self, rds) -> int:
+        with self._locker:
+            pending, self._pending = self._pending, OrderedDict()
+        if not pending:
+            return 0
+        pipe = rds.pipeline(transaction=False)
+        for task_id, item in pending.items():
+            if item['preview']:
+                pipe.set(TaskPreviewKeyPrefix + task_id, item['preview'], ProgressCacheExpire)
+            if item['snapshot'] is not None:
+                pipe.set(task_id, serialize.dumps(item['snapshot']), ProgressCacheExpire)
+            stream = TaskProgressStreamPrefix + task_id
+            pipe.xadd(stream, dict((k, serialize.dumps(v)) for k, v in item['delta'].items()),
+                      maxlen=ProgressStreamMaxLen, approximate=True)
+            pipe.expire(stream, ProgressCacheExpire)
+        pipe.execute()
+        return len(pending)
 
 
 class AsyncTaskDumper(Thread):
@@ -70,90 +264,71 @@ class AsyncTaskDumper(Thread):
         super(AsyncTaskDumper, self).__init__(name='task-dumper')
         self.db = db
         self.ip = pod_host() or get_host_ip()
+        # 中间进度最长延迟写入时间（秒），终态立即写入
         self.send_delay = 10
-        self.queue = queue.Queue(maxsize=100)
+        # 缓冲任务数达到该值时立即写入
+        self.flush_size = 50
+        self.metrics = DumperMetrics()
+        self.buffer = CoalescingBuffer(metrics=self.metrics)
+        # 进度缓存写入间隔（秒）
+        self.cache_interval = 0.5
+        self.progress_cache = ProgressCache()
         self._stop_flag = False
-        self._dump_now = False
         self._last_dump_time = 0
         self.redis_pool = RedisPool()
 
-    def _set_cache(self, info: DumpInfo):
+    def flush_cache(self):
         try:
             rds = self.redis_pool.get_connection()
-            data = dict(((k, v) for (k, v) in info.set['$set'].items() if not isinstance(v, datetime)))
-            rds.set(info.id.replace("task_id=", ""), json.dumps(data), 1200)
-        except Exception as err:
-            logger.exception('cannot write to redis')
-
-    def _get_queue_all(self):
-        infos = {}
-        while not self.queue.empty():
-            info = self.queue.get()
-            id = info.id
-            if info.id not in infos:
-                infos[id] = info
-            elif isinstance(info, DumpInfo) and isinstance(infos[id], DumpInfo)\
-                    and info.create_time > infos[id].create_time:
-                infos[id] = info
-            else:
-                # 先进先出
-                infos[id] = info
-
-        return infos
+            self.progress_cache.flush(rds)
+        except Exception:
+            logger.exception('cannot write progress to redis')
+
+    def flush(self):
+        infos = self.buffer.drain()
+        self._last_dump_time = time.time()
+        if not infos:
+            return
+        st = time.time()
+        failed = 0
+        if hasattr(self.db, 'bulk_update'):
+            # 一次无序批量写入，失败时逐条重试
+            try:
+                self.db.bulk_update([info.to_operation() for info in infos])
+            except Exception:
+                logger.exception(f"bulk update {len(infos)} docs failed, retry one by one.")
+                failed = sum(1 for info in infos if not info.update_db(self.db))
+        else:
+            failed = sum(1 for info in infos if not info.update_db(self.db))
+        self.metrics.record_flush(len(infos), time.time() - st, failed)
 
     def run(self) -> None:
-        counter = 0
+        last_report = time.time()
         while not self._stop_flag:
             try:
-                now = time.time()
-                if counter % 60 == 0:
-                    logger.info("dumper waiting db record.")
-                if counter > 120:
-                    counter = 0
-                if self._dump_now or now - self._last_dump_time > self.send_delay:
-                    self._last_dump_time = now
-                    if not self.queue.empty():
-                        array = self._get_queue_all()
-                        for info in array.values():
-                            info.update_db(self.db)
-                    self._dump_now = False
-                    counter = 0
-                time.sleep(1)
+                urgent = self.buffer.wait(self.cache_interval, self.flush_size)
+                self.flush_cache()
+                if urgent or time.time() - self._last_dump_time > self.send_delay:
+                    self.flush()
+                if time.time() - last_report > 60:
+                    last_report = time.time()
+                    logger.info(f"dumper metrics:{self.metrics.snapshot()}")
                 self.do_others()
             except:
                 logger.exception("unhandle err at dumper")
-            finally:
-                counter += 1
+        # 退出前写入剩余进度
+        try:
+            self.flush_cache()
+            self.flush()
+        except:
+            logger.exception("dumper flush on stop failed")
 
     def dump_task_progress(self, task_progress: TaskProgress):
-        # try:
-        #     v = task_progress.to_dict()
-        #     v.update(
-        #         {
-        #             "task_id": task_progress.task.id,
-        #             "ip": self.ip,
-        #             "latency": int(time.time()) - task_progress.task.create_at,
-        #         }
-        #     )
-        #     self.mgo.update(
-        #         {"task_id": v['task_id']},
-        #         {'$set': v},
-        #         multi=False
-        #     )
-        #     return 1
-        # except Exception:
-        #     loguru.logger.exception('dump task failed.')
-        #     return 0
-
         info = self.progress_to_info(task_progress)
         self.before_push_info(task_progress, info)
-        self.queue.put(info)
-        self._set_cache(info)
-        if not self._dump_now:
-            # 如果dump_now 已经是True,就不要覆盖
-            # self._dump_now = task_progress.status >= TaskStatus.Prepare \
-            #                  or task_progress.completed
-            self._dump_now = task_progress.completed
+        # 进度缓存由 dumper 线程批量写入 REDIS，不阻塞执行线程
+        self.progress_cache.put(task_progress.task.id, info.set['$set'], task_progress.completed)
+        self.buffer.put(info, task_progress.completed)
 
     @abc.abstractmethod
     def progress_to_info(self, task_progress: TaskProgress) -> DumpInfo:
@@ -167,6 +342,7 @@ class AsyncTaskDumper(Thread):
 
     def stop(self):
         self._stop_flag = True
+        self.buffer.wakeup()
 
 
 class AsyncMongoTaskDumper(AsyncTaskDumper):
@@ -200,8 +376,10 @@ class AsyncMongoTaskDumper(AsyncTaskDumper):
             image_cols.create_index([("update_at", 1), ('expireAfterSeconds', doc_exp//2)])
             mgo.collect.create_index([("update_at", 1), ('expireAfterSeconds', doc_exp)])
 
-        self.clean_time = 0
         super(AsyncMongoTaskDumper, self).__init__(mgo)
+        # 超时任务由获得 REDIS 锁的 WORKER 统一清理
+        self.sweeper = TaskTimeoutSweeper(mgo.collect, self.ip)
+        self.sweeper.ensure_index()
 
     def progress_to_info(self, task_progress: TaskProgress) -> DumpInfo:
         v = task_progress.to_dict()
@@ -227,24 +405,10 @@ class AsyncMongoTaskDumper(AsyncTaskDumper):
         self.clean_timeout()
 
     def clean_timeout(self):
-        now = int(time.time())
-        if now - self.clean_time > 3600:
-            tasks = self.db.collect.find({
-                'status': 0,
-                'task.create_at': {'$lt': now - 3600*18},
-            })
-            tasks = list(tasks)
-            for task in tasks:
-                task['status'] = -1
-                task['update_at'] = datetime.now()
-                task['task_desc'] = 'task timeout(auto clean).'
-                self.db.update(
-                    {"task_id": task['task_id']},
-                    {'$set': task},
-                    multi=False
-                )
-
-            self.clean_time = now
+        try:
+            self.sweeper.run(self.redis_pool.get_connection())
+        except Exception:
+            logger.exception('clean timeout tasks failed')
 
     def write_images(self, task_progress: TaskProgress):
         if task_progress.completed and task_progress.result:
@@ -376,7 +540,7 @@ class MongoTaskDumper:
         try:
             rds = self.redis_pool.get_connection()
             data = dict(((k, v) for (k, v) in info.set['$set'].items() if not isinstance(v, datetime)))
-            rds.set(info.id.replace("task_id=", ""), json.dumps(data), 1200)
+            rds.set(info.id.replace("task_id=", ""), serialize.dumps(data), 1200)
         except Exception as err:
             logger.exception('cannot write to redis')
 
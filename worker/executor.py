@@ -13,15 +13,21 @@ import typing
 from queue import Queue
 from loguru import logger
 from tools import safety_clean_tmp
-from tools.disk import tidy_model_caches
+from tools.model_cache import model_cache
+from filestorage.node_cache import get_node_cache
 from worker.task import Task, TaskProgress
-from modules.shared import mem_mon as vram_mon, models_path
+from worker.batching import TaskBatch, BatchSpec
+from worker.stager import TaskStager
+from worker.lease import TaskLeaseLost
+from worker.uploader import uploader
+from modules.shared import mem_mon as vram_mon
 from worker.handler import TaskHandler
 from modules.devices import torch_gc
+from modules.hashes import register_recorded_hash_hook
 from worker.task_recv import TaskReceiver, TaskTimeout
 from threading import Thread, Condition, Lock
 from tools.model_hist import CkptLoadRecorder
-from tools.environment import Env_DontCleanModels
+from tools.environment import get_task_lookahead
 from worker.k8s_health import write_healthy, system_exit, process_health
 
 
@@ -31,20 +37,31 @@ class TaskExecutor(Thread):
                  args=(), kwargs=None, *, daemon=None, train_only=False):
         self.recorder = ckpt_recorder
         self._handlers = {}
-        self.receiver = TaskReceiver(ckpt_recorder, train_only, self.can_exec_task, self.before_receive_task)
+        self.receiver = TaskReceiver(ckpt_recorder, train_only, self.can_exec_task, self.before_receive_task,
+                                     batch_spec=self.batch_spec)
         self.timeout = timeout if timeout > 0 else TaskTimeout
         self.__stop = False
         self.mutex = Lock()
         self.not_busy = Condition(self.mutex)
-        self.queue = Queue(1)  # 也可直接使用变量进行消息传递。。
+        # 预取：GPU执行当前任务时提前领取 lookahead 个任务，由 stager 在后台准备模型和图片
+        self.lookahead = 0 if train_only else get_task_lookahead()
+        self.stager = TaskStager(self.get_handler)
+        # 下载时已计算的模型哈希，加载模型时不再重新计算
+        register_recorded_hash_hook(model_cache.file_hash)
+        # 已领取、尚未完成推理的任务：任务（批次）ID -> (任务, 未完成推理的任务ID)
+        self._pending = {}
+        self.queue = Queue(self.lookahead + 1)
         name = name or 'task-executor'
         if train_only:
             logger.info("[executor] >>> run on train mode.")
         super(TaskExecutor, self).__init__(group, target, name, args, kwargs, daemon=daemon)
 
     def _close(self):
+        # 等待后台上传结束，最终进度写入后再关闭 handler
+        uploader.stop()
         for h in self._handlers.values():
             h.close()
+        self.stager.close()
         self.receiver.close()
 
     def stop(self):
@@ -54,6 +71,11 @@ class TaskExecutor(Thread):
         types = self._handlers.keys()
         return task.task_type in types
 
+    def batch_spec(self, task: Task) -> typing.Optional[BatchSpec]:
+        handler = self.get_handler(task)
+        if handler:
+            return handler.batch_spec(task)
+
     def add_handler(self, *handlers: TaskHandler):
         for handler in handlers:
             if not handler.enable:
@@ -66,24 +88,59 @@ class TaskExecutor(Thread):
     def error_handler(self, task: Task, ex: Exception):
         logger.error(f'exec task failed: {task.desc()}, ex: {ex}')
 
-    def nofity(self):
-        if getattr(self.not_busy, "value", 0) == 0:
-            return
+    def _add_pending(self, task: typing.Union[Task, TaskBatch]):
+        tasks = task if isinstance(task, TaskBatch) else [task]
+        with self.not_busy:
+            self._pending[task.id] = (task, set(t.id for t in tasks))
+
+    def _pending_limit(self) -> int:
+        # 训练任务独占GPU，执行期间不预取
+        for task, _ in self._pending.values():
+            for t in (task if isinstance(task, TaskBatch) else [task]):
+                if t.is_train:
+                    return 0
+        return self.lookahead
 
+    @property
+    def busy(self) -> bool:
+        return len(self._pending) > 0
+
+    def nofity(self, task_id: str = None, key: str = None):
+        '''
+        任务推理结束（不传参数则为全部任务），通知接收线程继续领取。
+        '''
+        done = []
         with self.not_busy:
-            self.not_busy.notify_all()
-            logger.debug("notify receiver ")
-            setattr(self.not_busy, "value", 0)
+            for k in list(self._pending.keys()):
+                if key is not None and k != key:
+                    continue
+                task, remaining = self._pending[k]
+                if task_id is not None:
+                    remaining.discard(task_id)
+                    if remaining:
+                        continue
+                self._pending.pop(k)
+                done.append(task)
+            if done:
+                self.not_busy.notify_all()
+                logger.debug("notify receiver ")
+        for task in done:
+            for t in (task if isinstance(task, TaskBatch) else [task]):
+                self.receiver.decr_train_concurrency(t)
 
     def task_progress(self, p: TaskProgress):
+        # 租约已被回收的任务放弃执行（终态进度除外），由 handler 中断执行
+        if not p.completed and self.receiver.lease_lost(p.task.id):
+            raise TaskLeaseLost(p.task.id)
         if p.pre_task_completed():
-            self.nofity()
+            self.nofity(p.task.id)
 
     def exec_task(self):
         write_healthy(True)
         handlers = [x.name for x in self._handlers.keys()]
         logger.info(f"executor start with:{','.join(handlers)}")
         while not self.__stop:
+            task = None
             try:
                 logger.info(f"====>>> start receive and execute task")
                 task = self.queue.get(timeout=10)
@@ -93,17 +150,37 @@ class TaskExecutor(Thread):
                 logger.info(f"====>>> receive task:{task. desc()}")
                 logger.info(f"====>>> model history:{self.recorder.history()}")
 
-                handler = self.get_handler(task)
-                if not handler:
-                    self.error_handler(task, Exception('can not found task handler'))
-                # 判断TASK超时。
-                if self._is_timeout(task):
-                    now = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time()))
-                    create_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(task.create_at))
-                    handler.set_failed(task, f'task time out(task create time:{create_time}, now:{now})')
-                    self.nofity()
-                    continue
-                handler(task, progress_callback=self.task_progress)
+                leader = task.leader if isinstance(task, TaskBatch) else task
+                try:
+                    # 等待预取完成（模型、图片已在本地）
+                    self.stager.wait(task)
+                    if isinstance(task, TaskBatch):
+                        with model_cache.holding(leader.id):
+                            self._exec_batch(task)
+                        continue
+
+                    if self.receiver.lease_lost(task.id):
+                        logger.warning(f"task:{task.id} lease lost before execution, abandon it.")
+                        continue
+                    handler = self.get_handler(task)
+                    if not handler:
+                        self.error_handler(task, Exception('can not found task handler'))
+                    # 判断TASK超时。
+                    if self._is_timeout(task):
+                        now = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time()))
+                        create_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(task.create_at))
+                        handler.set_failed(task, f'task time out(task create time:{create_time}, now:{now})')
+                        continue
+                    # 执行期间使用的模型不会被清理
+                    with model_cache.holding(leader.id):
+                        handler(task, progress_callback=self.task_progress)
+                finally:
+                    model_cache.release(leader.id)
+                    # 未使用的预读权重（失败、超时等）随任务结束释放
+                    self.stager.release(task)
+                    # 执行结束（含失败）且结果上传完成后释放租约，进程异常退出时租约过期后由其他worker重新入队
+                    self._complete_after_upload(task)
+                    self.nofity(key=task.id)
 
             except queue.Empty:
                 if random.randint(1, 10) < 3:
@@ -115,13 +192,43 @@ class TaskExecutor(Thread):
                 continue
             except Exception:
                 logger.exception("executor err")
-                self.nofity()
+                # 只通知出错的任务，其他已预取的任务仍持有训练并发许可
+                if task:
+                    self.nofity(key=task.id)
 
         logger.info('executor stopping...')
         write_healthy(False)
         self._close()
 
+    def _complete_after_upload(self, task: typing.Union[Task, TaskBatch]):
+        for t in (task if isinstance(task, TaskBatch) else [task]):
+            if isinstance(t, Task):
+                uploader.run_after(t.id, lambda x=t: self.receiver.complete_task(x))
+
+    def _exec_batch(self, batch: TaskBatch):
+        '''
+        合批执行，超时的任务单独标记失败，租约已丢失的任务跳过。
+        '''
+        handler = self.get_handler(batch.leader)
+        tasks = []
+        for task in batch:
+            if self.receiver.lease_lost(task.id):
+                logger.warning(f"task:{task.id} lease lost before execution, abandon it.")
+            elif self._is_timeout(task):
+                create_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(task.create_at))
+                handler.set_failed(task, f'task time out(task create time:{create_time})')
+            else:
+                tasks.append(task)
+        if len(tasks) > 1:
+            handler.do_batch(tasks, progress_callback=self.task_progress)
+        elif tasks:
+            handler(tasks[0], progress_callback=self.task_progress)
+
     def before_receive_task(self, *task_ids):
+        # 预取时GPU正在执行任务，显存占用不代表空闲状态，跳过检查
+        if self.busy:
+            return True
+
         def has_train_task():
             for id in task_ids:
                 if isinstance(id, bytes):
@@ -145,44 +252,62 @@ class TaskExecutor(Thread):
 
         return True
 
+    def _wait_not_busy(self, task) -> bool:
+        '''
+        未完成推理的任务数超过预取上限时等待。
+        '''
+        with self.not_busy:
+            while len(self._pending) > self._pending_limit() and not self.__stop:
+                logger.debug(f"====>>> waiting task:{task.id}, stop receive.")
+                try:
+                    timeout = 3600 * 16
+                    if not self.not_busy.wait(timeout=timeout):
+                        raise TimeoutError(f'wait task timeout:{timeout} seconds')
+                except Exception:
+                    free, total = vram_mon.cuda_mem_get_info()
+                    logger.exception("executor cannot require locker, quit...")
+                    self.receiver.close()
+                    system_exit(free, total, True)
+                    return False
+            # 有任务未完成推理时为预取，不领取训练任务
+            self.receiver.prefetching = len(self._pending) > 0
+        logger.debug(f"====>>> waiting task:{task.id}, begin receive.")
+        return True
+
     def _get_task(self):
         while self.is_alive() and not self.receiver.closed and not self.__stop:
-            with self.not_busy:
-                if not self.queue.full():
-                    try:
-                        for task in self.receiver.task_iter():
-                            if random.randint(1, 10) < 3:
-                                # 释放磁盘空间
-                                safety_clean_tmp()
-                                tidy_model_caches(models_path)
-                            logger.info(f"====>>> preload task:{task.id}")
-                            self.queue.put(task)
-                            logger.info(f"====>>> push task:{task.id}")
-                            if isinstance(task, Task):
-                                logger.debug(f"====>>> waiting task:{task.id}, stop receive.")
-                                setattr(self.not_busy, "value", 1)
-                                try:
-                                    timeout = 3600 * 16
-                                    self.not_busy.wait(timeout=timeout)
-                                    logger.info(f"====>>> acquire locker, time out:{timeout} seconds")
-                                except Exception as err:
-                                    free, total = vram_mon.cuda_mem_get_info()
-                                    logger.exception("executor cannot require locker, quit...")
-                                    self.receiver.close()
-                                    system_exit(free, total, True)
-                                    break
-                                self.receiver.decr_train_concurrency(task)
-                                logger.debug(f"====>>> waiting task:{task.id}, begin receive.")
-                    except Exception:
-                        logger.exception("receive task failed, restart app...")
-                        self.receiver.close()
-                        self.__stop = True
-                        system_exit(0, 0, True)
-                else:
-                    self.not_busy.wait()
+            try:
+                for task in self.receiver.task_iter():
+                    if random.randint(1, 10) < 3:
+                        # 释放磁盘空间
+                        safety_clean_tmp()
+                        model_cache.tidy()
+                        self._tidy_node_cache()
+                    logger.info(f"====>>> preload task:{task.id}")
+                    if isinstance(task, (Task, TaskBatch)):
+                        self._add_pending(task)
+                        self.stager.stage(task)
+                    self.queue.put(task)
+                    logger.info(f"====>>> push task:{task.id}")
+                    if isinstance(task, (Task, TaskBatch)) and not self._wait_not_busy(task):
+                        break
+            except Exception:
+                logger.exception("receive task failed, restart app...")
+                self.receiver.close()
+                self.__stop = True
+                system_exit(0, 0, True)
         logger.info("=======> task receiver quit!!!!!!")
         self.__stop = True
 
+    def _tidy_node_cache(self):
+        # 节点缓存中没有被模型目录链接的文件，超过本地模型预算总和时清理
+        node_cache = get_node_cache()
+        if node_cache:
+            try:
+                node_cache.tidy(sum(model_cache.budgets().values()))
+            except Exception:
+                logger.exception('tidy node cache failed')
+
     def _is_timeout(self, task: Task) -> bool:
         if task.create_at <= 0:
             return False
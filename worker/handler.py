@@ -16,6 +16,9 @@ from loguru import logger
 from modules.devices import torch_gc, get_cuda_device_string
 from worker.k8s_health import write_healthy, system_exit
 from worker.task import Task, TaskProgress, TaskStatus, TaskType
+from worker.batching import BatchSpec
+from worker.lease import TaskLeaseLost
+from worker.uploader import uploader
 
 
 class TaskHandler:
@@ -23,6 +26,8 @@ class TaskHandler:
     def __init__(self, task_type: TaskType):
         self.task_type = task_type
         self.enable = True
+        # 执行中的任务的进度回调（执行器检查租约、通知接收线程）
+        self._progress_callback = None
 
     def handle_task_type(self):
         return self.task_type
@@ -31,61 +36,131 @@ class TaskHandler:
     def _exec(self, task: Task) -> typing.Iterable[TaskProgress]:
         raise NotImplementedError
 
+    def _exec_batch(self, tasks: typing.Sequence[Task]) -> typing.Iterable[TaskProgress]:
+        '''
+        合批执行，默认逐个执行。支持合批的 handler 需要同时实现 batch_spec。
+        '''
+        for task in tasks:
+            yield from self._exec(task)
+
+    def batch_spec(self, task: Task) -> typing.Optional[BatchSpec]:
+        '''
+        任务的合批规则，返回None表示不合批。
+        '''
+        return None
+
+    def stage(self, task: Task):
+        '''
+        预取任务依赖的模型、图片（在后台线程中执行，不更新任务状态），默认不处理。
+        '''
+        pass
+
+    def unstage(self, task: Task):
+        '''
+        任务执行结束（含失败、超时）后释放预取时占用的内存，默认不处理。
+        '''
+        pass
+
     def _set_task_status(self, p: TaskProgress):
         logger.info(f">>> task:{p.task.desc()}, status:{p.status.name}, desc:{p.task_desc}")
 
+    def _report_progress(self, p: TaskProgress):
+        '''
+        执行过程中（如采样回调中）上报进度，与 yield 的进度一样先经过进度回调（租约已丢失时抛出 TaskLeaseLost）再写入。
+        '''
+        callback = getattr(self, '_progress_callback', None)
+        if callable(callback):
+            callback(p)
+        self._set_task_status(p)
+
     def do(self, task: Task, progress_callback=None):
         ok, msg = task.valid()
         if not ok:
             p = TaskProgress.new_failed(task, msg)
             self._set_task_status(p)
         else:
-            try:
-                p = TaskProgress.new_prepare(task, msg)
-                self._set_task_status(p)
-                for progress in self._exec(task):
-                    self._set_task_status(progress)
-                    if callable(progress_callback):
-                        progress_callback(progress)
-
-            except torch.cuda.OutOfMemoryError:
-                ok = torch_gc()
-                time.sleep(15)
-                logger.exception('CUDA out of memory')
-                free, total = vram_mon.cuda_mem_get_info()
-                logger.info(f'[VRAM] free: {free / 2 ** 30:.3f} GB, total: {total / 2 ** 30:.3f} GB')
-                p = TaskProgress.new_failed(
-                    task,
-                    'CUDA out of memory',
-                    f'CUDA out of memory and release, free: {free / 2 ** 30:.3f} GB, total: {total / 2 ** 30:.3f} GB')
-
+            p = TaskProgress.new_prepare(task, msg)
+            self._set_task_status(p)
+            self._run([task], self._exec(task), progress_callback)
+
+    def do_batch(self, tasks: typing.Sequence[Task], progress_callback=None):
+        valid_tasks = []
+        for task in tasks:
+            ok, msg = task.valid()
+            if not ok:
+                p = TaskProgress.new_failed(task, msg)
                 self._set_task_status(p)
-                progress_callback(p)
-                system_exit(free, total, coercive=not ok)
-            except RuntimeError as runtimeErr:
-                trace = traceback.format_exc()
-                msg = str(runtimeErr)
-                logger.exception('unhandle err')
-                p = TaskProgress.new_failed(task, msg, trace)
+            else:
+                p = TaskProgress.new_prepare(task, msg)
                 self._set_task_status(p)
-                progress_callback(p)
-                if not torch_gc():
-                    free, total = vram_mon.cuda_mem_get_info()
-                    system_exit(free, total, coercive=True)
-
-            except Exception as ex:
-                trace = traceback.format_exc()
-                msg = str(ex)
-                logger.exception('unhandle err')
+                valid_tasks.append(task)
+        if valid_tasks:
+            self._run(valid_tasks, self._exec_batch(valid_tasks), progress_callback)
+
+    def _run(self, tasks: typing.Sequence[Task], progresses: typing.Iterable[TaskProgress], progress_callback=None):
+        '''
+        执行并处理异常，异常时 tasks 中未完成的任务全部标记失败。
+        '''
+        finished = set()
+        self._progress_callback = progress_callback
+
+        def set_failed(msg: str, trace: str = None):
+            for task in tasks:
+                if task.id in finished:
+                    continue
                 p = TaskProgress.new_failed(task, msg, trace)
-
                 self._set_task_status(p)
-                progress_callback(p)
-                if not torch_gc():
-                    free, total = vram_mon.cuda_mem_get_info()
-                    system_exit(free, total, coercive=True)
-                if 'BrokenPipeError' in str(ex):
-                    pass
+                if callable(progress_callback):
+                    progress_callback(p)
+
+        try:
+            for progress in progresses:
+                # 先回调（租约已丢失时抛出 TaskLeaseLost），再写入进度，避免覆盖新 worker 的进度
+                if callable(progress_callback):
+                    progress_callback(progress)
+                self._set_task_status(progress)
+                if progress.completed:
+                    finished.add(progress.task.id)
+                if progress.upload_func:
+                    # 保存、上传、审核交给上传流水线，GPU继续执行后续任务，最终进度由上传线程写入
+                    uploader.submit(progress.task, progress.upload_func, self._set_task_status)
+                    finished.add(progress.task.id)
+
+        except TaskLeaseLost as lost:
+            # 任务已交给其他 worker，不再写入其进度；合批中的其他任务标记失败
+            logger.warning(f"abandon task:{lost.task_id}, lease lost.")
+            finished.add(lost.task_id)
+            set_failed(f'batch task:{lost.task_id} abandoned')
+        except torch.cuda.OutOfMemoryError:
+            ok = torch_gc()
+            time.sleep(15)
+            logger.exception('CUDA out of memory')
+            free, total = vram_mon.cuda_mem_get_info()
+            logger.info(f'[VRAM] free: {free / 2 ** 30:.3f} GB, total: {total / 2 ** 30:.3f} GB')
+            set_failed('CUDA out of memory',
+                       f'CUDA out of memory and release, free: {free / 2 ** 30:.3f} GB, total: {total / 2 ** 30:.3f} GB')
+            system_exit(free, total, coercive=not ok)
+        except RuntimeError as runtimeErr:
+            trace = traceback.format_exc()
+            msg = str(runtimeErr)
+            logger.exception('unhandle err')
+            set_failed(msg, trace)
+            if not torch_gc():
+                free, total = vram_mon.cuda_mem_get_info()
+                system_exit(free, total, coercive=True)
+
+        except Exception as ex:
+            trace = traceback.format_exc()
+            msg = str(ex)
+            logger.exception('unhandle err')
+            set_failed(msg, trace)
+            if not torch_gc():
+                free, total = vram_mon.cuda_mem_get_info()
+                system_exit(free, total, coercive=True)
+            if 'BrokenPipeError' in str(ex):
+                pass
+        finally:
+            self._progress_callback = None
 
     def close(self):
         pass
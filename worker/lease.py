@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/7 4:18 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : lease.py
+# @Software: xingzhe.ai
+import json
+import threading
+import time
+import typing
+from loguru import logger
+from .queue_registry import RefreshRegistryLua, TaskQueueRegistryKey, TaskQueueDepthKey
+from .wakeup import TaskWakeupChannelPrefix, TaskWakeupAnyChannel, PublishWakeupLua
+
+# 任务归属：task:worker:<任务ID> -> worker id
+TaskWorkerKeyPrefix = 'task:worker:'
+# 任务租约：ZSET，member为任务ID，score为租约到期时间（ms）
+TaskLeaseKey = 'task-leases'
+# 租约信息：HASH，任务ID -> {queue, score, worker}，只保存回收需要的字段；
+# 执行期间 <任务ID> 键会被进度快照覆盖，快照的 task 字段即任务数据，重新领取时从中取出（见 task_meta）
+TaskLeaseInfoKey = 'task-lease-info'
+# 任务因租约过期被重新入队的次数
+TaskLeaseRetryKeyPrefix = 'task:retries:'
+# 租约时长（秒），执行期间每 LeaseRenewInterval 秒续约一次
+LeaseTTL = 60
+LeaseRenewInterval = 15
+# 超过重试次数后不再入队
+LeaseMaxRetries = 2
+# 重新入队时恢复的任务数据过期时间（秒）
+LeaseTaskMetaExpire = 24 * 3600
+
+# 执行期间任务键被进度快照（TaskProgress.to_dict）覆盖，从快照的 task 字段取任务数据
+TaskDataLua = """
+local function task_data(t)
+    if type(t['task']) == 'table' and t['status'] ~= nil then
+        return t['task']
+    end
+    return t
+end
+"""
+
+# KEYS: 租约, 租约信息, 注册表, 长度表
+# ARGV: 当前时间（ms）, 最大重试次数, 单次处理数量, 入队通知频道前缀, 归属键前缀, 重试键前缀, 任务数据过期时间（秒）,
+#       公共通知频道
+ReapLeaseScript = """
+local leases = KEYS[1]
+local info = KEYS[2]
+local registry = KEYS[3]
+local depth = KEYS[4]
+""" + RefreshRegistryLua + PublishWakeupLua + """
+local now = ARGV[1]
+local max_retries = tonumber(ARGV[2])
+local wakeup_prefix = ARGV[4]
+local owner_prefix = ARGV[5]
+local retry_prefix = ARGV[6]
+local meta_expire = tonumber(ARGV[7])
+local any_channel = ARGV[8]
+
+local result = {}
+for _, task_id in ipairs(redis.call('ZRANGEBYSCORE', leases, '-inf', now, 'LIMIT', 0, tonumber(ARGV[3]))) do
+    redis.call('ZREM', leases, task_id)
+    local raw = redis.call('HGET', info, task_id)
+    redis.call('HDEL', info, task_id)
+    redis.call('DEL', owner_prefix .. task_id)
+    if raw then
+        local lease = cjson.decode(raw)
+        local meta = redis.call('GET', task_id)
+        local retry_key = retry_prefix .. task_id
+        local n = redis.call('INCR', retry_key)
+        redis.call('EXPIRE', retry_key, 24 * 3600)
+        if n <= max_retries then
+            -- 任务数据（或包含任务数据的进度快照）延长过期时间，以原始分数重新入队，不影响排队顺序
+            if meta then
+                redis.call('EXPIRE', task_id, meta_expire)
+            end
+            redis.call('ZADD', lease['queue'], lease['score'], task_id)
+            refresh_registry(lease['queue'])
+            publish_wakeup(wakeup_prefix, any_channel, lease['queue'])
+            table.insert(result, {task_id, lease['queue'], lease['worker'], 'requeue', meta})
+        else
+            redis.call('DEL', retry_key)
+            table.insert(result, {task_id, lease['queue'], lease['worker'], 'drop', meta})
+        end
+    end
+end
+return result
+"""
+
+
+class ExpiredLease(typing.NamedTuple):
+    task_id: str
+    queue_name: str
+    worker_id: str
+    requeued: bool
+    # 回收时的任务数据
+    meta: typing.Optional[str] = None
+
+
+class TaskLeaseLost(Exception):
+    '''
+    执行中的任务租约已被回收（任务已重新入队或丢弃），当前 worker 放弃执行。
+    '''
+
+    def __init__(self, task_id: str):
+        super(TaskLeaseLost, self).__init__(f'task:{task_id} lease lost')
+        self.task_id = task_id
+
+
+def _decode(v):
+    return v.decode('utf8') if isinstance(v, bytes) else v
+
+
+def task_meta(meta: str) -> str:
+    '''
+    任务键中的任务数据：重新入队的任务执行期间被写入了进度快照，取快照中的 task 字段。
+    '''
+    if '"task"' not in meta or '"status"' not in meta:
+        return meta
+    try:
+        d = json.loads(meta)
+    except ValueError:
+        return meta
+    if isinstance(d, dict) and isinstance(d.get('task'), dict) and 'status' in d:
+        return json.dumps(d['task'])
+    return meta
+
+
+class TaskLeaseManager:
+    '''
+    任务租约：领取任务时（claim 脚本中）创建，执行期间定期续约，执行完成后删除。
+    worker 异常退出后租约过期，任意 worker 的回收器会把任务按原分数放回原队列；
+    续约时发现租约已丢失的任务由当前 worker 放弃执行，不再续约和释放。
+    '''
+
+    def __init__(self, ttl: int = LeaseTTL, max_retries: int = LeaseMaxRetries,
+                 lease_key: str = TaskLeaseKey, info_key: str = TaskLeaseInfoKey,
+                 owner_prefix: str = TaskWorkerKeyPrefix):
+        self.ttl = ttl
+        self.max_retries = max_retries
+        self.lease_key = lease_key
+        self.info_key = info_key
+        self.owner_prefix = owner_prefix
+        self._holding = set()
+        self._lost = set()
+        self._locker = threading.Lock()
+        self._reap_script = None
+
+    def hold(self, task_id: str):
+        with self._locker:
+            self._holding.add(task_id)
+
+    def holding(self) -> typing.List[str]:
+        with self._locker:
+            return list(self._holding)
+
+    def lost(self, task_id: str) -> bool:
+        with self._locker:
+            return task_id in self._lost
+
+    def renew(self, rds) -> typing.List[str]:
+        '''
+        为当前持有的任务续约，返回已丢失租约（已被回收）的任务ID。
+        '''
+        task_ids = self.holding()
+        if not task_ids:
+            return []
+        expire_at = int(time.time() * 1000) + self.ttl * 1000
+        pipe = rds.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.zadd(self.lease_key, {task_id: expire_at}, xx=True, ch=True)
+            pipe.expire(self.owner_prefix + task_id, 2 * 3600)
+        results = pipe.execute()
+        lost = [task_id for task_id, changed in zip(task_ids, results[::2]) if not changed]
+        if lost:
+            with self._locker:
+                self._holding.difference_update(lost)
+                self._lost.update(lost)
+        return lost
+
+    def complete(self, rds, task_id: str):
+        with self._locker:
+            self._holding.discard(task_id)
+            if task_id in self._lost:
+                # 租约已被回收，任务可能正在其他 worker 上执行，不能删除其租约
+                self._lost.discard(task_id)
+                return
+        pipe = rds.pipeline(transaction=False)
+        pipe.zrem(self.lease_key, task_id)
+        pipe.hdel(self.info_key, task_id)
+        pipe.delete(TaskLeaseRetryKeyPrefix + task_id)
+        pipe.execute()
+
+    def reap(self, rds, batch: int = 100) -> typing.List[ExpiredLease]:
+        if self._reap_script is None:
+            self._reap_script = rds.register_script(ReapLeaseScript)
+        now = int(time.time() * 1000)
+        r = self._reap_script(keys=[self.lease_key, self.info_key, TaskQueueRegistryKey, TaskQueueDepthKey],
+                              args=[now, self.max_retries, batch, TaskWakeupChannelPrefix,
+                                    self.owner_prefix, TaskLeaseRetryKeyPrefix, LeaseTaskMetaExpire,
+                                    TaskWakeupAnyChannel],
+                              client=rds)
+        expired = []
+        for task_id, queue_name, worker_id, action, *meta in r or []:
+            expired.append(ExpiredLease(_decode(task_id), _decode(queue_name), _decode(worker_id),
+                                        _decode(action) == 'requeue',
+                                        task_meta(_decode(meta[0])) if meta and meta[0] else None))
+        for lease in expired:
+            logger.warning(f"[lease] task:{lease.task_id} of worker:{lease.worker_id} lease expired, "
+                           f"{'requeue to ' + lease.queue_name if lease.requeued else 'out of retries'}.")
+        return expired
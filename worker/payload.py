@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/19 10:48 AM
+# @Author  : wangdongming
+# @Site    :
+# @File    : payload.py
+# @Software: xingzhe.ai
+import abc
+import hashlib
+import os
+import threading
+import typing
+import uuid
+from tools.environment import Env_PayloadStoreDir, Env_PayloadRemotePrefix, get_payload_inline_limit
+
+# 任务 META 中被替换为引用的值：{"__payload__": sha256, "encoding": "text", "size": 字节数}
+PayloadRefKey = '__payload__'
+# META 中记录含引用的顶层字段，接收端只在访问这些字段时解析
+PayloadKeysField = '__payload_keys__'
+
+
+class PayloadStore(abc.ABC):
+    '''
+    内容寻址的 payload 存储，键为内容的 sha256。
+    '''
+
+    @abc.abstractmethod
+    def put(self, digest: str, data: bytes):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get(self, digest: str) -> bytes:
+        raise NotImplementedError
+
+
+class LocalBlobStore(PayloadStore):
+    '''
+    本地目录存储（单机或共享盘），同时作为远端存储的节点缓存。
+    '''
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.isfile(self.path(digest))
+
+    def put(self, digest: str, data: bytes):
+        dst = self.path(digest)
+        if os.path.isfile(dst):
+            return dst
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = f'{dst}.{uuid.uuid4().hex}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        # 内容相同，并发写入时后者覆盖不影响结果
+        os.replace(tmp, dst)
+        return dst
+
+    def get(self, digest: str) -> bytes:
+        with open(self.path(digest), 'rb') as f:
+            return f.read()
+
+
+class StorageBlobStore(PayloadStore):
+    '''
+    对象存储（filestorage），读取时先查节点本地缓存。
+    '''
+
+    def __init__(self, prefix: str, cache: LocalBlobStore):
+        self.prefix = prefix.rstrip('/')
+        self.cache = cache
+
+    def key(self, digest: str) -> str:
+        return f'{self.prefix}/{digest[:2]}/{digest}'
+
+    def put(self, digest: str, data: bytes):
+        from filestorage import push_local_path
+        local = self.cache.put(digest, data)
+        push_local_path(self.key(digest), local)
+
+    def get(self, digest: str) -> bytes:
+        if not self.cache.exists(digest):
+            from filestorage import get_local_path
+            os.makedirs(os.path.dirname(self.cache.path(digest)), exist_ok=True)
+            tmp = f'{self.cache.path(digest)}.{uuid.uuid4().hex}.tmp'
+            if not get_local_path(self.key(digest), tmp):
+                raise OSError(f'cannot download payload:{digest}')
+            os.replace(tmp, self.cache.path(digest))
+        data = self.cache.get(digest)
+        if hashlib.sha256(data).hexdigest() != digest:
+            os.remove(self.cache.path(digest))
+            raise OSError(f'payload checksum mismatch:{digest}')
+        return data
+
+
+_store = None
+_store_locker = threading.Lock()
+
+
+def get_payload_store() -> typing.Optional[PayloadStore]:
+    '''
+    配置了对象存储前缀（PAYLOAD_REMOTE_PREFIX）时使用对象存储，否则使用显式配置的共享目录（PAYLOAD_STORE_DIR），
+    都未配置时返回 None（生产者与 worker 没有共享的存储，不能替换为引用）。
+    '''
+    global _store
+    with _store_locker:
+        if _store is None:
+            root = os.getenv(Env_PayloadStoreDir)
+            prefix = os.getenv(Env_PayloadRemotePrefix)
+            if prefix:
+                _store = StorageBlobStore(prefix, LocalBlobStore(root or os.path.join('tmp', 'payloads')))
+            elif root:
+                _store = LocalBlobStore(root)
+        return _store
+
+
+def is_payload_ref(value) -> bool:
+    return isinstance(value, dict) and PayloadRefKey in value
+
+
+def _put(store: PayloadStore, data: bytes, encoding: str) -> dict:
+    digest = hashlib.sha256(data).hexdigest()
+    store.put(digest, data)
+    return {PayloadRefKey: digest, 'encoding': encoding, 'size': len(data)}
+
+
+def _offload(value, store: PayloadStore, limit: int):
+    if isinstance(value, str):
+        if len(value) > limit:
+            return _put(store, value.encode('utf8'), 'text'), True
+        return value, False
+    if isinstance(value, dict):
+        changed, r = False, {}
+        for k, v in value.items():
+            r[k], c = _offload(v, store, limit)
+            changed = changed or c
+        return (r, True) if changed else (value, False)
+    if isinstance(value, (list, tuple)):
+        changed, r = False, []
+        for v in value:
+            v, c = _offload(v, store, limit)
+            r.append(v)
+            changed = changed or c
+        return (r, True) if changed else (value, False)
+    return value, False
+
+
+def offload_payload(meta: typing.Mapping[str, typing.Any], store: PayloadStore = None,
+                    limit: int = None) -> typing.Dict[str, typing.Any]:
+    '''
+    将 META 中超过 limit 的字符串（含嵌套在脚本参数中的图片）存入 store 并替换为引用，未启用时原样返回。
+    '''
+    limit = get_payload_inline_limit() if limit is None else limit
+    store = store or (get_payload_store() if limit > 0 else None)
+    if limit <= 0 or store is None:
+        return dict(meta)
+    r, keys = {}, []
+    for k, v in meta.items():
+        r[k], changed = _offload(v, store, limit)
+        if changed:
+            keys.append(k)
+    if keys:
+        r[PayloadKeysField] = keys
+    return r
+
+
+def resolve_payload(value, store: PayloadStore = None):
+    '''
+    递归替换引用为原始内容。
+    '''
+    if is_payload_ref(value):
+        store = store or get_payload_store()
+        if store is None:
+            raise OSError(f'payload store not configured, cannot resolve:{value[PayloadRefKey]}')
+        return store.get(value[PayloadRefKey]).decode('utf8')
+    if isinstance(value, dict):
+        return dict((k, resolve_payload(v, store)) for k, v in value.items())
+    if isinstance(value, list):
+        return [resolve_payload(v, store) for v in value]
+    return value
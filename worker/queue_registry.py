@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/5 11:02 AM
+# @Author  : wangdongming
+# @Site    :
+# @File    : queue_registry.py
+# @Software: xingzhe.ai
+import time
+import typing
+from .wakeup import TaskWakeupChannelPrefix, TaskWakeupAnyChannel, PublishWakeupLua
+
+# 非空任务队列注册表：ZSET，member为队列名，score为队首（最早到期）任务分数
+TaskQueueRegistryKey = 'task-queue-registry'
+# 队列长度：HASH，队列名 -> 任务数
+TaskQueueDepthKey = 'task-queue-depth'
+# 预加载队列注册表：SET，由生产者维护
+TaskPreQueueRegistryKey = 'task-pre-queue-registry'
+# 重建注册表的互斥键，保证同一时间只有一个 worker 扫描
+RebuildRegistryKey = TaskQueueRegistryKey + ':rebuild'
+# 注册表为空时的 SCAN 修复（兼容绕过 push 直接 ZADD 入队的生产者）的互斥键及最小间隔（秒）
+RebuildEmptyRegistryKey = RebuildRegistryKey + ':empty'
+EmptyRebuildInterval = 30
+
+# 根据队列当前状态刷新注册表，供其他脚本拼接使用（需要定义 registry、depth 变量）
+RefreshRegistryLua = """
+local function refresh_registry(queue)
+    local head = redis.call('ZRANGE', queue, 0, 0, 'WITHSCORES')
+    if #head == 0 then
+        redis.call('ZREM', registry, queue)
+        redis.call('HDEL', depth, queue)
+    else
+        redis.call('ZADD', registry, head[2], queue)
+        redis.call('HSET', depth, queue, redis.call('ZCARD', queue))
+    end
+end
+"""
+
+# KEYS: 队列, 注册表, 长度表, 任务META键
+# ARGV: 任务ID, 分数, META（为空不写入）, META 过期时间（秒）, 入队通知频道前缀, 公共通知频道
+PushTaskScript = """
+local queue = KEYS[1]
+local registry = KEYS[2]
+local depth = KEYS[3]
+""" + RefreshRegistryLua + PublishWakeupLua + """
+if ARGV[3] ~= '' then
+    redis.call('SET', KEYS[4], ARGV[3], 'EX', tonumber(ARGV[4]))
+end
+redis.call('ZADD', queue, ARGV[2], ARGV[1])
+refresh_registry(queue)
+publish_wakeup(ARGV[5], ARGV[6], queue)
+return 1
+"""
+
+# KEYS: 队列, 注册表, 长度表
+RefreshQueueScript = """
+local queue = KEYS[1]
+local registry = KEYS[2]
+local depth = KEYS[3]
+""" + RefreshRegistryLua + """
+refresh_registry(queue)
+return 1
+"""
+
+
+class QueueStat(typing.NamedTuple):
+    name: str
+    depth: int
+    oldest_score: float
+
+
+def _decode(v):
+    return v.decode('utf8') if isinstance(v, bytes) else v
+
+
+class QueueRegistry:
+    '''
+    维护非空任务队列列表，worker 读取注册表决定访问哪些队列，避免 KEYS 扫描。
+    '''
+
+    def __init__(self, registry_key: str = TaskQueueRegistryKey, depth_key: str = TaskQueueDepthKey):
+        self.registry_key = registry_key
+        self.depth_key = depth_key
+        self._push_script = None
+        self._refresh_script = None
+
+    def push(self, rds, queue_name: str, task_id: str, score: float, meta: str = None, meta_expire: int = 0):
+        if self._push_script is None:
+            self._push_script = rds.register_script(PushTaskScript)
+        keys = [queue_name, self.registry_key, self.depth_key, task_id]
+        args = [task_id, score, meta or '', meta_expire or 3600 * 24,
+                TaskWakeupChannelPrefix, TaskWakeupAnyChannel]
+        self._push_script(keys=keys, args=args, client=rds)
+
+    def refresh(self, rds, queue_name: str):
+        if self._refresh_script is None:
+            self._refresh_script = rds.register_script(RefreshQueueScript)
+        self._refresh_script(keys=[queue_name, self.registry_key, self.depth_key], client=rds)
+
+    def snapshot(self, rds, due_before_ms: int = None) -> typing.List[QueueStat]:
+        '''
+        获取队首任务已到期的队列，按队首分数（等待时间）从早到晚排序。
+        '''
+        due_before_ms = due_before_ms or int(time.time() * 1000) + 1000
+        pipe = rds.pipeline(transaction=False)
+        pipe.zrangebyscore(self.registry_key, '-inf', due_before_ms, withscores=True)
+        pipe.hgetall(self.depth_key)
+        queues, depths = pipe.execute()
+        depths = dict((_decode(k), int(v)) for k, v in (depths or {}).items())
+        stats = []
+        for name, score in queues:
+            name = _decode(name)
+            stats.append(QueueStat(name, depths.get(name, 0), score))
+        return stats
+
+    def next_due(self, rds, after_ms: int = None) -> typing.Optional[float]:
+        '''
+        尚未到期的队首任务中最早的到期分数（ms），没有返回None。
+        '''
+        after_ms = after_ms or int(time.time() * 1000) + 1000
+        head = rds.zrangebyscore(self.registry_key, f'({after_ms}', '+inf', start=0, num=1, withscores=True)
+        if head:
+            return head[0][1]
+
+    def rebuild(self, rds, prefix: str, lock_expire: int = 600, lock_key: str = RebuildRegistryKey) -> int:
+        '''
+        通过 SCAN 修复注册表（兼容注册表上线前已存在的队列），同一时间只允许一个 worker 执行。
+        '''
+        if not rds.set(lock_key, 1, ex=lock_expire, nx=True):
+            return 0
+        counter = 0
+        for key in rds.scan_iter(match=prefix + '*', count=1000, _type='ZSET'):
+            self.refresh(rds, _decode(key))
+            counter += 1
+        return counter
+
+    def probe(self, rds, queue_names: typing.Iterable[str]) -> int:
+        '''
+        直接检查指定的队列（如已加载模型的队列），非空的队列加入注册表，返回非空队列数。
+        '''
+        queue_names = list(queue_names)
+        if not queue_names:
+            return 0
+        pipe = rds.pipeline(transaction=False)
+        for queue_name in queue_names:
+            pipe.exists(queue_name)
+        found = [queue_name for queue_name, n in zip(queue_names, pipe.execute()) if n]
+        for queue_name in found:
+            self.refresh(rds, queue_name)
+        return len(found)
+
+    def snapshot_or_probe(self, rds, prefix: str, queue_names: typing.Iterable[str] = ()) -> typing.List[QueueStat]:
+        '''
+        读取注册表；注册表为空时检查 queue_names 并限频 SCAN 修复，
+        直接 ZADD 入队的队列最迟 EmptyRebuildInterval 秒后可见（注册表非空时由定时 rebuild 修复）。
+        '''
+        stats = self.snapshot(rds)
+        if stats:
+            return stats
+        found = self.probe(rds, queue_names)
+        found += self.rebuild(rds, prefix, EmptyRebuildInterval, RebuildEmptyRegistryKey)
+        return self.snapshot(rds) if found else stats
+
+
+def register_preload_queue(rds, queue_name: str):
+    rds.sadd(TaskPreQueueRegistryKey, queue_name)
+
+
+def preload_queue_names(rds, prefix: str) -> typing.List[str]:
+    names = (_decode(k) for k in rds.smembers(TaskPreQueueRegistryKey))
+    return [k for k in names if k.startswith(prefix)]
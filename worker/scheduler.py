@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/11 10:35 AM
+# @Author  : wangdongming
+# @Site    :
+# @File    : scheduler.py
+# @Software: xingzhe.ai
+import abc
+import os
+import time
+import typing
+from .queue_registry import QueueStat
+
+TaskQueuePrefix = "task_"
+OtherTaskQueueToken = TaskQueuePrefix + 'others'
+# 模型所在位置对应的切换耗时估计（秒）
+SwitchCostLoaded = 0
+SwitchCostRAM = 3
+SwitchCostDisk = 15
+SwitchCostRemote = 90
+
+
+def queue_model_hash(queue_name: str) -> str:
+    return queue_name[len(TaskQueuePrefix):] if queue_name.startswith(TaskQueuePrefix) else queue_name
+
+
+class LocalModelInventory:
+    '''
+    本地模型清单（模型文件以 sha256 命名，按前10位 shorthash 索引），定时刷新。
+    '''
+
+    def __init__(self, *dirs: str, refresh_interval: int = 60):
+        self.dirs = dirs or ('models/Stable-diffusion', 'user-models/Stable-diffusion')
+        self.refresh_interval = refresh_interval
+        self._hashes = set()
+        self._refresh_time = 0
+
+    def _refresh(self):
+        hashes = set()
+        for d in self.dirs:
+            if not os.path.isdir(d):
+                continue
+            for fn in os.listdir(d):
+                name, ex = os.path.splitext(fn)
+                if ex.lower() in ('.safetensors', '.ckpt', '.pt', '.pth'):
+                    hashes.add(name[:10])
+        self._hashes = hashes
+        self._refresh_time = time.time()
+
+    def __contains__(self, shorthash: str) -> bool:
+        if time.time() - self._refresh_time > self.refresh_interval:
+            self._refresh()
+        return shorthash[:10] in self._hashes
+
+
+class SchedulePolicy(abc.ABC):
+    '''
+    决定 worker 访问队列的顺序，输入为注册表中已到期的非空队列。
+    '''
+
+    @abc.abstractmethod
+    def order(self, queues: typing.Sequence[QueueStat], now_ms: int = None) -> typing.List[str]:
+        raise NotImplementedError
+
+
+class AffinityFirstPolicy(SchedulePolicy):
+    '''
+    固定顺序：已加载模型 > others 队列 > 其他队列，同一优先级内按等待时间。
+    '''
+
+    def __init__(self, loaded_models: typing.Callable[[], typing.Sequence[str]]):
+        self.loaded_models = loaded_models
+
+    def order(self, queues: typing.Sequence[QueueStat], now_ms: int = None) -> typing.List[str]:
+        loaded = set(self.loaded_models() or [])
+
+        def sort_keys(q: QueueStat):
+            if queue_model_hash(q.name) in loaded:
+                return -1
+            elif OtherTaskQueueToken in q.name:
+                return 0
+            return 1
+
+        return [q.name for q in sorted(queues, key=sort_keys)]
+
+
+class CostBasedPolicy(SchedulePolicy):
+    '''
+    按“模型切换耗时 - wait_weight * 等待时间”评分，优先处理代价最低的队列。
+    队首分数已包含优先级偏移（level * -100000ms），高优先级任务的等待时间相应更长。
+    需要切换模型时，等待超过 starvation_seconds 的最早队列排在最前，保证冷门模型不会饿死。
+    '''
+
+    def __init__(self, loaded_models: typing.Callable[[], typing.Sequence[str]],
+                 local_models: typing.Container[str] = None,
+                 wait_weight: float = 0.02,
+                 starvation_seconds: float = 300):
+        self.loaded_models = loaded_models
+        self.local_models = local_models if local_models is not None else LocalModelInventory()
+        self.wait_weight = wait_weight
+        self.starvation_seconds = starvation_seconds
+
+    def switch_cost(self, queue_name: str, loaded: typing.Sequence[str]) -> float:
+        model_hash = queue_model_hash(queue_name)
+        if loaded and model_hash == loaded[-1]:
+            return SwitchCostLoaded
+        if model_hash in loaded:
+            return SwitchCostRAM
+        if OtherTaskQueueToken in queue_name or model_hash in self.local_models:
+            return SwitchCostDisk
+        return SwitchCostRemote
+
+    def cost(self, q: QueueStat, loaded: typing.Sequence[str], now_ms: int) -> float:
+        wait = max(now_ms - q.oldest_score, 0) / 1000
+        return self.switch_cost(q.name, loaded) - self.wait_weight * wait
+
+    def order(self, queues: typing.Sequence[QueueStat], now_ms: int = None) -> typing.List[str]:
+        now_ms = now_ms or int(time.time() * 1000)
+        # CkptLoadRecorder.history: 最近加载的在最后
+        loaded = list(self.loaded_models() or [])
+        queues = sorted(queues, key=lambda q: self.cost(q, loaded, now_ms))
+        oldest = min(queues, key=lambda q: q.oldest_score, default=None)
+        # 当前模型的队列还有任务时继续处理（不切换），需要切换模型时优先处理等待超时的队列
+        if oldest is not None and now_ms - oldest.oldest_score > self.starvation_seconds * 1000 \
+                and self.switch_cost(queues[0].name, loaded) > SwitchCostLoaded:
+            queues.remove(oldest)
+            queues.insert(0, oldest)
+        return [q.name for q in queues]
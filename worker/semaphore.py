@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/15 4:32 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : semaphore.py
+# @Software: xingzhe.ai
+import threading
+import time
+import typing
+
+# 训练任务用户并发许可：ZSET，member为任务ID，score为许可到期时间（ms）
+TrainPermitKeyPrefix = 'semaphore:train:'
+
+# 获取许可，供其他脚本拼接使用：先清理过期许可，未满额时写入（已持有则续期）
+AcquirePermitLua = """
+local function acquire_permit(key, member, limit, now_ms, ttl_ms)
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now_ms)
+    if not redis.call('ZSCORE', key, member) and redis.call('ZCARD', key) >= limit then
+        return false
+    end
+    redis.call('ZADD', key, now_ms + ttl_ms, member)
+    redis.call('PEXPIRE', key, ttl_ms)
+    return true
+end
+"""
+
+# KEYS: 许可
+# ARGV: 持有者, 许可数, 当前时间（ms）, 许可时长（ms）
+AcquirePermitScript = AcquirePermitLua + """
+if acquire_permit(KEYS[1], ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])) then
+    return 1
+end
+return 0
+"""
+
+
+class DistributedSemaphore:
+    '''
+    基于 REDIS ZSET 的分布式信号量：每个许可单独过期，持有期间定期续期，
+    持有者异常退出后许可到期自动释放，不依赖 worker 心跳。
+    '''
+
+    def __init__(self, prefix: str, ttl: int):
+        self.prefix = prefix
+        self.ttl = ttl
+        # 当前进程持有的许可：持有者 -> 许可键
+        self._holding = {}
+        self._locker = threading.Lock()
+        self._acquire_script = None
+
+    def key(self, name: str) -> str:
+        return self.prefix + name
+
+    def hold(self, name: str, member: str):
+        with self._locker:
+            self._holding[member] = self.key(name)
+
+    def acquire(self, rds, name: str, member: str, limit: int, now_ms: int = None) -> bool:
+        if self._acquire_script is None:
+            self._acquire_script = rds.register_script(AcquirePermitScript)
+        now_ms = now_ms or int(time.time() * 1000)
+        ok = self._acquire_script(keys=[self.key(name)], args=[member, limit, now_ms, self.ttl * 1000], client=rds)
+        if ok:
+            self.hold(name, member)
+        return bool(ok)
+
+    def renew(self, rds, now_ms: int = None) -> typing.List[str]:
+        '''
+        为持有的许可续期，返回已丢失（已过期被清理）的持有者。
+        '''
+        with self._locker:
+            holding = list(self._holding.items())
+        if not holding:
+            return []
+        now_ms = now_ms or int(time.time() * 1000)
+        pipe = rds.pipeline(transaction=False)
+        for member, key in holding:
+            pipe.zadd(key, {member: now_ms + self.ttl * 1000}, xx=True, ch=True)
+            pipe.pexpire(key, self.ttl * 1000)
+        results = pipe.execute()
+        return [member for (member, _), changed in zip(holding, results[::2]) if not changed]
+
+    def release(self, rds, name: str, member: str):
+        with self._locker:
+            self._holding.pop(member, None)
+        rds.zrem(self.key(name), member)
+
+    def count(self, rds, name: str, now_ms: int = None) -> int:
+        now_ms = now_ms or int(time.time() * 1000)
+        return rds.zcount(self.key(name), f'({now_ms}', '+inf')
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/13 11:16 AM
+# @Author  : wangdongming
+# @Site    :
+# @File    : stager.py
+# @Software: xingzhe.ai
+import time
+import typing
+from loguru import logger
+from tools.model_cache import model_cache
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, Future
+from .task import Task
+from .batching import TaskBatch
+
+
+class TaskStager:
+    '''
+    预取已领取任务的依赖（模型、图片、权重），在 GPU 执行当前任务时由后台线程完成，
+    执行任务前等待预取结束，handler 直接使用本地文件。
+    '''
+
+    def __init__(self, get_handler: typing.Callable[[Task], typing.Any], max_workers: int = 2):
+        self.get_handler = get_handler
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix='task-stager')
+        self._futures = {}
+        self._locker = Lock()
+
+    def stage(self, task: typing.Union[Task, TaskBatch]):
+        # 合批任务使用相同的模型，只需要预取首个任务
+        leader = task.leader if isinstance(task, TaskBatch) else task
+        handler = self.get_handler(leader)
+        if not handler:
+            return
+        future = self._pool.submit(self._stage, handler, leader)
+        with self._locker:
+            self._futures[leader.id] = future
+
+    def _stage(self, handler, task: Task):
+        st = time.time()
+        # 预取的模型在任务执行结束前不会被清理
+        with model_cache.holding(task.id):
+            handler.stage(task)
+        logger.info(f"[stager] task:{task.id} staged, cost:{time.time() - st:.2f}s")
+
+    def wait(self, task: typing.Union[Task, TaskBatch], timeout: float = None):
+        '''
+        等待预取完成，预取失败不影响执行（handler 会重新获取并上报错误）。
+        '''
+        leader = task.leader if isinstance(task, TaskBatch) else task
+        with self._locker:
+            future: Future = self._futures.pop(leader.id, None)
+        if future is None:
+            return
+        try:
+            future.result(timeout)
+        except Exception as err:
+            logger.warning(f"[stager] task:{leader.id} stage failed:{err}")
+
+    def release(self, task: typing.Union[Task, TaskBatch]):
+        '''
+        任务执行结束后释放预取占用的内存（如预读的模型权重），预取未完成时在预取结束后释放。
+        '''
+        leader = task.leader if isinstance(task, TaskBatch) else task
+        handler = self.get_handler(leader)
+        if not handler:
+            return
+        with self._locker:
+            future: Future = self._futures.pop(leader.id, None)
+        if future is not None and not future.done():
+            future.add_done_callback(lambda _: self._unstage(handler, leader))
+        else:
+            self._unstage(handler, leader)
+
+    def _unstage(self, handler, task: Task):
+        try:
+            handler.unstage(task)
+        except Exception:
+            logger.exception(f"[stager] task:{task.id} unstage failed")
+
+    def close(self):
+        with self._locker:
+            futures, self._futures = self._futures, {}
+        for future in futures.values():
+            future.cancel()
+        self._pool.shutdown(wait=False)
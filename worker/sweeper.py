@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/20 10:15 AM
+# @Author  : wangdongming
+# @Site    :
+# @File    : sweeper.py
+# @Software: xingzhe.ai
+import time
+import typing
+import uuid
+from datetime import datetime
+from loguru import logger
+
+# 超时任务清理的 leader 锁，持有者在锁有效期（一个清理周期）内负责清理
+TaskSweeperLeaderKey = 'task-sweeper:leader'
+# 最近一次清理结果：HASH {worker, at, count, cost}
+TaskSweeperReportKey = 'task-sweeper:report'
+# 清理用复合索引
+TaskSweeperIndex = [('status', 1), ('task.create_at', 1)]
+
+
+class TaskTimeoutSweeper:
+    '''
+    将长时间未执行（status=0）的任务标记为超时。
+    所有 WORKER 竞争 REDIS 锁（SET NX PX），每个清理周期只有获得锁的 WORKER 执行一次，
+    按复合索引分批 update_many，避免所有 WORKER 同时全表扫描。
+    '''
+
+    def __init__(self, collect, worker_id: str = None, interval: int = 3600, expire: int = 3600 * 18,
+                 batch_size: int = 1000, max_batches: int = 50, check_interval: int = 60):
+        self.collect = collect
+        self.worker_id = worker_id or uuid.uuid4().hex
+        # 清理周期（秒）
+        self.interval = interval
+        # 创建超过该时间（秒）仍在等待的任务视为超时
+        self.expire = expire
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        # 本地竞争锁的间隔（秒）
+        self.check_interval = check_interval
+        self._check_time = 0
+
+    def ensure_index(self):
+        self.collect.create_index(TaskSweeperIndex)
+
+    def try_lead(self, rds, now: float = None) -> bool:
+        now = now or time.time()
+        if now - self._check_time < self.check_interval:
+            return False
+        self._check_time = now
+        return bool(rds.set(TaskSweeperLeaderKey, self.worker_id, nx=True, px=int(self.interval * 1000)))
+
+    def sweep(self, now: int = None) -> int:
+        '''
+        清理超时任务，返回更新的文档数。
+        '''
+        now = int(now or time.time())
+        query = {
+            'status': 0,
+            'task.create_at': {'$lt': now - self.expire},
+        }
+        update = {
+            '$set': {
+                'status': -1,
+                'update_at': datetime.now(),
+                'task_desc': 'task timeout(auto clean).',
+            }
+        }
+        total = 0
+        for _ in range(self.max_batches):
+            # 只取 _id，由索引覆盖；每批数量受限，避免长时间占用
+            ids = [doc['_id'] for doc in self.collect.find(query, {'_id': 1}).hint(TaskSweeperIndex)
+                   .limit(self.batch_size)]
+            if not ids:
+                break
+            res = self.collect.update_many({'_id': {'$in': ids}, 'status': 0}, update)
+            total += res.modified_count
+            if len(ids) < self.batch_size:
+                break
+        return total
+
+    def run(self, rds, now: float = None) -> typing.Optional[int]:
+        '''
+        获得锁时执行清理并上报结果，否则返回 None。
+        '''
+        if not self.try_lead(rds, now):
+            return
+        st = time.time()
+        count = self.sweep(now)
+        cost = round(time.time() - st, 3)
+        logger.info(f"[sweeper] {count} timeout tasks cleaned, cost:{cost}s")
+        rds.hset(TaskSweeperReportKey, mapping={
+            'worker': self.worker_id,
+            'at': int(st),
+            'count': count,
+            'cost': cost,
+        })
+        return count
@@ -16,9 +16,11 @@ from collections import UserDict, UserList
 import math
 
 from tools import try_deserialize_json
+from worker.payload import PayloadKeysField, resolve_payload
 
 
 class SerializationObj:
+    __slots__ = ()
 
     def to_dict(self):
         pr = {}
@@ -39,10 +41,28 @@ class SerializationObj:
 class Task(UserDict):
 
     def __init__(self, **kwargs):
+        # 已解析的 payload 引用（按需从 payload store 读取）
+        self._resolved = {}
         super(Task, self).__init__(None, **kwargs)
         if 'create_at' not in self or self['create_at'] < 1:
             self['create_at'] = int(time.time())
 
+    def __getitem__(self, key):
+        value = super(Task, self).__getitem__(key)
+        if key in self.data.get(PayloadKeysField, ()):
+            if key not in self._resolved:
+                self._resolved[key] = resolve_payload(value)
+            return self._resolved[key]
+        return value
+
+    def __setitem__(self, key, value):
+        self._resolved.pop(key, None)
+        super(Task, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._resolved.pop(key, None)
+        super(Task, self).__delitem__(key)
+
     @property
     def id(self):
         task_id = self.get("task_id")
@@ -108,7 +128,8 @@ class Task(UserDict):
         return f'taskId:{task_id}, type:{self.task_type.name}'
 
     def json(self) -> str:
-        return json.dumps(dict(self.items()))
+        # 保留 payload 引用，重新入队时不展开大字段
+        return json.dumps(self.data)
 
     def value(self, key, default=None, requires=False):
         if requires:
@@ -116,8 +137,15 @@ class Task(UserDict):
         else:
             return self.get(key, default=default)
 
+    def resolved(self) -> typing.Dict[str, typing.Any]:
+        '''
+        展开 payload 引用后的任务数据（不含引用记录字段）。
+        '''
+        return dict((k, self[k]) for k in self.data if k != PayloadKeysField)
+
     def to_dict(self):
-        return dict(self)
+        # 落库（MONGO）的任务数据展开 payload 引用，与未启用 payload store 时的结构一致
+        return self.resolved()
 
 
 class TaskType(IntEnum):
@@ -145,12 +173,16 @@ class TaskStatus(IntEnum):
 
 
 class TrainEpoch(SerializationObj):
+    __slots__ = ('epoch', 'loss', 'time')
 
     def __init__(self, epoch, loss):
         self.epoch = epoch
         self.loss = loss
         self.time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+    def to_dict(self):
+        return {'epoch': self.epoch, 'loss': self.loss, 'time': self.time}
+
 
 class TrainEpochLog(UserList, SerializationObj):
 
@@ -175,10 +207,14 @@ class TrainEpochLog(UserList, SerializationObj):
 
 
 class TrainTaskInfo(SerializationObj):
+    __slots__ = ('epoch',)
 
     def __init__(self):
         self.epoch = TrainEpochLog()
 
+    def to_dict(self):
+        return {'epoch': self.epoch.data}
+
     def add_epoch_log(self, epoch: TrainEpoch):
         self.epoch.append(epoch)
 
@@ -193,6 +229,9 @@ class TrainTaskInfo(SerializationObj):
 
 
 class TaskProgress(SerializationObj):
+    # 显式字段，序列化时不再反射遍历 dir()
+    __slots__ = ('status', 'task_desc', 'task', '_result', 'task_progress', 'eta_relative', 'train', 'preview',
+                 'start_time', 'version', 'cate', 'trace', '_upload')
 
     def __init__(self, task: Task):
         self.status = TaskStatus.Waiting
@@ -206,6 +245,30 @@ class TaskProgress(SerializationObj):
         self.start_time = time.time()
         self.version = 0
         self.cate = ""
+        self.trace = None
+        self._upload = None
+
+    def to_dict(self):
+        result = self._result
+        if hasattr(result, 'to_dict'):
+            result = result.to_dict()
+        d = {
+            'status': self.status,
+            'task_desc': self.task_desc,
+            'task': self.task.to_dict() if hasattr(self.task, 'to_dict') else self.task,
+            'task_progress': self.task_progress,
+            'eta_relative': self.eta_relative,
+            'train': self.train.to_dict(),
+            'preview': self.preview,
+            'start_time': self.start_time,
+            'version': self.version,
+            'cate': self.cate,
+            'completed': self.completed,
+            'result': result,
+        }
+        if self.trace is not None:
+            d['trace'] = self.trace
+        return d
 
     @property
     def completed(self):
@@ -222,6 +285,17 @@ class TaskProgress(SerializationObj):
         self.task_desc = desc
         self.status = status
 
+    def set_async_upload(self, upload: typing.Callable[[], 'TaskProgress']):
+        '''
+        后台上传：状态置为 Uploading，由执行线程提交到上传流水线，upload 返回任务最终进度。
+        '''
+        self.status = TaskStatus.Uploading
+        self._upload = upload
+
+    @property
+    def upload_func(self):
+        return self._upload
+
     def set_finish_result(self, r: typing.Any, is_train_task=False):
         self._result = r
         self.status = TaskStatus.Finish if not is_train_task else TaskStatus.TrainCompleted
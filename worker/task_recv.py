@@ -9,15 +9,20 @@ import enum
 import hashlib
 import json
 import os
-import random
 import shutil
 import time
 import typing
 import uuid
-import redis_lock
 import requests
 from loguru import logger
-from .task import Task
+from .task import Task, TaskProgress
+from .claim import TaskClaimer, ClaimedTask, SDWorkerZset
+from .queue_registry import QueueRegistry, preload_queue_names
+from .wakeup import TaskWakeupListener, TaskWakeupAnyChannel, wakeup_channel
+from .lease import LeaseRenewInterval
+from .batching import BatchSpec, TaskBatch, BatchPollInterval, task_images
+from .scheduler import SchedulePolicy, CostBasedPolicy, TaskQueuePrefix, OtherTaskQueueToken
+from .dumper import dumper
 from datetime import datetime, timedelta
 from modules.shared import cmd_opts
 from tools.redis import RedisPool
@@ -37,14 +42,11 @@ try:
 except:
     from collections import Iterable  # <=py3.9
 
-TaskQueuePrefix = "task_"
 TaskPreQueuePrefix = 'task-pre_'
-OtherTaskQueueToken = TaskQueuePrefix + 'others'
 TrainTaskQueueToken = 'train'
 UpscaleCoeff = 100 * 1000
 TaskScoreRange = (0, 100 * UpscaleCoeff)
 TaskTimeout = 20 * 3600 if not cmd_opts.train_only else 48 * 3600
-SDWorkerZset = 'sd-workers'
 ElasticResWorkerFlag = "[ElasticRes]"
 TrainOnlyWorkerFlag = "[TrainOnly]"
 MaintainKey = get_maintain_env()
@@ -125,7 +127,9 @@ class TaskReceiver:
 
     def __init__(self, recoder: CkptLoadRecorder, train_only: bool = False,
                  task_received_callback: typing.Callable = None,
-                 before_pop_task: typing.Callable = None):
+                 before_pop_task: typing.Callable = None,
+                 schedule_policy: SchedulePolicy = None,
+                 batch_spec: typing.Callable[[Task], typing.Optional[BatchSpec]] = None):
         self.release_flag = None
         self.model_recoder = recoder
         self.redis_pool = RedisPool()
@@ -138,6 +142,10 @@ class TaskReceiver:
         self.task_score_limit = 5 if cmd_opts.lowvram else (10 if cmd_opts.medvram else -1)
         self.task_received_callback = task_received_callback
         self.before_pop_task = before_pop_task
+        # 返回任务的合批规则，返回None不合批
+        self.batch_spec = batch_spec
+        # 预取（GPU正在执行其他任务）时不领取训练任务
+        self.prefetching = False
 
         run_train_time_cfg = get_run_train_time_cfg()
         run_train_time_start = run_train_time_cfg[Env_Run_Train_Time_Start]
@@ -164,6 +172,18 @@ class TaskReceiver:
         self.closed = False
         self.is_task_group_queue_only = is_task_group_queue_only()
         self.worker_id = self._worker_id()
+        self.claimer = TaskClaimer(self.worker_id, self.task_score_limit)
+        self.queue_registry = self.claimer.registry
+        self.wakeup = TaskWakeupListener(self.redis_pool, self._wakeup_channels)
+        self.leases = self.claimer.leases
+        # 队列访问顺序：默认按模型切换代价 + 等待时间评分
+        self.schedule_policy = schedule_policy or CostBasedPolicy(self._loaded_models)
+        # 执行中的任务定期续约，同时回收其他（已退出）worker 过期的租约
+        self.timer.add_job(self._renew_leases, 'interval', seconds=LeaseRenewInterval)
+        self.timer.add_job(self._reap_expired_leases, 'interval', seconds=LeaseRenewInterval * 2)
+        # 定期修复队列注册表（集群内同一时间只有一个WORKER执行）
+        self.timer.add_job(self._rebuild_queue_registry, 'interval', seconds=600,
+                           next_run_time=datetime.now())
         self.timer.start()
         logger.info(
             f"worker id:{self.worker_id}, train work receive clock:"
@@ -229,30 +249,22 @@ class TaskReceiver:
         if self.model_recoder:
             return self.model_recoder.history()
 
-    def _search_history_ckpt_task(self):
-        if not self.train_only:
-            model_hash_list = self._loaded_models()
-            if model_hash_list:
-                return self._get_queue_task(*model_hash_list)
-
-    def _search_other_ckpt(self):
+    def _search_ckpt_task(self):
+        '''
+        按调度策略给出的顺序访问（非训练）队列。
+        '''
         if not self.train_only:
-            model_hash_list = self._loaded_models()
-
-            def sort_keys(x):
-                x = str(x) if not isinstance(x, bytes) else x.decode('utf8')
-                if x in model_hash_list:
-                    return -1
-                elif OtherTaskQueueToken in x:
-                    return 0
-                return 1
-
-            keys = self._search_queue_names()
-            sorted_keys = sorted(keys, key=sort_keys)
-            for queue_name in sorted_keys:
-                if TrainTaskQueueToken in queue_name:
-                    continue
-
+            rds = self.redis_pool.get_connection()
+            stats = [s for s in self._queue_snapshot(rds)
+                     if s.name.startswith(TaskQueuePrefix) and TrainTaskQueueToken not in s.name]
+            if not stats:
+                return
+            try:
+                queue_names = self.schedule_policy.order(stats)
+            except Exception:
+                logger.exception("schedule policy err")
+                queue_names = [s.name for s in stats]
+            for queue_name in queue_names:
                 task = self._extract_queue_task(queue_name)
                 if task:
                     return task
@@ -266,12 +278,10 @@ class TaskReceiver:
 
         return self._get_queue_task(resource_name)
 
-    def _search_train_task(self):
-        # 弹性不训练
-        if self.is_elastic:
-            return
-
-        if self.train_only or self._can_gener_img_worker_run_train():
+    def _search_train_task(self, can_train: bool = None):
+        if can_train is None:
+            can_train = self._can_run_train()
+        if can_train:
             keys = self._search_queue_names()
             for queue_name in keys:
                 if TrainTaskQueueToken in queue_name:
@@ -330,48 +340,28 @@ class TaskReceiver:
 
         return False
 
-    def search_task_with_id(self, rds, task_id, queue_name, task_score) -> typing.Any:
-        # redis > 6.2.0
-        # meta = rds.getdel(task_id)
-        if self.task_score_limit > 0:
-            arr = task_id.split('_')
-            if len(arr) == 2:
-                try:
-                    score = int(arr[-1])
-                    if self.task_score_limit < score:
-                        print(f"====> task:{task_id} out of limit({self.task_score_limit}).")
-                        return
-
-                except:
-                    pass
-
-        meta = rds.get(task_id)
-        if meta:
-            t = Task.from_json_str(meta)
-            if t.is_train:
-                paralle_count = t.get('paralle_count', 0)
-                if paralle_count > 0:
-                    can_exec = self.can_exec_train_task(t.user_id, paralle_count)
-
-                    if not can_exec:
-                        delay = 0
-                        logger.info(f"repush task {t.id} to {queue_name} and score:{task_score + delay}")
-                        time.sleep(10)
-                        self.repush_task(t.id, queue_name, task_score + delay)
-                        time.sleep(2)
-                        logger.debug(f"return none task")
-                        return
-                    else:
-                        self.incr_train_concurrency(t.user_id)
-
-            if callable(self.task_received_callback) and not self.task_received_callback(t):
-                logger.info("receive callback repush task.")
-                self.repush_task(t.id, queue_name, task_score)
-                return
+    def _accept_claimed_task(self, rds, claimed: ClaimedTask, queue_name: str) -> typing.Optional[Task]:
+        t = Task.from_json_str(claimed.meta)
+        if not t:
+            logger.warning(f"cannot decode task meta:{claimed.task_id}")
+            return
 
-            task_id = task_id.decode('utf8') if isinstance(task_id, bytes) else task_id
-            rds.setex(f"task:worker:{task_id}", timedelta(hours=2), self.worker_id)
-            return t
+        # before receive task
+        if callable(self.before_pop_task) and not self.before_pop_task(claimed.task_id):
+            logger.info(f"before pop callback repush task {claimed.task_id}.")
+            self._release_claimed_task(rds, claimed, queue_name, t)
+            return
+
+        if callable(self.task_received_callback) and not self.task_received_callback(t):
+            logger.info("receive callback repush task.")
+            self._release_claimed_task(rds, claimed, queue_name, t)
+            return
+
+        return t
+
+    def _release_claimed_task(self, rds, claimed: ClaimedTask, queue_name: str, task: Task):
+        self.claimer.release(rds, claimed, queue_name)
+        self.decr_train_concurrency(task)
 
     def _check_cluster_status(self):
         '''
@@ -406,55 +396,44 @@ class TaskReceiver:
     def _extract_queue_task(self, queue_name: str, retry: int = 1):
         queue_name = queue_name.decode('utf8') if isinstance(queue_name, bytes) else queue_name
         rds = self.redis_pool.get_connection()
-
-        locker = redis_lock.Lock(rds, "task-lock-" + queue_name, expire=10)
-        locked = False
         try:
-            logger.debug("===> acquire locker: task-lock-" + queue_name)
-            locker.acquire(blocking=True, timeout=3)
-            locked = True
-            # self._preload_task(queue_name)
             for _ in range(retry):
-                now = int(time.time() * 1000)
-                # min 最小为当前时间（ms）- VIP最大等级*放大系数（VIP提前执行权重）- 任务过期时间（1天）
-                # max 为当前时间（ms） + 偏移量1秒
-                min, max = -1, now + 1000
-                values = rds.zrangebyscore(
-                    queue_name, min, max, start=0, num=1, withscores=True)
-                task = None
-                if values:
-                    names = [v[0] for v in values]
-                    # before receive task
-                    if callable(self.before_pop_task):
-                        r = self.before_pop_task(*names)
-                        if not r:
-                            continue
-
-                    rds.zrem(queue_name, *names)
-                    for name, score in values:
-
-                        task = self.search_task_with_id(rds, name, queue_name, score)
-                        if task:
-                            break
+                # 服务端原子领取，队列为空时直接返回
+                claimed = self.claimer.claim(rds, queue_name)
+                if not claimed:
+                    return
+                task = self._accept_claimed_task(rds, claimed, queue_name)
                 if task:
-                    return task
-                elif not values:
-                    rand = random.randint(0, 10) * 0.1 * retry
-                    if (rand < 0.5):
-                        continue
-                    time.sleep(rand)
-        except redis_lock.NotAcquired:
-            locked = False
-        except redis_lock.TimeoutTooLarge:
-            locked = False
-        except Exception as err:
+                    return self._gather_batch(rds, task, claimed, queue_name)
+        except Exception:
             logger.exception("cannot get task from redis")
-        finally:
-            try:
-                if locked:
-                    locker.release()
-            except:
-                pass
+
+    def _gather_batch(self, rds, task: Task, claimed: ClaimedTask, queue_name: str):
+        '''
+        领取同一队列中可与 task 合并执行的任务，在等待窗口内凑满图片数上限。
+        '''
+        spec = self.batch_spec(task) if callable(self.batch_spec) else None
+        if not spec:
+            return task
+        budget = spec.max_images - task_images(task)
+        batch = TaskBatch([task])
+        deadline = time.time() + spec.wait
+        try:
+            while budget > 0:
+                for c in self.claimer.claim_batch(rds, queue_name, claimed.meta, spec.fields, budget):
+                    t = self._accept_claimed_task(rds, c, queue_name)
+                    if t:
+                        batch.append(t)
+                        budget -= task_images(t)
+                if budget <= 0 or time.time() >= deadline:
+                    break
+                time.sleep(BatchPollInterval)
+        except Exception:
+            logger.exception("cannot gather batch tasks")
+        if len(batch) == 1:
+            return task
+        logger.info(f"gather {len(batch)} tasks to batch: {batch.id}")
+        return batch
 
     def _get_queue_task(self, *model_hash: str):
         for sha256 in model_hash:
@@ -467,7 +446,7 @@ class TaskReceiver:
         rds = self.redis_pool.get_connection()
         model_hash = queue_name[len(TaskQueuePrefix):]
         # 查询键：task-pre_{model_hash}*
-        keys = rds.keys(TaskPreQueuePrefix + model_hash + '*')
+        keys = preload_queue_names(rds, TaskPreQueuePrefix + model_hash)
 
         if not keys:
             return
@@ -486,81 +465,163 @@ class TaskReceiver:
                 # 设置task str任务的meta信息的过期
                 rds.expire(task_id, 3600 * 24)
                 # 从pre队列的task id 导入到正式队列
-                rds.zadd(queue_name, {
-                    task_id: now
-                })
+                self.queue_registry.push(rds, queue_name, task_id, now)
                 logger.info(f"preload task:{task_id} to {queue_name}.")
 
     def _search_queue_names(self):
+        '''
+        从队列注册表中读取队首任务已到期的队列（按等待时间排序）。
+        '''
         rds = self.redis_pool.get_connection()
-        keys = rds.keys(TaskQueuePrefix + '*')
-        return [k.decode('utf8') if isinstance(k, bytes) else k for k in keys]
+        stats = self._queue_snapshot(rds)
+        return [s.name for s in stats if s.name.startswith(TaskQueuePrefix)]
+
+    def _queue_snapshot(self, rds):
+        # 注册表为空时直接检查已加载模型的队列
+        loaded = (TaskQueuePrefix + model_hash[:10] for model_hash in self._loaded_models() or [])
+        return self.queue_registry.snapshot_or_probe(rds, TaskQueuePrefix, loaded)
+
+    def _rebuild_queue_registry(self):
+        try:
+            rds = self.redis_pool.get_connection()
+            n = self.queue_registry.rebuild(rds, TaskQueuePrefix)
+            if n:
+                logger.info(f"rebuild task queue registry, queue count:{n}")
+        except:
+            logger.exception("cannot rebuild task queue registry")
 
-    def _search_task(self):
+    def _search_task(self, can_train: bool = None):
         if self.is_task_group_queue_only:
             return self._search_group_task_queue()
 
-        t = self._search_history_ckpt_task()
+        t = self._search_ckpt_task()
         if t:
             return t
-        t = self._search_other_ckpt()
+        t = self._search_train_task(can_train)
         if t:
             return t
-        if self._can_gener_img_worker_run_train():
-            t = self._search_train_task()
-            if t:
-                return t
 
-    def get_one_task(self, block: bool = True, sleep_time: float = 4) -> typing.Optional[Task]:
+    def _search_any_task(self, can_train: bool = None):
+        if self.train_only:
+            return self._search_train_task(can_train)
+        return self._search_task(can_train)
+
+    def _can_run_train(self) -> bool:
+        '''
+        当前是否可以执行训练任务（弹性、预取时不训练），需要查询分组 worker，每轮轮询只计算一次。
+        '''
+        if self.is_elastic or self.prefetching:
+            return False
+        return self.train_only or self._can_gener_img_worker_run_train()
+
+    def _can_serve_queue(self, queue_name: str, can_train: bool) -> bool:
+        if not queue_name.startswith(TaskQueuePrefix):
+            return False
+        if self.is_task_group_queue_only:
+            return queue_name == TaskQueuePrefix + self._worker_info()['resource']
+        if TrainTaskQueueToken in queue_name:
+            return can_train
+        return not self.train_only
+
+    def _wakeup_channels(self, can_train: bool = None) -> typing.List[str]:
+        '''
+        只订阅可以执行的队列的入队通知：资源组队列、训练队列（可以训练时）、已加载模型的队列，
+        通用 worker 另外订阅公共频道（入队的队列没有订阅者时通知）。
+        '''
+        if self.is_task_group_queue_only:
+            return [wakeup_channel(TaskQueuePrefix + self._worker_info()['resource'])]
+        channels = []
+        if can_train is None:
+            can_train = self._can_run_train()
+        if can_train:
+            channels.append(wakeup_channel(TaskQueuePrefix + '*' + TrainTaskQueueToken + '*'))
+        if not self.train_only:
+            channels.extend(wakeup_channel(TaskQueuePrefix + model_hash[:10])
+                            for model_hash in self._loaded_models() or [])
+            channels.append(TaskWakeupAnyChannel)
+        return channels
+
+    def _idle_wait_timeout(self, start_time: float, sleep_time: float, idle_wait_time: float) -> float:
+        # 订阅不可用时回落到原有的定时轮询
+        if not self.wakeup.listening:
+            return sleep_time - time.time() + start_time
+        # 有延迟执行的任务时，等待到其到期时间
+        try:
+            rds = self.redis_pool.get_connection()
+            next_due = self.queue_registry.next_due(rds)
+            if next_due:
+                return max(min(idle_wait_time, next_due / 1000 - time.time()), 0.1)
+        except Exception as err:
+            logger.warning(f"cannot get next due task:{err}")
+        return idle_wait_time
+
+    def _wait_task(self, timeout: float, can_train: bool) -> typing.Optional[Task]:
+        '''
+        空闲等待：阻塞等待入队通知，直接领取被通知的队列；超时返回None，由调用方重新完整搜索。
+        '''
+        deadline = time.time() + timeout
+        while not self.closed:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            for queue_name in self.wakeup.wait(remaining):
+                if self._can_serve_queue(queue_name, can_train):
+                    task = self._extract_queue_task(queue_name)
+                    if task:
+                        return task
+
+    def _on_task_received(self, task):
+        # 执行任务期间不接收通知，避免消息在订阅连接中堆积
+        self.wakeup.pause()
+        for t in (task if isinstance(task, TaskBatch) else [task]):
+            if isinstance(t, Task):
+                t.setdefault("worker", self.worker_id)
+                self.leases.hold(t.id)
+        self.recorder.set_state(TaskReceiverState.Running)
+
+    def get_one_task(self, block: bool = True, sleep_time: float = 4,
+                     idle_wait_time: float = 10) -> typing.Optional[Task]:
         while not self.closed:
             self._check_cluster_status()
             st = time.time()
-            if self.train_only:
-                task = self._search_train_task()
-            else:
-                task = self._search_task()
+            # 先订阅再搜索，搜索期间入队的通知会缓存在订阅连接中
+            can_train = self._can_run_train()
+            self.wakeup.subscribe(self._wakeup_channels(can_train))
+            task = self._search_any_task(can_train)
+            if not task and block:
+                task = self._wait_task(self._idle_wait_timeout(st, sleep_time, idle_wait_time), can_train)
             if task:
-                if isinstance(task, Task):
-                    task.setdefault("worker", self.worker_id)
-
-                self.recorder.set_state(TaskReceiverState.Running)
+                self._on_task_received(task)
                 return task
             if not block:
                 return None
-            wait = sleep_time - time.time() + st
-            if wait > 0:
-                time.sleep(wait)
             self.register_worker()
 
-    def task_iter(self, sleep_time: float = 2) -> typing.Iterable[Task]:
+    def task_iter(self, sleep_time: float = 2, idle_wait_time: float = 10) -> typing.Iterable[Task]:
         while not self.closed:
             try:
                 self._check_cluster_status()
                 st = time.time()
+                task = None
 
                 # 释放弹性资源，不再获取任务主动
                 if self.release_elastic_res_state():
                     logger.info("release elastic resource...")
-                    task = None
+                    self.wakeup.pause()
                     time.sleep(1)
                 else:
-                    if self.train_only:
-                        task = self._search_train_task()
-                    else:
-                        task = self._search_task()
+                    # 先订阅再搜索，搜索期间入队的通知会缓存在订阅连接中
+                    can_train = self._can_run_train()
+                    self.wakeup.subscribe(self._wakeup_channels(can_train))
+                    task = self._search_any_task(can_train)
+                    if not task:
+                        self.recorder.set_state(TaskReceiverState.Idle)
+                        task = self._wait_task(self._idle_wait_timeout(st, sleep_time, idle_wait_time), can_train)
 
                 if task:
-                    if isinstance(task, Task):
-                        task.setdefault("worker", self.worker_id)
-
-                    self.recorder.set_state(TaskReceiverState.Running)
+                    self._on_task_received(task)
                     yield task
-                else:
-                    self.recorder.set_state(TaskReceiverState.Idle)
 
-                wait = sleep_time - time.time() + st
-                if wait > 0:
-                    time.sleep(wait)
                 self.register_worker()
                 self.write_worker_state()
                 self.exception_ts = -1
@@ -575,6 +636,53 @@ class TaskReceiver:
                     self.close()
                     break
 
+    def _renew_leases(self):
+        try:
+            rds = self.redis_pool.get_connection()
+            lost = self.leases.renew(rds)
+            for task_id in lost:
+                logger.warning(f"[lease] task:{task_id} lease lost, it may be executed by other worker, abandon it.")
+            for task_id in self.claimer.permits.renew(rds):
+                logger.warning(f"[permit] task:{task_id} train permit lost.")
+        except:
+            logger.exception("cannot renew task leases")
+
+    def _reap_expired_leases(self):
+        try:
+            rds = self.redis_pool.get_connection()
+            for lease in self.leases.reap(rds):
+                if lease.requeued:
+                    continue
+                # 超过重试次数，直接标记失败，不再等待超时清理
+                t = Task.from_json_str(lease.meta) if lease.meta else None
+                if t and dumper:
+                    p = TaskProgress.new_failed(t, 'worker lost and out of retries')
+                    dumper.dump_task_progress(p)
+        except:
+            logger.exception("cannot reap expired task leases")
+
+    def lease_lost(self, task_id: str) -> bool:
+        '''
+        任务租约是否已被回收（任务已交给其他 worker），是则放弃执行。
+        '''
+        return self.leases.lost(task_id)
+
+    def complete_task(self, task: Task):
+        '''
+        任务执行结束（成功或失败），释放租约。
+        '''
+        if isinstance(task, TaskBatch):
+            for t in task:
+                self.complete_task(t)
+            return
+        if not isinstance(task, Task):
+            return
+        try:
+            rds = self.redis_pool.get_connection()
+            self.leases.complete(rds, task.id)
+        except:
+            logger.exception(f"cannot complete task lease:{task.id}")
+
     def register_worker(self):
         if time.time() - self.register_time > 60:
             try:
@@ -639,51 +747,18 @@ class TaskReceiver:
             self.release_flag = False
         return self.release_flag
 
-    def incr_train_concurrency(self, user_id: str):
-        rds = self.redis_pool.get_connection()
-        key = f'counter:train:{user_id}'
-        v = rds.sadd(key, self.worker_id)
-        logger.info(f'{key} + 1, current:{v}')
-        rds.expire(key, 3 * 3600)
-
     def decr_train_concurrency(self, task: Task):
         if task.is_train:
             paralle_count = task.get('paralle_count', 0)
             if paralle_count > 0:
                 user_id = task.user_id
                 rds = self.redis_pool.get_connection()
-                key = f'counter:train:{user_id}'
-                v = rds.srem(key, self.worker_id)
-                logger.info(f'{key} - 1, current:{v}')
-                rds.expire(key, 3 * 3600)
-
-    def can_exec_train_task(self, user_id: str, max_value: int):
-        rds = self.redis_pool.get_connection()
-        key = f'counter:train:{user_id}'
-        members = rds.smembers(key)
-        if len(members) < max_value:
-            return True
-        running_workers = self.get_all_workers()
-        user_workers = set()
-
-        logger.debug(f">>> {user_id} current workers:{'/n/t'.join(running_workers)}, /n/t max:{max_value}")
-        flag = True
-        members = [k.decode('utf8') if isinstance(k, bytes) else k for k in members]
-        for worker_id in members:
-            if worker_id in running_workers:
-                user_workers.add(worker_id)
-            if len(user_workers) >= max_value:
-                flag = False
-                break
-        logger.info(f">>> {user_id} current trainning workers:{'/n/t'.join(user_workers)},/n/t max:{max_value}>{flag}")
-        return flag
+                self.claimer.permits.release(rds, user_id, task.id)
+                logger.info(f'train permit of {user_id} released, task:{task.id}')
 
     def repush_task(self, task_id: str, queue_name: str, score: int):
         rds = self.redis_pool.get_connection()
-
-        rds.zadd(queue_name, {
-            task_id: score
-        })
+        self.queue_registry.push(rds, queue_name, task_id, score)
 
     def close(self):
         if self.closed:
@@ -691,4 +766,5 @@ class TaskReceiver:
 
         self.closed = True
         self.timer.shutdown()
+        self.wakeup.close()
         self.redis_pool.close()
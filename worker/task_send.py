@@ -8,9 +8,12 @@
 import os.path
 import time
 
+from tools import serialize
 from tools.redis import RedisPool
 from .task import Task
+from .payload import offload_payload
 from .task_recv import TaskQueuePrefix
+from .queue_registry import QueueRegistry
 from .vip import VipLevel
 
 
@@ -18,6 +21,7 @@ class RedisSender:
 
     def __init__(self):
         self.redis_pool = RedisPool()
+        self.queue_registry = QueueRegistry()
 
     def push_task(self, level: VipLevel, *tasks: Task):
         redis = self.redis_pool.get_connection()
@@ -29,11 +33,10 @@ class RedisSender:
             #  task_ + shorthash(前10位的sha256)
             queue = TaskQueuePrefix + name
             now = int(time.time() * 1000)
-            meta = task.json()
-            redis.set(task.id, meta, 3600*24*1)
-            redis.zadd(queue, {
-                task.id: int(level) * -100000 + now
-            })
+            # 大字段（图片、蒙版、脚本参数等）存入 payload store，META 中只保留引用
+            meta = serialize.dumps(offload_payload(task.data))
+            # 写入META、入队并更新队列注册表
+            self.queue_registry.push(redis, queue, task.id, int(level) * -100000 + now, meta, 3600*24*1)
 
     def notify_train_task(self, task: Task):
         queue = 'checkpoint:train'
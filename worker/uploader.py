@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/14 2:05 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : uploader.py
+# @Software: xingzhe.ai
+import time
+import typing
+import traceback
+from loguru import logger
+from collections import defaultdict
+from threading import Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
+from .task import Task, TaskProgress
+
+UploadFunc = typing.Callable[[], TaskProgress]
+ProgressCallback = typing.Callable[[TaskProgress], typing.Any]
+
+
+class AsyncTaskUploader:
+    '''
+    结果上传流水线：GPU 线程采样结束后提交“保存-压缩-上传-审核”任务，由后台线程执行并输出最终进度，
+    GPU 线程直接执行下一个任务。等待上传的任务数达到 max_pending 时提交阻塞（限制内存中的图片数量）。
+    '''
+
+    def __init__(self, workers: int = 2, max_pending: int = 4):
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='task-uploader')
+        self._slots = BoundedSemaphore(max_pending)
+        self._locker = Lock()
+        # 任务ID -> 上传结束后需要执行的回调
+        self._pending = defaultdict(list)
+
+    def submit(self, task: Task, upload: UploadFunc, callback: ProgressCallback):
+        '''
+        upload 返回任务最终进度（上传失败时生成失败进度），通过 callback 输出。
+        '''
+        self._slots.acquire()
+        with self._locker:
+            self._pending[task.id]
+        try:
+            self._pool.submit(self._upload, task, upload, callback)
+        except Exception:
+            self._done(task.id)
+            raise
+
+    def _upload(self, task: Task, upload: UploadFunc, callback: ProgressCallback):
+        st = time.time()
+        try:
+            try:
+                progress = upload()
+            except Exception as ex:
+                logger.exception(f"upload task:{task.id} failed")
+                progress = TaskProgress.new_failed(task, f'upload failed:{ex}', traceback.format_exc())
+            callback(progress)
+            logger.info(f"[uploader] task:{task.id} uploaded, cost:{time.time() - st:.2f}s")
+        except Exception:
+            logger.exception(f"upload task:{task.id} callback err")
+        finally:
+            self._done(task.id)
+
+    def _done(self, task_id: str):
+        with self._locker:
+            callbacks = self._pending.pop(task_id, [])
+        self._slots.release()
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception:
+                logger.exception(f"task:{task_id} upload done callback err")
+
+    def run_after(self, task_id: str, fn: typing.Callable):
+        '''
+        任务上传结束后执行 fn（没有等待上传的任务时立即执行）。
+        '''
+        with self._locker:
+            if task_id in self._pending:
+                self._pending[task_id].append(fn)
+                return
+        fn()
+
+    def stop(self):
+        self._pool.shutdown(wait=True)
+
+
+uploader = AsyncTaskUploader()
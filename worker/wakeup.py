@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/12/6 2:40 PM
+# @Author  : wangdongming
+# @Site    :
+# @File    : wakeup.py
+# @Software: xingzhe.ai
+import time
+import typing
+from loguru import logger
+
+# 入队通知频道：task-wakeup:<队列名>，消息内容为队列名，worker 只订阅可以执行的队列
+TaskWakeupChannelPrefix = 'task-wakeup:'
+# 公共通知频道：队列频道没有订阅者（没有已加载该模型的空闲 worker）时通知所有空闲的通用 worker
+TaskWakeupAnyChannel = 'task-wakeup-any'
+
+# 发送入队通知，供其他脚本拼接使用
+PublishWakeupLua = """
+local function publish_wakeup(prefix, any_channel, queue)
+    if redis.call('PUBLISH', prefix .. queue, queue) == 0 then
+        redis.call('PUBLISH', any_channel, queue)
+    end
+end
+"""
+
+
+def _decode(v):
+    return v.decode('utf8') if isinstance(v, bytes) else v
+
+
+def wakeup_channel(queue_name: str) -> str:
+    return TaskWakeupChannelPrefix + queue_name
+
+
+def publish_wakeup(rds, queue_name: str):
+    if not rds.publish(wakeup_channel(queue_name), queue_name):
+        rds.publish(TaskWakeupAnyChannel, queue_name)
+
+
+class TaskWakeupListener:
+    '''
+    订阅入队通知，空闲 worker 阻塞等待，不再定时轮询 REDIS。
+    channels 返回当前需要订阅的频道（以 * 结尾的按模式订阅），每次 subscribe 时重新计算。
+    通知可能丢失（连接断开、订阅前入队），调用方需要设置超时并回落到轮询。
+    '''
+
+    def __init__(self, redis_pool, channels: typing.Callable[[], typing.Iterable[str]] = None):
+        self.redis_pool = redis_pool
+        self.channels = channels or (lambda: [TaskWakeupChannelPrefix + '*'])
+        self._pubsub = None
+        self._subscribed = set()
+
+    @property
+    def listening(self):
+        return self._pubsub is not None
+
+    def subscribe(self, channels: typing.Iterable[str] = None):
+        '''
+        开始订阅（幂等，频道变化时增量更新），需要在搜索任务之前调用，避免搜索与等待之间入队的通知丢失。
+        channels 为空时使用构造时传入的 channels 计算。
+        '''
+        try:
+            channels = set(self.channels() if channels is None else channels)
+            if self._pubsub is not None and channels == self._subscribed:
+                return True
+            if self._pubsub is None:
+                rds = self.redis_pool.get_connection()
+                self._pubsub = rds.pubsub(ignore_subscribe_messages=True)
+                self._subscribed = set()
+            removed, added = self._subscribed - channels, channels - self._subscribed
+            for channel in removed:
+                (self._pubsub.punsubscribe if channel.endswith('*') else self._pubsub.unsubscribe)(channel)
+            for channel in added:
+                (self._pubsub.psubscribe if channel.endswith('*') else self._pubsub.subscribe)(channel)
+            self._subscribed = channels
+            return True
+        except Exception as err:
+            logger.warning(f"cannot subscribe task wakeup:{err}")
+            self.pause()
+            return False
+
+    def wait(self, timeout: float) -> typing.List[str]:
+        '''
+        等待入队通知，返回去重后的队列名列表，超时返回空列表。
+        '''
+        # 已订阅时沿用本轮的频道，不重新计算
+        if not self.listening and not self.subscribe():
+            time.sleep(timeout)
+            return []
+
+        queues = []
+        deadline = time.time() + timeout
+        try:
+            while 1:
+                # 先取走已缓存的全部通知，没有通知时再阻塞等待
+                msg = self._pubsub.get_message(timeout=0 if queues else max(deadline - time.time(), 0))
+                if msg is None:
+                    if queues or time.time() >= deadline:
+                        break
+                    continue
+                if msg.get('type') in ('message', 'pmessage'):
+                    queue_name = _decode(msg['data'])
+                    if queue_name not in queues:
+                        queues.append(queue_name)
+        except Exception as err:
+            logger.warning(f"task wakeup listener err:{err}")
+            self.pause()
+            remaining = deadline - time.time()
+            if remaining > 0 and not queues:
+                time.sleep(remaining)
+        return queues
+
+    def pause(self):
+        '''
+        执行任务期间取消订阅，防止通知在连接缓冲区中堆积。
+        '''
+        pubsub, self._pubsub = self._pubsub, None
+        if pubsub is not None:
+            try:
+                pubsub.close()
+            except Exception:
+                pass
+
+    def close(self):
+        self.pause()